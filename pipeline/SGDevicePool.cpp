@@ -1,3 +1,4 @@
+#include <cmath>
 #include "SGDevicePool.h"
 
 namespace bm {
@@ -18,15 +19,85 @@ void SGDeviceContext::setConfigData(void *value)
     configData = value;
 }
 
-SGDeviceContext::SGDeviceContext(DeviceId deviceId, const std::string &bmodel):
-    deviceId(deviceId), batchSize(batchSize), configData(nullptr) {
-    batchSize = -1;
-    SGLOG(INFO, "init context on device %d", deviceId);
+SGDeviceRuntime::SGDeviceRuntime(DeviceId deviceId): deviceId(deviceId) {
+    SGLOG(INFO, "init runtime on device %d", deviceId);
     auto status = bm_dev_request(&handle, deviceId);
     BM_ASSERT_EQ(status, BM_SUCCESS);
     pSGRuntime = bmrt_create(handle);
     BM_ASSERT(pSGRuntime != nullptr, "cannot create bmruntime handle");
-    net = std::make_shared<SGNetwork>(pSGRuntime, bmodel);
+}
+
+SGDeviceRuntime::~SGDeviceRuntime() {
+    bmrt_destroy(pSGRuntime);
+    bm_dev_free(handle);
+}
+
+static std::vector<std::string> networkNames(void *bmrt) {
+    std::vector<std::string> result;
+    const char **names;
+    int num = bmrt_get_network_number(bmrt);
+    if(num == 0) return result;
+    bmrt_get_network_names(bmrt, &names);
+    result.assign(names, names + num);
+    free(names);
+    return result;
+}
+
+bool SGDeviceRuntime::loadBModel(const std::string &bmodel, std::string &netName) {
+    std::lock_guard<std::mutex> guard(mut);
+    auto iter = netNames.find(bmodel);
+    if(iter != netNames.end()) {
+        netName = iter->second;
+        return true;
+    }
+    auto loaded = networkNames(pSGRuntime);
+    if (!bmrt_load_bmodel(pSGRuntime, bmodel.c_str())) {
+        // the network name is taken by a bmodel loaded before
+        if(!loaded.empty()) return false;
+        SGLOG(FATAL, "load bmodel(%s) failed!", bmodel.c_str());
+    }
+    for(auto& name: networkNames(pSGRuntime)){
+        if(std::find(loaded.begin(), loaded.end(), name) == loaded.end()){
+            netNames[bmodel] = name;
+            netName = name;
+            return true;
+        }
+    }
+    if(!loaded.empty()) return false;
+    SGLOG(FATAL, "no new network in bmodel(%s)", bmodel.c_str());
+    return false;
+}
+
+std::shared_ptr<SGDeviceRuntime> SGDeviceRuntime::acquire(DeviceId deviceId, bool shared) {
+    if(!shared) return std::make_shared<SGDeviceRuntime>(deviceId);
+    static std::mutex cacheMutex;
+    static std::map<DeviceId, std::weak_ptr<SGDeviceRuntime>> cache;
+    std::lock_guard<std::mutex> guard(cacheMutex);
+    auto runtime = cache[deviceId].lock();
+    if(!runtime){
+        runtime = std::make_shared<SGDeviceRuntime>(deviceId);
+        cache[deviceId] = runtime;
+    }
+    return runtime;
+}
+
+SGDeviceContext::SGDeviceContext(DeviceId deviceId, const std::string &bmodel, bool sharedRuntime):
+    deviceId(deviceId), batchSize(batchSize), configData(nullptr) {
+    batchSize = -1;
+    SGLOG(INFO, "init context on device %d", deviceId);
+    runtime = SGDeviceRuntime::acquire(deviceId, sharedRuntime);
+    std::string netName;
+    if(!runtime->loadBModel(bmodel, netName)) {
+        SGLOG(WARNING, "network of bmodel(%s) clashes with one loaded on device %d, using a private runtime",
+              bmodel.c_str(), deviceId);
+        runtime = SGDeviceRuntime::acquire(deviceId, false);
+        if(!runtime->loadBModel(bmodel, netName)) {
+            SGLOG(FATAL, "load bmodel(%s) failed!", bmodel.c_str());
+        }
+    }
+    handle = runtime->handle;
+    pSGRuntime = runtime->pSGRuntime;
+    net = std::make_shared<SGNetwork>(pSGRuntime, bmodel, netName);
     batchSize = net->getBatchSize();
     net->showInfo();
 }
@@ -60,8 +131,6 @@ SGDeviceContext::~SGDeviceContext() {
     for(auto m : mems){
         freeDeviceMem(m);
     }
-    bmrt_destroy(pSGRuntime);
-    bm_dev_free(handle);
 }
 
 void ProcessStatInfo::update(const std::shared_ptr<ProcessStatus> &status, size_t batch) {
@@ -71,13 +140,63 @@ void ProcessStatInfo::update(const std::shared_ptr<ProcessStatus> &status, size_
         for(size_t i = durations.size(); i<status->starts.size(); i++){
             durations.push_back(0);
         }
+        std::lock_guard<std::mutex> guard(histogramMutex);
         for(size_t i=0; i<status->starts.size(); i++){
-            durations[i] += usBetween(status->starts[i], status->ends[i]);
+            auto duration = usBetween(status->starts[i], status->ends[i]);
+            durations[i] += duration;
+            stageHistograms[std::make_pair(status->deviceId, i)].record(duration);
         }
         deviceProcessNum[status->deviceId] += batch;
     }
 }
 
+size_t LatencyHistogram::bucketIndex(uint64_t value) {
+    const uint64_t subCount = 1 << subBits;
+    const uint64_t halfCount = subCount >> 1;
+    if(value < subCount) return value;
+    size_t msb = 63;
+    while(!(value >> msb)) msb--;
+    size_t shift = msb - subBits + 1;
+    return subCount + (shift - 1) * halfCount + (value >> shift) - halfCount;
+}
+
+uint64_t LatencyHistogram::bucketLower(size_t index) {
+    const uint64_t subCount = 1 << subBits;
+    const uint64_t halfCount = subCount >> 1;
+    if(index < subCount) return index;
+    size_t shift = (index - subCount) / halfCount + 1;
+    return (halfCount + (index - subCount) % halfCount) << shift;
+}
+
+uint64_t LatencyHistogram::bucketUpper(size_t index) {
+    return bucketLower(index + 1) - 1;
+}
+
+void LatencyHistogram::record(uint64_t value) {
+    auto index = bucketIndex(value);
+    if(index >= counts.size()) counts.resize(index + 1, 0);
+    counts[index]++;
+    total++;
+    sum += value;
+    maxValue = std::max(maxValue, value);
+}
+
+double LatencyHistogram::mean() const {
+    return total? (double)sum/total: 0;
+}
+
+uint64_t LatencyHistogram::percentile(double p) const {
+    uint64_t rank = std::ceil(p / 100 * total);
+    uint64_t seen = 0;
+    for(size_t i=0; i<counts.size(); i++){
+        seen += counts[i];
+        if(seen >= rank && seen > 0){
+            return std::min(bucketUpper(i), maxValue);
+        }
+    }
+    return maxValue;
+}
+
 void ProcessStatInfo::start() {
     startTime=std::chrono::steady_clock::now();
 }
@@ -100,7 +219,8 @@ void ProcessStatInfo::show() {
 
     SGLOG(INFO, "Samples process stat:");
     for(auto& p: deviceProcessNum){
-        SGLOG(INFO, "  -> device #%d processes %d samples", p.first, p.second);
+        SGLOG(INFO, "  -> device #%d processes %d samples, speed=%g samples/sec",
+              p.first, p.second, p.second*1e6/totalUs);
     }
     SGLOG(INFO, "Average per device:");
     for(size_t i=0; i<durations.size(); i++){
@@ -108,6 +228,15 @@ void ProcessStatInfo::show() {
               __phaseMap[i],
               durations[i]/1000.0, durations[i]/1000.0/numSamples);
     }
+    std::lock_guard<std::mutex> guard(histogramMutex);
+    SGLOG(INFO, "Latency per device and stage:");
+    for(auto& p: stageHistograms){
+        auto& h = p.second;
+        SGLOG(INFO, "  -> device #%d %s: p50=%gms, p90=%gms, p99=%gms, max=%gms",
+              p.first.first, __phaseMap[p.first.second],
+              h.percentile(50)/1000.0, h.percentile(90)/1000.0,
+              h.percentile(99)/1000.0, h.maxValue/1000.0);
+    }
 }
 
 void ProcessStatus::reset(){
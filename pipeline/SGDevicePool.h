@@ -5,6 +5,8 @@
 #include <algorithm>
 #include <exception>
 #include <chrono>
+#include <map>
+#include <mutex>
 #include "SGDeviceUtils.h"
 #include "SGPipelinePool.h"
 #include "SGNetwork.h"
@@ -13,22 +15,44 @@
 namespace bm {
 
 extern const char* __phaseMap[];
+
+// bm handle and bmruntime of a device, shared by the runners that load
+// their bmodels into it
+class SGDeviceRuntime: public Uncopiable {
+    std::mutex mut;
+    std::map<std::string, std::string> netNames;
+
+public:
+    DeviceId deviceId;
+    bm_handle_t handle;
+    void* pSGRuntime;
+
+    SGDeviceRuntime(DeviceId deviceId);
+    ~SGDeviceRuntime();
+
+    // loads bmodel on first use and sets netName to its network name.
+    // false when the runtime already holds a network of the same name,
+    // bmruntime keeps one network per name
+    bool loadBModel(const std::string& bmodel, std::string& netName);
+
+    static std::shared_ptr<SGDeviceRuntime> acquire(DeviceId deviceId, bool shared);
+};
+
 class SGDeviceContext {
 
 private:
     std::vector<bm_device_mem_t> mem_to_free;
-    void* preExtra;
-    void* postExtra;
 
 public:
     DeviceId deviceId;
+    std::shared_ptr<SGDeviceRuntime> runtime;
     bm_handle_t handle;
     void* pSGRuntime;
     std::shared_ptr<SGNetwork> net;
     size_t batchSize;
     void* configData;
 
-    SGDeviceContext(DeviceId deviceId, const std::string& bmodel);
+    SGDeviceContext(DeviceId deviceId, const std::string& bmodel, bool sharedRuntime = false);
 
     std::shared_ptr<SGNetwork> getNetwork() { return net; }
     size_t getBatchSize(){ return batchSize; }
@@ -40,20 +64,6 @@ public:
 
     void allocMemForTensor(TensorPtr tensor);
 
-    void setPreExtra(void* data){
-        preExtra = data;
-    }
-    void* getPreExtra(){
-        return preExtra;
-    }
-
-    void* getPostExtra(){
-        return postExtra;
-    }
-    void setPostExtra(void* data){
-        postExtra = data;
-    }
-
     ~SGDeviceContext();
     void *getConfigData() const;
     void setConfigData(void *value);
@@ -74,11 +84,30 @@ struct ProcessStatus {
 
 };
 
+// log-linear latency histogram in us, buckets are within ~6% of their values
+struct LatencyHistogram {
+    static const size_t subBits = 5;
+    std::vector<uint64_t> counts;
+    uint64_t total = 0;
+    uint64_t sum = 0;
+    uint64_t maxValue = 0;
+
+    static size_t bucketIndex(uint64_t value);
+    static uint64_t bucketLower(size_t index);
+    static uint64_t bucketUpper(size_t index);
+    void record(uint64_t value);
+    double mean() const;
+    uint64_t percentile(double p) const;
+};
+
 struct ProcessStatInfo {
     size_t totalDuration = 0;
     size_t numSamples = 0;
     std::map<size_t, size_t> deviceProcessNum;
     std::vector<size_t> durations;
+    // per (device, stage) latency
+    std::map<std::pair<DeviceId, size_t>, LatencyHistogram> stageHistograms;
+    std::mutex histogramMutex;
     std::string name;
     std::chrono::steady_clock::time_point startTime;
     ProcessStatInfo(const std::string& name): name(name), startTime(std::chrono::steady_clock::now()){ }
@@ -90,6 +119,17 @@ struct ProcessStatInfo {
     }
 };
 
+// how tasks are handed to the devices of a SGDevicePool
+enum SGSchedulePolicy {
+    // devices take tasks from one shared queue, whoever wakes first
+    SG_SCHEDULE_SHARED = 0,
+    SG_SCHEDULE_ROUND_ROBIN = 1,
+    // the device with the fewest tasks not yet popped
+    SG_SCHEDULE_LEAST_OUTSTANDING = 2,
+    // the device expected to finish first, from its recent forward time
+    SG_SCHEDULE_LATENCY_WEIGHTED = 3,
+};
+
 template<typename InType, typename OutType>
 class SGDevicePool {
 public:
@@ -117,13 +157,24 @@ public:
 
     using RunnerType = SGPipelinePool<InType, _PostOutType, SGDeviceContext>;
     using RunnerPtr = std::shared_ptr<RunnerType>;
-    using PreProcessFunc = std::function<bool(const InType&, const TensorVec&, ContextPtr)>;
-    using PostProcessFunc = std::function<bool(const InType&, const TensorVec&, OutType&, ContextPtr)>;
+    // extra is data of the task handed from pre-process to post-process.
+    // It travels with the task, the context is shared by the workers of a
+    // device
+    using PreProcessFunc = std::function<bool(const InType&, const TensorVec&, void*& extra, ContextPtr)>;
+    using PostProcessFunc = std::function<bool(const InType&, const TensorVec&, OutType&, void* extra, ContextPtr)>;
     std::atomic_size_t atomicBatchSize;
 
     template<typename PreFuncType, typename PostFuncType>
     SGDevicePool(const std::string& bmodel, PreFuncType preProcessFunc, PostFuncType postProcessFunc,
-                 std::vector<DeviceId> userDeviceIds={}): atomicBatchSize(0) {
+                 std::vector<DeviceId> userDeviceIds={}, bool sharedRuntime=false,
+                 SGQueueType queueType=SG_QUEUE_LOCKED,
+                 size_t bufferDepth=2, size_t queueCapacity=0,
+                 SGSchedulePolicy policy=SG_SCHEDULE_SHARED,
+                 size_t preWorkers=1, size_t postWorkers=1):
+        atomicBatchSize(0), bufferDepth(bufferDepth), policy(policy), nextIndex(0),
+        preWorkers(preWorkers), postWorkers(postWorkers) {
+        BM_ASSERT(bufferDepth>0, "buffer depth must be positive");
+        BM_ASSERT(preWorkers>0 && postWorkers>0, "worker number must be positive");
         deviceIds = userDeviceIds;
         if(userDeviceIds.empty()){
            deviceIds = getAvailableDevices();
@@ -136,8 +187,8 @@ public:
             deviceStr += std::to_string(id)+" ";
         }
         SGLOG(INFO, "USING DEVICES: %s", deviceStr.c_str());
-        std::function<std::shared_ptr<ContextType>(size_t)>  contextInitializer = [&localDeviceIds, bmodel, this](size_t i) {
-            auto context = std::make_shared<ContextType>(localDeviceIds[i], bmodel);
+        std::function<std::shared_ptr<ContextType>(size_t)>  contextInitializer = [&localDeviceIds, bmodel, sharedRuntime, this](size_t i) {
+            auto context = std::make_shared<ContextType>(localDeviceIds[i], bmodel, sharedRuntime);
             this->atomicBatchSize=context->getBatchSize();
             return context;
         };
@@ -146,10 +197,14 @@ public:
             return std::string(netInfo->name) + "@" + std::to_string(localDeviceIds[i]);
         };
 
-        pool = std::make_shared<RunnerType>(deviceNum, contextInitializer, nullptr, nameFunc);
+        pool = std::make_shared<RunnerType>(deviceNum, contextInitializer, nullptr, nameFunc, queueType,
+                                            policy != SG_SCHEDULE_SHARED);
+        outstanding.assign(deviceNum, 0);
+        forwardUs.assign(deviceNum, 0);
 
-        auto inQueue = pool->getInputQueue();
-        inQueue->setMaxNode(deviceNum*4);
+        // queue capacity 0 means the default of 4 tasks per device
+        this->queueCapacity = queueCapacity? queueCapacity: deviceNum*4;
+        pool->setInputCapacity(this->queueCapacity);
 
         PreProcessFunc preCoreFunc = preProcessFunc;
         PostProcessFunc postCoreFunc = postProcessFunc;
@@ -157,18 +212,24 @@ public:
                 [this, preCoreFunc] (const InType& in, _PreOutType& out, ContextPtr ctx){
             return preProcess(in, out, ctx, preCoreFunc);
         };
-        std::function<std::vector<_PreOutType>(ContextPtr)> preCreateFunc = createPreProcessOutput;
-        pool->addNode(preFunc, preCreateFunc);
+        size_t preDepth = getPreDepth();
+        std::function<std::vector<_PreOutType>(ContextPtr)> preCreateFunc = [preDepth](ContextPtr ctx){
+            return createPreProcessOutput(ctx, preDepth);
+        };
+        pool->addNode(preFunc, preCreateFunc, preWorkers);
 
         std::function<bool(const _PreOutType&, _ForwardOutType&, ContextPtr)> forwardFunc = forward;
-        std::function<std::vector<_ForwardOutType>(ContextPtr)> createForwardFunc = createForwardOutput;
+        size_t forwardDepth = getForwardDepth();
+        std::function<std::vector<_ForwardOutType>(ContextPtr)> createForwardFunc = [forwardDepth](ContextPtr ctx){
+            return createForwardOutput(ctx, forwardDepth);
+        };
         pool->addNode(forwardFunc, createForwardFunc);
 
         std::function<bool(const _ForwardOutType&, _PostOutType&, ContextPtr)> postFunc =
                 [postCoreFunc] (const _ForwardOutType& in, _PostOutType& out, ContextPtr ctx){
             return postProcess(in, out, ctx, postCoreFunc);
         };
-        pool->addNode(postFunc);
+        pool->addNode(postFunc, std::function<std::vector<_PostOutType>(ContextPtr)>(), postWorkers);
     }
 
     const bm_net_info_t *getNetInfo() const {
@@ -206,7 +267,17 @@ public:
     }
 
     bool push(InType in){
-        return pool->push(in);
+        if(policy == SG_SCHEDULE_SHARED){
+            return pool->push(in);
+        }
+        size_t index = schedule();
+        if(index == deviceIds.size()) return false;
+        if(!pool->pushTo(index, in)){
+            std::lock_guard<std::mutex> guard(scheduleMutex);
+            outstanding[index]--;
+            return false;
+        }
+        return true;
     }
 
     bool empty() {
@@ -223,6 +294,7 @@ public:
         if(res){
             status = postOut.status;
             out = postOut.out;
+            completed(status);
         }
         return res;
     }
@@ -233,25 +305,83 @@ public:
         if(res){
             status = postOut.status;
             out = postOut.out;
+            completed(status);
         }
         return res;
     }
 
+    template<typename Duration>
+    bool waitAndPopFor(OutType &out, std::shared_ptr<ProcessStatus>& status, const Duration& timeout) {
+        _PostOutType postOut;
+        bool res = pool->waitAndPopFor(postOut, timeout);
+        if(res){
+            status = postOut.status;
+            out = postOut.out;
+            completed(status);
+        }
+        return res;
+    }
+
+    // picks the device of the next task and counts it as outstanding,
+    // returns deviceNum() if no device is available
+    size_t schedule() {
+        std::lock_guard<std::mutex> guard(scheduleMutex);
+        size_t num = deviceIds.size();
+        size_t best = num;
+        if(policy == SG_SCHEDULE_ROUND_ROBIN){
+            for(size_t i=0; i<num && best == num; i++){
+                size_t index = (nextIndex + i) % num;
+                if(pool->isAvailable(index)) best = index;
+            }
+            nextIndex = best + 1;
+        } else {
+            bool measured = std::all_of(forwardUs.begin(), forwardUs.end(), [](double t){ return t>0; });
+            double bestCost = 0;
+            for(size_t index=0; index<num; index++){
+                if(!pool->isAvailable(index)) continue;
+                double cost = outstanding[index] + 1;
+                if(policy == SG_SCHEDULE_LATENCY_WEIGHTED && measured){
+                    cost *= forwardUs[index];
+                }
+                if(best == num || cost < bestCost){
+                    best = index;
+                    bestCost = cost;
+                }
+            }
+        }
+        if(best != num) outstanding[best]++;
+        return best;
+    }
+
+    void completed(const std::shared_ptr<ProcessStatus>& status) {
+        if(policy == SG_SCHEDULE_SHARED) return;
+        auto iter = std::find(deviceIds.begin(), deviceIds.end(), status->deviceId);
+        if(iter == deviceIds.end()) return;
+        size_t index = iter - deviceIds.begin();
+        std::lock_guard<std::mutex> guard(scheduleMutex);
+        if(outstanding[index]) outstanding[index]--;
+        if(status->valid && status->starts.size()>1){
+            // moving average of the forward time
+            double us = usBetween(status->starts[1], status->ends[1]);
+            forwardUs[index] = forwardUs[index]>0? 0.8*forwardUs[index] + 0.2*us: us;
+        }
+    }
+
     bool preProcess(const InType& in, _PreOutType& out, ContextPtr ctx, PreProcessFunc preCoreFunc) {
         out.status = std::make_shared<ProcessStatus>();
         out.status->deviceId = ctx->deviceId;
         out.status->start();
         out.in = in;
-        out.status->valid = preCoreFunc(in, out.preOut, ctx);
+        out.extra = nullptr;
+        out.status->valid = preCoreFunc(in, out.preOut, out.extra, ctx);
         out.status->end();
-        out.extra = ctx->getPreExtra();
         return true;
     }
 
-    static std::vector<_PreOutType> createPreProcessOutput(ContextPtr ctx) {
+    static std::vector<_PreOutType> createPreProcessOutput(ContextPtr ctx, size_t depth) {
         auto net = ctx->net;
         std::vector<_PreOutType> preOuts;
-        for(size_t i=0; i<2; i++){
+        for(size_t i=0; i<depth; i++){
             _PreOutType preOut;
             preOut.preOut = net->createInputTensors();
             for(auto tensor: preOut.preOut){
@@ -274,10 +404,10 @@ public:
         return true;
     }
 
-    static std::vector<_ForwardOutType> createForwardOutput(ContextPtr ctx) {
+    static std::vector<_ForwardOutType> createForwardOutput(ContextPtr ctx, size_t depth) {
         auto net = ctx->net;
         std::vector<_ForwardOutType> forwardOuts;
-        for(size_t i=0; i<2; i++){
+        for(size_t i=0; i<depth; i++){
             _ForwardOutType forwardOut;
             forwardOut.forwardOut = net->createOutputTensors();
             for(auto tensor: forwardOut.forwardOut){
@@ -290,9 +420,8 @@ public:
 
     static bool postProcess(const _ForwardOutType& in, _PostOutType& out, ContextPtr ctx, PostProcessFunc postCoreFunc) {
         out.status = std::move(in.status);
-        ctx->setPostExtra(in.extra);
         out.status->start();
-        out.status->valid &= postCoreFunc(in.in, in.forwardOut, out.out, ctx);
+        out.status->valid &= postCoreFunc(in.in, in.forwardOut, out.out, in.extra, ctx);
         out.status->end();
         return true;
     }
@@ -302,9 +431,27 @@ public:
     }
 
     size_t deviceNum() const { return deviceIds.size(); }
+    size_t getBufferDepth() const { return bufferDepth; }
+    size_t getQueueCapacity() const { return queueCapacity; }
+    size_t getPreWorkers() const { return preWorkers; }
+    size_t getPostWorkers() const { return postWorkers; }
+    // buffers per device of the pre-process and forward outputs, every
+    // worker of the consuming stage needs its own, plus one held by the
+    // stage after it
+    size_t getPreDepth() const { return std::max(bufferDepth, preWorkers + 1); }
+    size_t getForwardDepth() const { return std::max(bufferDepth, postWorkers + 1); }
 private:
     RunnerPtr pool;
     std::vector<DeviceId> deviceIds;
+    size_t bufferDepth;
+    size_t queueCapacity;
+    SGSchedulePolicy policy;
+    std::mutex scheduleMutex;
+    size_t nextIndex;
+    std::vector<size_t> outstanding;
+    std::vector<double> forwardUs;
+    size_t preWorkers;
+    size_t postWorkers;
 };
 
 }
@@ -2,9 +2,9 @@
 #include "SGNetwork.h"
 namespace bm {
 
-SGNetwork::SGNetwork(void *bmrt, const std::string &name): m_bmrt(bmrt), bmodelPath(name) {
+SGNetwork::SGNetwork(void *bmrt, const std::string &name, const std::string &netName): m_bmrt(bmrt), bmodelPath(name) {
     m_handle = static_cast<bm_handle_t>(bmrt_get_bm_handle(bmrt));
-    if (!bmrt_load_bmodel(m_bmrt, bmodelPath.c_str())) {
+    if (netName.empty() && !bmrt_load_bmodel(m_bmrt, bmodelPath.c_str())) {
         SGLOG(FATAL, "load bmodel(%s) failed!", bmodelPath.c_str());
     }
     const char **names;
@@ -16,7 +16,7 @@ SGNetwork::SGNetwork(void *bmrt, const std::string &name): m_bmrt(bmrt), bmodelP
     }
     free(names);
 
-    auto net_name = m_network_names[0];
+    auto net_name = netName.empty() ? m_network_names[0] : netName;
     m_netinfo = bmrt_get_network_info(bmrt, net_name.c_str());
     assert(m_netinfo->stage_num == 1);
     batchSize = 1;
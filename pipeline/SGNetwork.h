@@ -74,7 +74,8 @@ class SGNetwork : public Uncopiable {
     std::vector<std::string> m_network_names;
 
 public:
-    SGNetwork(void *bmrt, const std::string& name);
+    // loads bmodel name into bmrt, unless it is already loaded as netName
+    SGNetwork(void *bmrt, const std::string& name, const std::string& netName = "");
     void showInfo();
 
     ~SGNetwork() { }
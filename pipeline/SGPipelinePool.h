@@ -11,6 +11,7 @@
 #include "SGLog.h"
 #include "SGCommonUtils.h"
 #include "SGQueue.h"
+#include "SGThreadPool.h"
 
 namespace bm {
 
@@ -41,6 +42,8 @@ private:
     std::thread innerThread;
     std::atomic_bool& done;
     std::string name;
+    size_t numWorkers;
+    std::unique_ptr<SGThreadPool> workers;
 
     void workThread(){
         if(!inTaskQueue) {
@@ -48,6 +51,10 @@ private:
             SGLOG(FATAL, "[%s] no input task queue!", name.c_str());
             return;
         }
+        if(workers) {
+            parallelWorkThread();
+            return;
+        }
         // done is global, if it is set all pipeline threads will stop
         // so we use a seperate local flag
         // done can still be useful, such as when handling exceptions
@@ -90,20 +97,95 @@ private:
         SGLOG(DEBUG, "[%s] leave thread", name.c_str());
     }
 
+    // Runs taskFunc on the worker threads, one output per input. This thread
+    // stays the only user of the queues and retires the tasks in the order
+    // they were taken, so outputs keep the input order.
+    // Unlike workThread, an output cannot accumulate several inputs here, so
+    // taskFunc of a multi-worker node must always return true.
+    void parallelWorkThread(){
+        struct Ticket {
+            InType in;
+            OutType out;
+            std::future<bool> result;
+        };
+        std::deque<Ticket> tickets;
+        auto retire = [&]() {
+            auto& ticket = tickets.front();
+            BM_ASSERT(ticket.result.get(), "[%s] task of a multi-worker node must return true", name.c_str());
+            if(inFreeQueue) {
+                inFreeQueue->push(ticket.in);
+            }
+            if(!done && outTaskQueue) {
+                outTaskQueue->push(ticket.out);
+            }
+            tickets.pop_front();
+        };
+        auto ready = [](Ticket& ticket) {
+            return ticket.result.wait_for(std::chrono::seconds(0)) == std::future_status::ready;
+        };
+        OutType out;
+        bool hasOut = !outFreeQueue;
+        while(!done){
+            while(!tickets.empty() && ready(tickets.front())) retire();
+            if(tickets.size() >= numWorkers) {
+                retire();
+                continue;
+            }
+            if(!hasOut) {
+                if(outFreeQueue->tryPop(out)) {
+                    hasOut = true;
+                } else if(!tickets.empty()) {
+                    retire();
+                    continue;
+                } else if(outFreeQueue->waitAndPop(out)) {
+                    hasOut = true;
+                } else {
+                    break;
+                }
+            }
+            InType in;
+            if(!inTaskQueue->tryPop(in)) {
+                if(!tickets.empty()) {
+                    retire();
+                    continue;
+                }
+                if(!inTaskQueue->waitAndPop(in)) {
+                    SGLOG(DEBUG, "[%s] join", name.c_str());
+                    break;
+                }
+            }
+            tickets.emplace_back();
+            auto ticket = &tickets.back();
+            ticket->in = std::move(in);
+            ticket->out = std::move(out);
+            hasOut = !outFreeQueue;
+            ticket->result = workers->submit([this, ticket]() {
+                return taskFunc(ticket->in, ticket->out, context);
+            });
+        }
+        while(!tickets.empty()) retire();
+        SGLOG(DEBUG, "[%s] leave thread", name.c_str());
+    }
+
 public:
     SGPipelineNodeImp(TaskType taskFunc,
                       InQueuePtr inFreeQueue, InQueuePtr inTaskQueue,
                       OutQueuePtr outFreeQueue, OutQueuePtr outTaskQueue,
                       std::atomic_bool& done,
                       std::shared_ptr<ContextType> context,
-                      const std::string& name
+                      const std::string& name,
+                      size_t numWorkers = 1
                       ):
         taskFunc(taskFunc),
         inFreeQueue(inFreeQueue), inTaskQueue(inTaskQueue),
         outFreeQueue(outFreeQueue), outTaskQueue(outTaskQueue),
         done(done),
-        context(context), name(name)
-    {}
+        context(context), name(name), numWorkers(numWorkers)
+    {
+        if(numWorkers > 1) {
+            workers.reset(new SGThreadPool(numWorkers));
+        }
+    }
 
     virtual void setOutQueue(std::shared_ptr<SGQueueVoid> outQueueVoid) override {
         auto outQueue = std::dynamic_pointer_cast<SGQueue<OutType>>(outQueueVoid);
@@ -145,12 +227,15 @@ private:
     std::string lastTypeName;
     std::string outTypeName;
     std::string pipelineName;
+    SGQueueType queueType;
 
 public:
-    SGPipeline(std::shared_ptr<ContextType> context = std::shared_ptr<ContextType>(), const std::string& name="node"):
+    SGPipeline(std::shared_ptr<ContextType> context = std::shared_ptr<ContextType>(), const std::string& name="node",
+               SGQueueType queueType = SG_QUEUE_LOCKED):
         context(context),
         done(false),
-        pipelineName(name)
+        pipelineName(name),
+        queueType(queueType)
     {
         setInputQueue(std::make_shared<SGQueue<InType>>());
         lastOutResourceQueue = std::shared_ptr<SGQueue<InType>>();
@@ -208,9 +293,11 @@ public:
         addNode(inner_func, outResource);
     }
 
+    // With numWorkers > 1, func runs on a thread pool and must return true,
+    // see parallelWorkThread
     template<typename NodeInType, typename NodeOutType, typename Container= std::vector<NodeOutType>>
     void addNode(std::function<bool(const NodeInType&, NodeOutType&, std::shared_ptr<ContextType>)> func,
-                 Container outResource = {}) {
+                 Container outResource = {}, size_t numWorkers = 1) {
         auto inWorkQueue = std::dynamic_pointer_cast<SGQueue<NodeInType>>(lastOutWorkQueue);
         if(!inWorkQueue) {
             SGLOG(FATAL, "input type of the added node is wrong: %s is needed, but got %s", lastTypeName.c_str(),typeid(NodeInType).name());
@@ -218,9 +305,11 @@ public:
         auto inResourceQueue = std::dynamic_pointer_cast<SGQueue<NodeInType>>(lastOutResourceQueue);
 
         lastTypeName = typeid(NodeOutType).name();
-        lastOutWorkQueue = std::shared_ptr<SGQueue<NodeOutType>>(new SGQueue<NodeOutType>());
+        // links inside a pipeline have one producer and one consumer thread
+        size_t capacity = std::max<size_t>(outResource.size(), 16);
+        lastOutWorkQueue = makeQueue<NodeOutType>(queueType, capacity);
         if(!outResource.empty()){
-            lastOutResourceQueue = std::shared_ptr<SGQueue<NodeOutType>>(new SGQueue<NodeOutType>());
+            lastOutResourceQueue = makeQueue<NodeOutType>(queueType, outResource.size());
         } else {
             lastOutResourceQueue =  std::shared_ptr<SGQueueVoid>();
         }
@@ -234,7 +323,7 @@ public:
                     new SGPipelineNodeImp<NodeInType, NodeOutType, ContextType>(func,
                                                                                 inResourceQueue, inWorkQueue,
                                                                                 outResourceQueue, outWorkQueue,
-                                                                                done, context, nodeName)
+                                                                                done, context, nodeName, numWorkers)
                     );
     }
 
@@ -272,6 +361,11 @@ public:
         return outQueue->waitAndPop(value);
     }
 
+    template<typename Duration>
+    bool waitAndPopFor(OutType &value, const Duration& timeout) {
+        return outQueue->waitAndPopFor(value, timeout);
+    }
+
     bool isStopped(){
         return done;
     }
@@ -302,13 +396,17 @@ private:
    std::vector<std::unique_ptr<SGPipeline<InType, OutType, ContextType>>> pipelines;
    std::shared_ptr<SGQueue<InType>> inQueue;
    std::shared_ptr<SGQueue<OutType>> outQueue;
+   // one input queue per pipeline when tasks are dispatched with pushTo()
+   std::vector<std::shared_ptr<SGQueue<InType>>> pipelineInQueues;
    std::function<void(std::shared_ptr<ContextType>)> contextDeinitializer;
 
 public:
     SGPipelinePool(size_t num_pipeline = 1,
                    std::function<std::shared_ptr<ContextType>(size_t)> contextInitializer = nullptr,
                    std::function<void(std::shared_ptr<ContextType>)> contextDeinitializer = nullptr,
-                   std::function<std::string(size_t, ContextType &)> nameFunc = nullptr
+                   std::function<std::string(size_t, ContextType &)> nameFunc = nullptr,
+                   SGQueueType queueType = SG_QUEUE_LOCKED,
+                   bool dispatchInputs = false
                    ) {
         inQueue = std::make_shared<SGQueue<InType>>();
         outQueue = std::make_shared<SGQueue<OutType>>();
@@ -321,10 +419,15 @@ public:
             if(nameFunc){
                 pipelineName = nameFunc(i, *context);
             }
-            pipelines.emplace_back(new SGPipeline<InType, OutType, ContextType>(context, pipelineName));
+            pipelines.emplace_back(new SGPipeline<InType, OutType, ContextType>(context, pipelineName, queueType));
         }
         for(auto& pipeline: pipelines){
-            pipeline->setInputQueue(inQueue);
+            if(dispatchInputs){
+                pipelineInQueues.push_back(std::make_shared<SGQueue<InType>>());
+                pipeline->setInputQueue(pipelineInQueues.back());
+            } else {
+                pipeline->setInputQueue(inQueue);
+            }
         }
         this->contextDeinitializer = contextDeinitializer;
     }
@@ -342,36 +445,55 @@ public:
         return inQueue;
     }
 
+    void setInputCapacity(size_t capacity){
+        inQueue->setMaxNode(capacity);
+        for(auto& queue: pipelineInQueues){
+            queue->setMaxNode(std::max<size_t>(capacity/pipelineInQueues.size(), 1));
+        }
+    }
+
+    size_t pipelineNum() const {
+        return pipelines.size();
+    }
+
+    bool isAvailable(size_t index) {
+        return index<pipelines.size() && pipelines[index] && !pipelines[index]->isStopped();
+    }
+
     template<typename NodeInType, typename NodeOutType, typename Container = std::vector<NodeOutType>>
     void addNode(std::function<NodeOutType(const NodeInType&)> func,
-                 std::function<Container(std::shared_ptr<ContextType>)> outResourceInitializer = nullptr) {
+                 std::function<Container(std::shared_ptr<ContextType>)> outResourceInitializer = nullptr,
+                 size_t numWorkers = 1) {
         std::function<bool(const NodeInType&, NodeOutType&, std::shared_ptr<ContextType>)> inner_func = [func](
                 const NodeInType& in, NodeOutType& out, std::shared_ptr<ContextType>){
             out =  std::move(func(in));
             return true;
         };
-        addNode(inner_func, outResourceInitializer);
+        addNode(inner_func, outResourceInitializer, numWorkers);
     }
 
     template<typename NodeInType, typename NodeOutType, typename Container = std::vector<NodeOutType>>
     void addNode(std::function<NodeOutType(const NodeInType&, std::shared_ptr<ContextType>)> func,
-                 std::function<Container(std::shared_ptr<ContextType>)> outResourceInitializer = nullptr) {
+                 std::function<Container(std::shared_ptr<ContextType>)> outResourceInitializer = nullptr,
+                 size_t numWorkers = 1) {
         std::function<NodeOutType(const NodeInType&, std::shared_ptr<ContextType>)> inner_func = [func](
                 const NodeInType& in, NodeOutType& out, std::shared_ptr<ContextType> ctx){ out =  std::move(func(in, ctx)); };
-        addNode(inner_func, outResourceInitializer);
+        addNode(inner_func, outResourceInitializer, numWorkers);
     }
 
     template<typename NodeInType, typename NodeOutType, typename Container=std::vector<NodeOutType>>
     void addNode(std::function<bool(const NodeInType&, NodeOutType&)> func,
-                 std::function<Container(std::shared_ptr<ContextType>)> outResourceInitializer = nullptr) {
+                 std::function<Container(std::shared_ptr<ContextType>)> outResourceInitializer = nullptr,
+                 size_t numWorkers = 1) {
         std::function<bool(const NodeInType&, NodeOutType&, std::shared_ptr<ContextType>)> inner_func = [func](
                 const NodeInType& in, NodeOutType& out, std::shared_ptr<ContextType>){ return func(in, out); };
-        addNode(inner_func, outResourceInitializer);
+        addNode(inner_func, outResourceInitializer, numWorkers);
     }
 
     template<typename NodeInType, typename NodeOutType, typename Container=std::vector<NodeOutType>>
     void addNode(std::function<bool(const NodeInType&, NodeOutType&, std::shared_ptr<ContextType>)> func,
-                 std::function<Container(std::shared_ptr<ContextType>)> outResourceInitializer = nullptr
+                 std::function<Container(std::shared_ptr<ContextType>)> outResourceInitializer = nullptr,
+                 size_t numWorkers = 1
                  ) {
        for(size_t i=0; i<pipelines.size(); i++){
            auto& pipeline = pipelines[i];
@@ -381,7 +503,7 @@ public:
                if(outResourceInitializer){
                    outResources = std::move(outResourceInitializer(pipeline->getContext()));
                }
-               pipeline->addNode(func, outResources);
+               pipeline->addNode(func, outResources, numWorkers);
            } catch (...) {
                SGLOG(WARNING, "pipeline #%d is not created!", i);
                contextDeinitializer(pipeline->getContext());
@@ -422,6 +544,9 @@ public:
     }
 
     bool canPush(){
+        for(auto& queue: pipelineInQueues){
+            if(queue->canPush()) return true;
+        }
         return inQueue->canPush();
     }
 
@@ -433,6 +558,14 @@ public:
         return false;
     }
 
+    bool pushTo(size_t index, InType in) {
+        if(index>=pipelineInQueues.size() || !isAvailable(index)){
+            return false;
+        }
+        pipelineInQueues[index]->push(in);
+        return true;
+    }
+
     bool pop(OutType& out) {
         return outQueue->tryPop(out);
     }
@@ -441,8 +574,16 @@ public:
         return outQueue->waitAndPop(out);
     }
 
+    template<typename Duration>
+    bool waitAndPopFor(OutType& out, const Duration& timeout) {
+        return outQueue->waitAndPopFor(out, timeout);
+    }
+
     void join() {
         inQueue->join();
+        for(auto& queue: pipelineInQueues){
+            queue->join();
+        }
         for(auto& pipeline: pipelines) {
             pipeline->join();
         }
@@ -4,6 +4,9 @@
 #include <thread>
 #include <mutex>
 #include <deque>
+#include <vector>
+#include <chrono>
+#include <functional>
 #include <atomic>
 #include <condition_variable>
 #include "SGCommonUtils.h"
@@ -51,6 +54,14 @@ private:
         return popHead();
     }
 
+    template<typename Duration>
+    std::unique_ptr<Node> waitPopHeadFor(const Duration& timeout){
+        std::unique_lock<std::mutex> ulock(mut);
+        data_cond.wait_for(ulock, timeout, [&]{ return head.get() != tail || joined; });
+        if (head.get() == tail) return nullptr;
+        return popHead();
+    }
+
     std::unique_ptr<Node> tryPopHead(){
         std::lock_guard<std::mutex> ulock(mut);
         if (head.get() == tail){
@@ -62,12 +73,12 @@ private:
 public:
     SGQueue(size_t max_nodes=0): head(new Node), tail(head.get()), max_nodes(max_nodes), num_nodes(0) {}
 
-    std::shared_ptr<T> tryPop() {
+    virtual std::shared_ptr<T> tryPop() {
         auto oldHead = tryPopHead();
         return oldHead? oldHead->data: std::shared_ptr<T>();
     }
 
-    bool tryPop(T& value){
+    virtual bool tryPop(T& value){
         auto oldHead = tryPopHead();
         if(oldHead){
             value = std::move(*oldHead->data);
@@ -76,35 +87,42 @@ public:
         return false;
     }
 
-    std::shared_ptr<T> waitAndPop() {
+    virtual std::shared_ptr<T> waitAndPop() {
         const auto oldHead = waitPopHead();
-        if (!oldHead) return oldHead;
+        if (!oldHead) return std::shared_ptr<T>();
         return oldHead->data;
     }
 
-    bool waitAndPop(T& value) {
+    virtual bool waitAndPop(T& value) {
         const auto oldHead = waitPopHead();
         if (!oldHead) return false;
         value = std::move(*oldHead->data);
         return true;
     }
 
-    void join() {
+    virtual bool waitAndPopFor(T& value, std::chrono::microseconds timeout) {
+        const auto oldHead = waitPopHeadFor(timeout);
+        if (!oldHead) return false;
+        value = std::move(*oldHead->data);
+        return true;
+    }
+
+    virtual void join() {
         std::lock_guard<std::mutex> ulock(mut);
         joined = true;
         slot_cond.notify_all();
         data_cond.notify_all();
     }
 
-    bool canPush() {
+    virtual bool canPush() {
         return  max_nodes==0 || num_nodes<max_nodes;
     }
 
-    void setMaxNode(size_t max){
+    virtual void setMaxNode(size_t max){
         max_nodes = max;
     }
 
-    void push(T new_value) {
+    virtual void push(T new_value) {
         std::shared_ptr<T> new_data(
                     std::make_shared<T>(std::move(new_value)));
         std::unique_ptr<Node> new_node(new Node);
@@ -122,12 +140,166 @@ public:
         }
     }
 
-    bool empty() {
+    virtual bool empty() {
         std::lock_guard<std::mutex> ulock(mut);
         return head.get() == tail;
     }
 };
 
+enum SGQueueType {
+    SG_QUEUE_LOCKED = 0,
+    SG_QUEUE_RING = 1,
+};
+
+/*
+ * Bounded ring buffer for links with a single producer thread and a single
+ * consumer thread. Push and pop are lock free while the ring is neither full
+ * nor empty; a blocked side sleeps on a condition variable and is woken by
+ * the other side only when it announced that it is waiting.
+ * setMaxNode() limits the number of queued items up to the ring capacity,
+ * 0 means the full capacity.
+ */
+template <typename T>
+class SGRingQueue: public SGQueue<T>
+{
+private:
+    static const size_t spinCount = 64;
+    std::vector<T> slots;
+    size_t mask;
+    size_t max_nodes;
+    alignas(64) std::atomic<size_t> head;
+    alignas(64) std::atomic<size_t> tail;
+    alignas(64) std::atomic<bool> joined;
+    std::atomic<bool> consumer_waiting;
+    std::atomic<bool> producer_waiting;
+    std::mutex mut;
+    std::condition_variable data_cond, slot_cond;
+
+    static size_t roundCapacity(size_t capacity) {
+        size_t size = 1;
+        while(size < capacity) size <<= 1;
+        return size;
+    }
+
+    bool hasData() const {
+        return head.load(std::memory_order_relaxed) != tail.load(std::memory_order_acquire);
+    }
+
+    bool hasSlot() const {
+        return tail.load(std::memory_order_relaxed) - head.load(std::memory_order_acquire) < max_nodes;
+    }
+
+    void wake(std::atomic<bool>& waiting, std::condition_variable& cond) {
+        if(waiting.load(std::memory_order_seq_cst)){
+            std::lock_guard<std::mutex> ulock(mut);
+            cond.notify_all();
+        }
+    }
+
+    bool popValue(T& value) {
+        auto h = head.load(std::memory_order_relaxed);
+        if(h == tail.load(std::memory_order_acquire)) return false;
+        value = std::move(slots[h & mask]);
+        head.store(h + 1, std::memory_order_seq_cst);
+        wake(producer_waiting, slot_cond);
+        return true;
+    }
+
+    template<typename Wait>
+    bool waitPop(T& value, Wait wait) {
+        for(size_t i=0; i<spinCount; i++){
+            if(popValue(value)) return true;
+            if(joined) break;
+            std::this_thread::yield();
+        }
+        std::unique_lock<std::mutex> ulock(mut);
+        consumer_waiting.store(true, std::memory_order_seq_cst);
+        wait(ulock, [&]{ return hasData() || joined; });
+        consumer_waiting.store(false, std::memory_order_relaxed);
+        ulock.unlock();
+        return popValue(value);
+    }
+
+public:
+    SGRingQueue(size_t capacity): slots(roundCapacity(capacity)), mask(slots.size() - 1),
+        max_nodes(slots.size()), head(0), tail(0), joined(false),
+        consumer_waiting(false), producer_waiting(false) {}
+
+    std::shared_ptr<T> tryPop() override {
+        T value;
+        if(!popValue(value)) return std::shared_ptr<T>();
+        return std::make_shared<T>(std::move(value));
+    }
+
+    bool tryPop(T& value) override {
+        return popValue(value);
+    }
+
+    std::shared_ptr<T> waitAndPop() override {
+        T value;
+        if(!waitAndPop(value)) return std::shared_ptr<T>();
+        return std::make_shared<T>(std::move(value));
+    }
+
+    bool waitAndPop(T& value) override {
+        return waitPop(value, [this](std::unique_lock<std::mutex>& ulock, std::function<bool()> pred){
+            data_cond.wait(ulock, pred);
+        });
+    }
+
+    bool waitAndPopFor(T& value, std::chrono::microseconds timeout) override {
+        return waitPop(value, [this, timeout](std::unique_lock<std::mutex>& ulock, std::function<bool()> pred){
+            data_cond.wait_for(ulock, timeout, pred);
+        });
+    }
+
+    void join() override {
+        std::lock_guard<std::mutex> ulock(mut);
+        joined = true;
+        slot_cond.notify_all();
+        data_cond.notify_all();
+    }
+
+    bool canPush() override {
+        return hasSlot();
+    }
+
+    void setMaxNode(size_t max) override {
+        max_nodes = (max == 0 || max > slots.size())? slots.size(): max;
+    }
+
+    void push(T new_value) override {
+        size_t i = 0;
+        while(!hasSlot() && !joined){
+            if(i++ < spinCount){
+                std::this_thread::yield();
+                continue;
+            }
+            std::unique_lock<std::mutex> ulock(mut);
+            producer_waiting.store(true, std::memory_order_seq_cst);
+            slot_cond.wait(ulock, [&]{ return hasSlot() || joined; });
+            producer_waiting.store(false, std::memory_order_relaxed);
+        }
+        if(!hasSlot()) return;
+        auto t = tail.load(std::memory_order_relaxed);
+        slots[t & mask] = std::move(new_value);
+        tail.store(t + 1, std::memory_order_seq_cst);
+        wake(consumer_waiting, data_cond);
+    }
+
+    bool empty() override {
+        return !hasData();
+    }
+};
+
+template <typename T>
+std::shared_ptr<SGQueue<T>> makeQueue(SGQueueType type, size_t capacity) {
+    if(type == SG_QUEUE_RING) {
+        return std::make_shared<SGRingQueue<T>>(capacity);
+    }
+    return std::make_shared<SGQueue<T>>();
+}
+
 template<typename T>
 class SGWorkStealingQueue: public Uncopiable
 {
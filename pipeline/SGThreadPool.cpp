@@ -39,11 +39,10 @@ void SGThreadPool::workThread(size_t index) {
 void SGThreadPool::runPendingTask()
 {
         SGTask task;
-        if(globalQueue.tryPop(task)) {
+        // wait instead of yielding, idle workers should not spin
+        if(globalQueue.waitAndPopFor(task, std::chrono::milliseconds(1))) {
             SGLOG(DEBUG, "[%d] get a task", std::this_thread::get_id());
             task();
-        } else {
-            std::this_thread::yield();
         }
 }
 
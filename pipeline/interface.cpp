@@ -1,5 +1,6 @@
 #include <map>
 #include <memory>
+#include <mutex>
 #include <string.h>
 #include "bmruntime_interface.h"
 #include "SGDevicePool.h"
@@ -29,11 +30,16 @@ static size_t elem_num(const unsigned int* shape, unsigned int dims){
     return elem;
 }
 
+using RecycleQueue = SGQueue<unsigned int>;
+
 struct InputType {
     bool release_inside = false;
     unsigned int id = 0;
     unsigned num = 0;
     tensor_data_t* tensors = nullptr;
+    // caller owned input buffers are handed back through this queue
+    // once they have been copied to device memory
+    std::shared_ptr<RecycleQueue> recycled;
 };
 
 struct OutputType {
@@ -42,14 +48,20 @@ struct OutputType {
     tensor_data_t* tensors = nullptr;
 };
 
-bool preProcess(const InputType& input, const TensorVec& inTensors, ContextPtr ctx);
-bool postProcess(const InputType& input, const TensorVec& outTensors, OutputType& postOut, ContextPtr ctx);
+bool preProcess(const InputType& input, const TensorVec& inTensors, void*& extra, ContextPtr ctx);
+bool postProcess(const InputType& input, const TensorVec& outTensors, OutputType& postOut, void* extra, ContextPtr ctx);
 
-std::vector<DeviceId> globalDevices;
 using GeneralRunner = SGDevicePool<InputType, OutputType>;
 struct RunnerInfo {
-    RunnerInfo(const char* bmodel, unsigned int batch = 1):
-        task_id(INVALID_TASK_ID), runner(bmodel, preProcess, postProcess, globalDevices), status(bmodel), batch(batch) {
+    RunnerInfo(const char* bmodel, unsigned int batch, const runner_options_t& options):
+        task_id(INVALID_TASK_ID),
+        runner(bmodel, preProcess, postProcess,
+               std::vector<DeviceId>(options.device_ids, options.device_ids + options.device_num),
+               options.share_runtime, static_cast<SGQueueType>(options.queue_type),
+               options.buffer_depth, options.queue_capacity,
+               static_cast<SGSchedulePolicy>(options.schedule_policy),
+               options.pre_workers, options.post_workers),
+        status(bmodel), batch(batch), next_pool_id(0) {
         runner.start();
         status.start();
     }
@@ -58,17 +70,44 @@ struct RunnerInfo {
         if(task_id == INVALID_TASK_ID) task_id++;
         return task_id;
     }
+    std::shared_ptr<RecycleQueue> inputPool(unsigned int pool_id) {
+        std::lock_guard<std::mutex> guard(pool_mutex);
+        auto iter = input_pools.find(pool_id);
+        if(iter == input_pools.end()) return nullptr;
+        return iter->second;
+    }
 
     unsigned int task_id;
 
     GeneralRunner runner;
     ProcessStatInfo status;
     unsigned int batch;
+
+    // recycle queue of each input pool, so that pools never see the task
+    // ids of one another and puts without a pool are not recorded
+    std::mutex pool_mutex;
+    unsigned int next_pool_id;
+    std::map<unsigned int, std::shared_ptr<RecycleQueue>> input_pools;
 };
 
-std::map<unsigned int, std::shared_ptr<RunnerInfo>> globalRunnerInfos;
+using RunnerInfoPtr = std::shared_ptr<RunnerInfo>;
+
+// runners are used from many threads while others start and stop, every
+// access to the map goes through globalMutex. Calls work on a copy of the
+// pointer, so a runner stopped meanwhile lives until they return
+static std::mutex globalMutex;
+static std::map<unsigned int, RunnerInfoPtr> globalRunnerInfos;
+// devices of runner_start_with_batch, set by runner_use_devices
+static std::vector<unsigned> globalDevices;
+
+static RunnerInfoPtr getRunnerInfo(unsigned int runner_id) {
+    std::lock_guard<std::mutex> guard(globalMutex);
+    auto iter = globalRunnerInfos.find(runner_id);
+    if(iter == globalRunnerInfos.end()) return nullptr;
+    return iter->second;
+}
 
-bool preProcess(const InputType& input, const TensorVec& inTensors, ContextPtr ctx){
+bool preProcess(const InputType& input, const TensorVec& inTensors, void*& extra, ContextPtr ctx){
     if(input.num == 0){
         return false;
     }
@@ -83,10 +122,13 @@ bool preProcess(const InputType& input, const TensorVec& inTensors, ContextPtr c
         }
         inTensors[i]->set_shape(input.tensors[i].shape, input.tensors[i].dims);
     }
+    if(input.recycled){
+        input.recycled->push(input.id);
+    }
     return true;
 }
 
-bool postProcess(const InputType& input, const TensorVec& outTensors, OutputType& postOut, ContextPtr ctx){
+bool postProcess(const InputType& input, const TensorVec& outTensors, OutputType& postOut, void* extra, ContextPtr ctx){
     postOut.id = input.id;
     if(input.release_inside){
         for(size_t i=0; i<input.num; i++){
@@ -112,36 +154,79 @@ bool postProcess(const InputType& input, const TensorVec& outTensors, OutputType
     return true;
 }
 
-unsigned int runner_start_with_batch(const char *bmodel, unsigned int batch) {
+void runner_default_options(runner_options_t *options) {
+    options->device_ids = nullptr;
+    options->device_num = 0;
+    options->share_runtime = 0;
+    options->queue_type = SG_QUEUE_LOCKED;
+    options->buffer_depth = 2;
+    options->queue_capacity = 0;
+    options->schedule_policy = SG_SCHEDULE_SHARED;
+    options->pre_workers = 1;
+    options->post_workers = 1;
+}
+
+unsigned int runner_start_with_options(const char *bmodel, unsigned int batch, const runner_options_t *options) {
     set_env_log_level();
     unsigned int runner_id = 0;
-    while(globalRunnerInfos.count(runner_id)) runner_id++;
-    globalRunnerInfos[runner_id] = std::make_shared<RunnerInfo>(bmodel, batch);
+    {
+        // reserve the id, loading the bmodel must not block other runners
+        std::lock_guard<std::mutex> guard(globalMutex);
+        while(globalRunnerInfos.count(runner_id)) runner_id++;
+        globalRunnerInfos[runner_id] = nullptr;
+    }
+    auto info = std::make_shared<RunnerInfo>(bmodel, batch, *options);
+    std::lock_guard<std::mutex> guard(globalMutex);
+    globalRunnerInfos[runner_id] = info;
     return runner_id;
 }
 
+unsigned int runner_start_with_batch(const char *bmodel, unsigned int batch) {
+    runner_options_t options;
+    runner_default_options(&options);
+    std::vector<unsigned> devices;
+    {
+        std::lock_guard<std::mutex> guard(globalMutex);
+        devices = globalDevices;
+    }
+    options.device_ids = devices.data();
+    options.device_num = devices.size();
+    return runner_start_with_options(bmodel, batch, &options);
+}
+
 unsigned int runner_start(const char *bmodel) {
     runner_start_with_batch(bmodel, 1);
     return 0;
 }
 
 void runner_stop(unsigned int runner_id) {
-    if(!globalRunnerInfos.count(runner_id)) return;
-    globalRunnerInfos[runner_id]->runner.join();
-    globalRunnerInfos.erase(runner_id);
+    RunnerInfoPtr info;
+    {
+        std::lock_guard<std::mutex> guard(globalMutex);
+        auto iter = globalRunnerInfos.find(runner_id);
+        if(iter == globalRunnerInfos.end() || !iter->second) return;
+        info = iter->second;
+        globalRunnerInfos.erase(iter);
+    }
+    info->runner.join();
 }
 
 void runner_show_status(unsigned int runner_id)
 {
-    if(!globalRunnerInfos.count(runner_id)) return;
-    globalRunnerInfos[runner_id]->status.show();
+    auto info = getRunnerInfo(runner_id);
+    if(!info) return;
+    info->status.show();
+    SGLOG(INFO, "Pipeline: buffer_depth=%zu (pre-process %zu, forward %zu), queue_capacity=%zu, "
+          "pre_workers=%zu, post_workers=%zu",
+          info->runner.getBufferDepth(), info->runner.getPreDepth(), info->runner.getForwardDepth(),
+          info->runner.getQueueCapacity(), info->runner.getPreWorkers(), info->runner.getPostWorkers());
 }
 
-unsigned int runner_put_input(unsigned runner_id, unsigned int input_num, const tensor_data_t *input_tensors, int need_copy)
+static unsigned int put_input(const RunnerInfoPtr& info, unsigned int input_num, const tensor_data_t *input_tensors,
+                              int need_copy, std::shared_ptr<RecycleQueue> recycled)
 {
-    if(!globalRunnerInfos.count(runner_id)) return -1;
     InputType input;
-    input.id = globalRunnerInfos[runner_id]->nextId();
+    input.id = info->nextId();
     input.release_inside = need_copy;
     input.num = input_num;
     if(input_num != 0){
@@ -155,30 +240,72 @@ unsigned int runner_put_input(unsigned runner_id, unsigned int input_num, const
             }
         } else {
             input.tensors = (tensor_data_t*)input_tensors;
+            input.recycled = recycled;
         }
     } else {
         input.tensors = nullptr;
     }
-    globalRunnerInfos[runner_id]->runner.push(input);
+    info->runner.push(input);
     return input.id;
 }
 
+unsigned int runner_put_input(unsigned runner_id, unsigned int input_num, const tensor_data_t *input_tensors, int need_copy)
+{
+    auto info = getRunnerInfo(runner_id);
+    if(!info) return -1;
+    return put_input(info, input_num, input_tensors, need_copy, nullptr);
+}
+
+unsigned int runner_create_input_pool(unsigned runner_id)
+{
+    auto info = getRunnerInfo(runner_id);
+    if(!info) return 0;
+    std::lock_guard<std::mutex> guard(info->pool_mutex);
+    info->next_pool_id++;
+    info->input_pools[info->next_pool_id] = std::make_shared<RecycleQueue>();
+    return info->next_pool_id;
+}
+
+void runner_release_input_pool(unsigned runner_id, unsigned int pool_id)
+{
+    auto info = getRunnerInfo(runner_id);
+    if(!info) return;
+    std::lock_guard<std::mutex> guard(info->pool_mutex);
+    info->input_pools.erase(pool_id);
+}
+
+unsigned int runner_put_pooled_input(unsigned runner_id, unsigned int pool_id, unsigned int input_num,
+                                     const tensor_data_t *input_tensors)
+{
+    auto info = getRunnerInfo(runner_id);
+    if(!info) return -1;
+    auto recycled = info->inputPool(pool_id);
+    if(!recycled){
+        SGLOG(ERROR, "invalid input pool %d of runner %d", pool_id, runner_id);
+        return INVALID_TASK_ID;
+    }
+    return put_input(info, input_num, input_tensors, 0, recycled);
+}
+
 
 int runner_all_stopped(size_t runner_id){
-    if(!globalRunnerInfos.count(runner_id)) return true;
-    return globalRunnerInfos[runner_id]->runner.allStopped();
+    auto info = getRunnerInfo(runner_id);
+    if(!info) return true;
+    return info->runner.allStopped();
 }
 
-static tensor_data_t *__runner_get_output(unsigned runner_id, unsigned int *task_id, unsigned int *output_num, unsigned int *is_valid, bool is_async){
-    if(!globalRunnerInfos.count(runner_id)) return nullptr;
-    auto& info = globalRunnerInfos[runner_id];
+static tensor_data_t *__runner_get_output(unsigned runner_id, unsigned int *task_id, unsigned int *output_num, unsigned int *is_valid, int timeout_ms){
+    auto info = getRunnerInfo(runner_id);
+    if(!info) return nullptr;
     OutputType output;
     std::shared_ptr<ProcessStatus> status;
     bool ok;
-    if (is_async)
+    if (timeout_ms == 0)
         ok = info->runner.pop(output, status);
-    else
+    else if (timeout_ms < 0)
         ok = info->runner.waitAndPop(output, status);
+    else
+        ok = info->runner.waitAndPopFor(output, status, std::chrono::milliseconds(timeout_ms));
 
     if(!ok) return nullptr;
 
@@ -191,13 +318,18 @@ static tensor_data_t *__runner_get_output(unsigned runner_id, unsigned int *task
 
 tensor_data_t *runner_try_to_get_output(unsigned runner_id, unsigned int *task_id, unsigned int *output_num, unsigned int *is_valid)
 {
-    return __runner_get_output(runner_id, task_id, output_num, is_valid, true);
+    return __runner_get_output(runner_id, task_id, output_num, is_valid, 0);
+}
+
+tensor_data_t *runner_wait_output(unsigned runner_id, unsigned int *task_id, unsigned int *output_num, unsigned int *is_valid, int timeout_ms)
+{
+    return __runner_get_output(runner_id, task_id, output_num, is_valid, timeout_ms);
 }
 
 
 tensor_data_t *runner_get_output(unsigned runner_id, unsigned int *task_id, unsigned int *output_num, unsigned int *is_valid)
 {
-    return __runner_get_output(runner_id, task_id, output_num, is_valid, false);
+    return __runner_get_output(runner_id, task_id, output_num, is_valid, -1);
 }
 
 unsigned int runner_release_output(unsigned int output_num, const tensor_data_t *output_data){
@@ -208,24 +340,43 @@ unsigned int runner_release_output(unsigned int output_num, const tensor_data_t
     return 0;
 }
 
+unsigned int runner_get_recycled_inputs(unsigned runner_id, unsigned int pool_id, unsigned int *task_ids,
+                                        unsigned int max_num, int timeout_ms)
+{
+    auto info = getRunnerInfo(runner_id);
+    if(!info || max_num == 0) return 0;
+    auto recycled = info->inputPool(pool_id);
+    if(!recycled) return 0;
+    unsigned int num = 0;
+    if(timeout_ms < 0) {
+        if(recycled->waitAndPop(task_ids[num])) num++;
+    } else if(timeout_ms > 0) {
+        if(recycled->waitAndPopFor(task_ids[num], std::chrono::milliseconds(timeout_ms))) num++;
+    }
+    while(num<max_num && recycled->tryPop(task_ids[num])) num++;
+    return num;
+}
+
 int runner_empty(unsigned int runner_id)
 {
-    if(!globalRunnerInfos.count(runner_id)) return true;
-    return globalRunnerInfos[runner_id]->runner.empty();
+    auto info = getRunnerInfo(runner_id);
+    if(!info) return true;
+    return info->runner.empty();
 }
 
 void runner_join(unsigned int runner_id)
 {
-    if(!globalRunnerInfos.count(runner_id)) {
+    auto info = getRunnerInfo(runner_id);
+    if(!info) {
         SGLOG(ERROR, "invalid runner_id %d", runner_id);
         return;
     }
-    auto& info = globalRunnerInfos[runner_id];
     info->runner.join();
 }
 
 void runner_use_devices(const unsigned *device_ids, unsigned num)
 {
+    std::lock_guard<std::mutex> guard(globalMutex);
     globalDevices.assign(device_ids, device_ids+num);
 }
 
@@ -241,11 +392,11 @@ unsigned int available_devices(unsigned int *devices, unsigned int maxNum)
 
 blob_info_t *get_input_info(unsigned runner_id, unsigned *num)
 {
-    if(!globalRunnerInfos.count(runner_id)) {
+    auto info = getRunnerInfo(runner_id);
+    if(!info) {
         SGLOG(ERROR, "invalid runner_id %d", runner_id);
         return nullptr;
     }
-    auto& info = globalRunnerInfos[runner_id];
     const bm_net_info_t *net_info = info->runner.getNetInfo();
     *num = net_info->input_num;
     auto blobs = new blob_info_t[*num];
@@ -264,11 +415,11 @@ blob_info_t *get_input_info(unsigned runner_id, unsigned *num)
 
 blob_info_t *get_output_info(unsigned runner_id, unsigned *num)
 {
-    if(!globalRunnerInfos.count(runner_id)) {
+    auto info = getRunnerInfo(runner_id);
+    if(!info) {
         SGLOG(ERROR, "invalid runner_id %d", runner_id);
         return nullptr;
     }
-    auto& info = globalRunnerInfos[runner_id];
     const bm_net_info_t *net_info = info->runner.getNetInfo();
     *num = net_info->output_num;
     auto blobs = new blob_info_t[*num];
@@ -293,8 +444,9 @@ void release_input_info(unsigned runner_id, blob_info_t *info)
 uint32_t *get_runner_durations(unsigned runner_id, unsigned *num)
 {
     *num = 0;
-    if(!globalRunnerInfos.count(runner_id)) return nullptr;
-    return globalRunnerInfos[runner_id]->status.get_durations(num);
+    auto info = getRunnerInfo(runner_id);
+    if(!info) return nullptr;
+    return info->status.get_durations(num);
 }
 
 void release_unsigned_pointer(unsigned *data)
@@ -302,3 +454,45 @@ void release_unsigned_pointer(unsigned *data)
     delete[] data;
 }
 
+stage_stat_t *get_runner_stage_stats(unsigned runner_id, unsigned *num)
+{
+    *num = 0;
+    auto info = getRunnerInfo(runner_id);
+    if(!info) return nullptr;
+    auto& status = info->status;
+    std::lock_guard<std::mutex> guard(status.histogramMutex);
+    *num = status.stageHistograms.size();
+    auto stats = new stage_stat_t[*num];
+    size_t i = 0;
+    for(auto& p: status.stageHistograms){
+        auto& h = p.second;
+        auto& stat = stats[i++];
+        stat.device_id = p.first.first;
+        stat.stage = p.first.second;
+        stat.count = h.total;
+        stat.mean_us = h.mean();
+        stat.p50_us = h.percentile(50);
+        stat.p90_us = h.percentile(90);
+        stat.p99_us = h.percentile(99);
+        stat.max_us = h.maxValue;
+        stat.bucket_num = std::count_if(h.counts.begin(), h.counts.end(), [](uint64_t c){ return c>0; });
+        stat.buckets = new histogram_bucket_t[stat.bucket_num];
+        size_t b = 0;
+        for(size_t index=0; index<h.counts.size(); index++){
+            if(!h.counts[index]) continue;
+            stat.buckets[b].lower_us = LatencyHistogram::bucketLower(index);
+            stat.buckets[b].upper_us = LatencyHistogram::bucketUpper(index);
+            stat.buckets[b].count = h.counts[index];
+            b++;
+        }
+    }
+    return stats;
+}
+
+void release_stage_stats(unsigned num, stage_stat_t *stats)
+{
+    for(unsigned i=0; i<num; i++){
+        delete [] stats[i].buckets;
+    }
+    delete [] stats;
+}
@@ -27,6 +27,22 @@ struct tensor_data_t {
 unsigned int available_devices(unsigned int* devices, unsigned int maxNum);
 void runner_use_devices(const unsigned* device_ids, unsigned num);
 unsigned int runner_start_with_batch(const char *bmodel, unsigned int batch);
+
+// everything a runner is configured with. runner_start_with_batch starts
+// with the defaults on the devices of runner_use_devices
+struct runner_options_t {
+    const unsigned* device_ids;  // all available devices when device_num is 0
+    unsigned device_num;
+    int share_runtime;
+    int queue_type;
+    unsigned buffer_depth;
+    unsigned queue_capacity;     // 0 for unbounded
+    int schedule_policy;
+    unsigned pre_workers;
+    unsigned post_workers;
+};
+void runner_default_options(runner_options_t* options);
+unsigned int runner_start_with_options(const char *bmodel, unsigned int batch, const runner_options_t* options);
 unsigned int runner_start(const char* bmodel);
 void runner_stop(unsigned int runner_id);
 int runner_empty(unsigned int runner_id);
@@ -36,7 +52,18 @@ void runner_show_status(unsigned int runner_id);
 unsigned int runner_put_input(unsigned runner_id, unsigned int input_num, const tensor_data_t* input_tensors, int need_copy);
 tensor_data_t *runner_get_output(unsigned runner_id, unsigned int *task_id, unsigned int *output_num, unsigned int *is_valid);
 tensor_data_t *runner_try_to_get_output(unsigned runner_id, unsigned int *task_id, unsigned int *output_num, unsigned int *is_valid);
+tensor_data_t *runner_wait_output(unsigned runner_id, unsigned int *task_id, unsigned int *output_num, unsigned int *is_valid, int timeout_ms);
 unsigned int runner_release_output(unsigned int output_num, const tensor_data_t *output_data);
+// Input pools put caller owned buffers without copying. The task ids of
+// a pool's inputs come back through runner_get_recycled_inputs once
+// pre-process no longer needs them. It waits up to timeout_ms for the
+// first one, forever if timeout_ms is negative.
+unsigned int runner_create_input_pool(unsigned runner_id);
+void runner_release_input_pool(unsigned runner_id, unsigned int pool_id);
+unsigned int runner_put_pooled_input(unsigned runner_id, unsigned int pool_id, unsigned int input_num,
+                                     const tensor_data_t *input_tensors);
+unsigned int runner_get_recycled_inputs(unsigned runner_id, unsigned int pool_id, unsigned int *task_ids,
+                                        unsigned int max_num, int timeout_ms);
 
 struct blob_info_t {
     const char *name;
@@ -53,6 +80,28 @@ void runner_join(unsigned int runner_id);
 unsigned *get_runner_durations(unsigned runner_id, unsigned *num);
 void release_unsigned_pointer(unsigned *data);
 
+struct histogram_bucket_t {
+    unsigned long long lower_us;
+    unsigned long long upper_us;
+    unsigned long long count;
+};
+
+struct stage_stat_t {
+    unsigned device_id;
+    unsigned stage;
+    unsigned long long count;
+    double mean_us;
+    unsigned long long p50_us;
+    unsigned long long p90_us;
+    unsigned long long p99_us;
+    unsigned long long max_us;
+    unsigned bucket_num;
+    histogram_bucket_t *buckets;
+};
+
+stage_stat_t *get_runner_stage_stats(unsigned runner_id, unsigned *num);
+void release_stage_stats(unsigned num, stage_stat_t *stats);
+
 #ifdef __cplusplus
 }
 #endif
@@ -2,7 +2,10 @@ import os
 import ctypes as ct
 import numpy as np
 import time
+import queue
+import asyncio
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 
 SGTypeTuple = (
    (np.float32, 0),
@@ -33,9 +36,11 @@ class SGTensor(ct.Structure):
         ("dtype", ct.c_uint32),
         ("data", ct.c_void_p),
     ]
-    def to_numpy(self):
+    def to_numpy(self, owner=None):
         shape = self.shape[0:self.dims]
         dtype = nptype(self.dtype)
+        if owner is not None:
+            return np.asarray(_NativeBuffer(owner, self.data, shape, dtype))
         mem_size = np.prod(shape)*sglen(self.dtype)
         data_ptr = (ct.c_byte*mem_size)()
         ct.memmove(data_ptr, self.data, mem_size)
@@ -50,6 +55,28 @@ class SGTensor(ct.Structure):
         self.dtype = ct.c_uint32(sgtype(data.dtype))
         self.data = data.ctypes.data_as(ct.c_void_p)
 
+class _NativeOutputs:
+    """
+    Output tensors of one task as returned by libpipeline. They are released
+    when the last numpy array viewing them goes away.
+    """
+    def __init__(self, lib, num, tensors):
+        self.lib = lib
+        self.num = num
+        self.tensors = tensors
+
+    def __del__(self):
+        self.lib.runner_release_output(self.num, self.tensors)
+
+class _NativeBuffer:
+    def __init__(self, owner, data, shape, dtype):
+        self.owner = owner
+        self.__array_interface__ = dict(
+            version=3,
+            shape=tuple(shape),
+            typestr=np.dtype(dtype).str,
+            data=(data or 0, False))
+
 class BlobInfo(ct.Structure):
     _fields_ = [
         ("name", ct.c_char_p),
@@ -58,23 +85,79 @@ class BlobInfo(ct.Structure):
         ("dims", ct.c_int * 8),
         ("scale", ct.c_float)]
 
+class HistogramBucket(ct.Structure):
+    _fields_ = [
+        ("lower_us", ct.c_ulonglong),
+        ("upper_us", ct.c_ulonglong),
+        ("count", ct.c_ulonglong)]
+
+class StageStat(ct.Structure):
+    _fields_ = [
+        ("device_id", ct.c_uint),
+        ("stage", ct.c_uint),
+        ("count", ct.c_ulonglong),
+        ("mean_us", ct.c_double),
+        ("p50_us", ct.c_ulonglong),
+        ("p90_us", ct.c_ulonglong),
+        ("p99_us", ct.c_ulonglong),
+        ("max_us", ct.c_ulonglong),
+        ("bucket_num", ct.c_uint),
+        ("buckets", ct.POINTER(HistogramBucket))]
+
+STAGE_NAMES = ('pre-process', 'forward', 'post-process')
+
+class RunnerOptions(ct.Structure):
+    _fields_ = [
+        ("device_ids", ct.POINTER(ct.c_uint)),
+        ("device_num", ct.c_uint),
+        ("share_runtime", ct.c_int),
+        ("queue_type", ct.c_int),
+        ("buffer_depth", ct.c_uint),
+        ("queue_capacity", ct.c_uint),
+        ("schedule_policy", ct.c_int),
+        ("pre_workers", ct.c_uint),
+        ("post_workers", ct.c_uint)]
+
 class SGInfer:
     __lib = None
 
-    def __init__(self, bmodel_path, batch=1, devices=None):
+    QUEUE_TYPES = dict(locked=0, ring=1)
+    SCHEDULE_POLICIES = dict(
+        shared=0, round_robin=1, least_outstanding=2, latency_weighted=3)
+
+    def __init__(self, bmodel_path, batch=1, devices=None, zero_copy=False, shared_runtime=False,
+                 queue_type='locked', buffer_depth=2, queue_capacity=None, schedule='shared',
+                 pre_workers=1, post_workers=1):
+        # libpipeline asserts on these, which aborts the interpreter
+        if buffer_depth < 1:
+            raise ValueError('buffer_depth must be at least 1, got {}'.format(buffer_depth))
+        if queue_capacity is not None and queue_capacity < 0:
+            raise ValueError('queue_capacity must not be negative, got {}'.format(queue_capacity))
+        if pre_workers < 1 or post_workers < 1:
+            raise ValueError('pre_workers and post_workers must be at least 1, got {} and {}'.format(
+                pre_workers, post_workers))
         self.bmodel_path = bmodel_path
+        self.zero_copy = zero_copy
         if self.__class__.__lib is None:
             lib_path = os.path.join(os.path.dirname(__file__), "libpipeline.so")
             self.__class__.__lib = ct.cdll.LoadLibrary(lib_path)
         self.__lib = self.__class__.__lib
+        options = RunnerOptions()
+        self.__lib.runner_default_options(ct.byref(options))
         if devices is not None:
-            device_ids = (ct.c_int*len(devices))(*devices)
-            device_num = ct.c_int(len(devices))
-            self.__lib.runner_use_devices(device_ids, device_num)
-        self.runner_id = self.__lib.runner_start_with_batch(ct.c_char_p(bytes(bmodel_path, encoding='utf-8')), batch)
-        if devices is not None:
-            device_num = ct.c_int(0)
-            self.__lib.runner_use_devices(device_ids, device_num)
+            device_ids = (ct.c_uint*len(devices))(*devices)
+            options.device_ids = device_ids
+            options.device_num = len(devices)
+        options.share_runtime = int(shared_runtime)
+        options.queue_type = self.QUEUE_TYPES[queue_type]
+        options.buffer_depth = buffer_depth
+        options.queue_capacity = queue_capacity or 0
+        options.schedule_policy = self.SCHEDULE_POLICIES[schedule]
+        options.pre_workers = pre_workers
+        options.post_workers = post_workers
+        self.runner_id = self.__lib.runner_start_with_options(
+            ct.c_char_p(bytes(bmodel_path, encoding='utf-8')), batch, ct.byref(options))
+        self.running = True
 
     @classmethod
     def available_devices(cls):
@@ -112,20 +195,43 @@ class SGInfer:
         self.__lib.release_input_info(self.runner_id, infos)
         return result
 
+    def stop(self):
+        """
+        Stops the runner and frees its devices, runtime and buffers.
+        """
+        # runner ids are reused, never stop one twice
+        if getattr(self, 'running', False):
+            self.running = False
+            self.__lib.runner_stop(self.runner_id)
+
     def __del__(self):
-        self.__lib.runner_stop(self.runner_id)
+        self.stop()
 
     def put(self, *inputs):
         if not inputs:
             self.__lib.runner_join(self.runner_id)
             return
-        input_num = ct.c_int(len(inputs))
         sg_inputs = (SGTensor*len(inputs))()
         inputs = [i if i.data.c_contiguous else np.ascontiguousarray(i) for i in inputs]
         for i in range(len(inputs)):
             sg_inputs[i].from_numpy(inputs[i])
-        task_id = self.__lib.runner_put_input(self.runner_id, input_num, sg_inputs, 1)
-        return task_id
+        input_num = ct.c_int(len(inputs))
+        return self.__lib.runner_put_input(self.runner_id, input_num, sg_inputs, 1)
+
+    def _create_input_pool(self):
+        return self.__lib.runner_create_input_pool(self.runner_id)
+
+    def _release_input_pool(self, pool_id):
+        self.__lib.runner_release_input_pool(self.runner_id, ct.c_uint32(pool_id))
+
+    def _put_pooled(self, pool_id, sg_inputs):
+        return self.__lib.runner_put_pooled_input(
+            self.runner_id, ct.c_uint32(pool_id), ct.c_uint32(len(sg_inputs)), sg_inputs)
+
+    def _get_recycled(self, pool_id, task_ids, timeout):
+        return self.__lib.runner_get_recycled_inputs(
+            self.runner_id, ct.c_uint32(pool_id), task_ids, ct.c_uint32(len(task_ids)),
+            ct.c_int(int(timeout * 1000)))
         
     def get(self):
         return self.__get(self.__lib.runner_get_output)
@@ -133,17 +239,24 @@ class SGInfer:
     def try_get(self):
         return self.__get(self.__lib.runner_try_to_get_output)
 
+    def wait_get(self, timeout=None):
+        """
+        Like get() but gives up after timeout seconds, returning task id 0.
+        """
+        timeout_ms = -1 if timeout is None else int(timeout * 1000)
+        return self.__get(self.__lib.runner_wait_output, ct.c_int(timeout_ms))
+
     def stopped(self):
         return self.__lib.runner_all_stopped(self.runner_id)
         
     def empty(self):
         return self.__lib.runner_empty(self.runner_id)
 
-    def infer_all(self, samples, key_func=None, out_func=None, in_func=None):
+    def infer_all(self, samples, key_func=None, out_func=None, in_func=None, input_pool=None):
         self.sample_count = len(samples)
         if self.sample_count == 0:
             return
-        self.map_lock = threading.Lock()
+        self.map_lock = threading.Condition()
         self.finish_cond = threading.Condition()
         self.task_map = {}
         self.sample_index = {}
@@ -154,23 +267,78 @@ class SGInfer:
             sample_id = key_func(i, sample) if key_func else i
             if in_func is not None:
                 sample = in_func(sample)
-            task_id = self.put(*sample)
+            if input_pool is not None:
+                task_id = input_pool.put(*sample)
+            else:
+                task_id = self.put(*sample)
             self.map_lock.acquire()
-            self.sample_index[sample_id] = len(self.task_map)
+            self.sample_index[sample_id] = i
             self.task_map[task_id] = sample_id
+            self.map_lock.notify()
             self.map_lock.release()
         self.wait_thread.join()
         return self.final_outputs
 
+    def infer_stream(self, samples, max_inflight=16, ordered=False, key_func=None, in_func=None, input_pool=None):
+        """
+        Lazily puts samples from any iterable and yields (sample_id, outputs)
+        as results complete. At most max_inflight samples are in the runner
+        (or waiting to be yielded in order), so memory stays bounded however
+        long the iterable is. With ordered=True results are yielded in input
+        order.
+        """
+        samples = iter(samples)
+        pending = {}
+        reorder = {}
+        next_seq = 0
+        seq = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) + len(reorder) < max_inflight:
+                    try:
+                        sample = next(samples)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    sample_id = key_func(seq, sample) if key_func else seq
+                    if in_func is not None:
+                        sample = in_func(sample)
+                    if input_pool is not None:
+                        task_id = input_pool.put(*sample)
+                    else:
+                        task_id = self.put(*sample)
+                    pending[task_id] = seq, sample_id
+                    seq += 1
+                if not pending:
+                    break
+                task_id, outputs, valid = self.wait_get(0.1)
+                if task_id == 0:
+                    continue
+                task_seq, sample_id = pending.pop(task_id)
+                if not ordered:
+                    yield sample_id, outputs
+                    continue
+                reorder[task_seq] = sample_id, outputs
+                while next_seq in reorder:
+                    yield reorder.pop(next_seq)
+                    next_seq += 1
+        finally:
+            # drain what is still in flight if the consumer stopped early
+            while pending:
+                task_id, _, _ = self.wait_get(0.1)
+                pending.pop(task_id, None)
+
     def __wait_result(self):
         cached_outputs = []
         while self.sample_count>0:
-            task_id, outputs, valid = self.try_get()
+            task_id, outputs, valid = self.wait_get(0.1)
             if task_id == 0:
-                time.sleep(0.0001)
                 continue
 
             self.map_lock.acquire()
+            # the result may come back before put() returned its task id
+            self.map_lock.wait_for(lambda: task_id in self.task_map)
             sample_id = self.task_map[task_id]
             del self.task_map[task_id]
             self.map_lock.release()
@@ -185,17 +353,22 @@ class SGInfer:
             self.final_outputs[self.sample_index[id]] = out
 
 
-    def __get(self, func):
+    def __get(self, func, *args):
         output_num= ct.c_uint32(0)
         task_id = ct.c_uint32(0)
         output_valid = ct.c_uint32(0)
         func.restype = ct.POINTER(SGTensor)
-        output_tensors = func(self.runner_id, ct.byref(task_id), ct.byref(output_num), ct.byref(output_valid))
+        output_tensors = func(self.runner_id, ct.byref(task_id), ct.byref(output_num), ct.byref(output_valid), *args)
         if(task_id.value == 0):
             return 0, [], 0
         outputs = []
         if output_valid.value == 0:
             return task_id.value, [], False
+        if self.zero_copy:
+            owner = _NativeOutputs(self.__lib, output_num, output_tensors)
+            for i in range(output_num.value):
+                outputs.append(output_tensors[i].to_numpy(owner))
+            return task_id.value, outputs, True
         for i in range(output_num.value):
             outputs.append(output_tensors[i].to_numpy())
         self.__lib.runner_release_output(output_num, output_tensors)
@@ -220,9 +393,423 @@ class SGInfer:
         self.__lib.release_unsigned_pointer(durations);
         return result
 
+    def stats(self):
+        """
+        Latency of each pipeline stage on each device, in us. Histograms are
+        lists of (lower, upper, count) of the non-empty buckets.
+        """
+        num = ct.c_uint32(0)
+        self.__lib.get_runner_stage_stats.restype = ct.POINTER(StageStat)
+        stats = self.__lib.get_runner_stage_stats(self.runner_id, ct.byref(num))
+        result = []
+        for _, stat in zip(range(num.value), stats):
+            result.append(dict(
+                device=stat.device_id,
+                stage=STAGE_NAMES[stat.stage],
+                count=stat.count,
+                mean=stat.mean_us,
+                p50=stat.p50_us,
+                p90=stat.p90_us,
+                p99=stat.p99_us,
+                max=stat.max_us,
+                histogram=[
+                    (b.lower_us, b.upper_us, b.count)
+                    for _, b in zip(range(stat.bucket_num), stat.buckets)]))
+        self.__lib.release_stage_stats(num, stats)
+        return result
+
     def show(self):
         self.__lib.runner_show_status(self.runner_id)
 
+class SGInferRegistry:
+    """
+    Several bmodels served on the same devices. All of them are loaded into
+    one bmruntime per device instead of one runtime per model and device,
+    and requests pick their model by name.
+
+    A bmruntime holds one network per name, so a bmodel whose network name
+    is already loaded on a device gets a private runtime there instead,
+    with a warning in the log.
+    """
+    def __init__(self, devices=None):
+        self.devices = devices
+        self.runners = {}
+
+    def load(self, name, bmodel_path, batch=1, **kwargs):
+        if name in self.runners:
+            raise KeyError('model {} is already loaded'.format(name))
+        runner = SGInfer(bmodel_path, batch, self.devices, shared_runtime=True, **kwargs)
+        self.runners[name] = runner
+        return runner
+
+    def unload(self, name):
+        self.runners.pop(name).stop()
+
+    def __getitem__(self, name):
+        return self.runners[name]
+
+    def __contains__(self, name):
+        return name in self.runners
+
+    def names(self):
+        return list(self.runners)
+
+    def infer_one(self, name, *inputs):
+        return self.runners[name].infer_one(*inputs)
+
+
+class InputBufferPool:
+    """
+    Preallocated input buffers handed to the runner without copying.
+
+    The runner reads them in place and hands them back once pre-process
+    has copied them to device memory, so steady state inference does no
+    host allocation for inputs. Buffers have the shapes and dtypes of the
+    network inputs unless shapes/dtypes are given. Each pool has its own
+    recycle queue in the runner, so several pools may share a runner.
+    """
+    def __init__(self, infer, size=4, shapes=None, dtypes=None):
+        if shapes is None or dtypes is None:
+            info = infer.get_input_info().values()
+            shapes = shapes or [i['shape'] for i in info]
+            dtypes = dtypes or [nptype(i['dtype']) for i in info]
+        self.infer = infer
+        self.shapes = [tuple(s) for s in shapes]
+        self.dtypes = [np.dtype(t) for t in dtypes]
+        self.buffers = []
+        self.tensors = []
+        for _ in range(size):
+            buffers = [np.empty(s, dtype=t) for s, t in zip(self.shapes, self.dtypes)]
+            tensors = (SGTensor*len(buffers))()
+            for t, b in zip(tensors, buffers):
+                t.from_numpy(b)
+            self.buffers.append(buffers)
+            self.tensors.append(tensors)
+        self.slots = {id(b): i for i, b in enumerate(self.buffers)}
+        self.free = list(range(size))
+        self.busy = {}
+        self.recycled = (ct.c_uint32*size)()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.pool_id = infer._create_input_pool()
+
+    def __recycle(self, timeout=0):
+        num = self.infer._get_recycled(self.pool_id, self.recycled, timeout)
+        for i in range(num):
+            self.free.append(self.busy.pop(self.recycled[i]))
+
+    def acquire(self):
+        """
+        Returns the list of input arrays of a free buffer, waiting for one
+        to come back from the runner if all of them are in flight. Fill the
+        arrays in place and hand them to submit().
+        """
+        with self.lock:
+            self.__recycle()
+            while not self.free:
+                if self.closed or not self.infer.running:
+                    raise RuntimeError('input pool is closed')
+                self.__recycle(0.1)
+            return self.buffers[self.free.pop()]
+
+    def submit(self, buffers):
+        with self.lock:
+            slot = self.slots[id(buffers)]
+            task_id = self.infer._put_pooled(self.pool_id, self.tensors[slot])
+            self.busy[task_id] = slot
+        return task_id
+
+    def put(self, *inputs):
+        """
+        Copies inputs into a free buffer and puts it, like SGInfer.put.
+        Inputs must have exactly the shapes and dtypes of the buffers.
+        """
+        if len(inputs) != len(self.shapes):
+            raise ValueError('expected {} inputs, got {}'.format(len(self.shapes), len(inputs)))
+        for i, (data, shape, dtype) in enumerate(zip(inputs, self.shapes, self.dtypes)):
+            if data.shape != shape or data.dtype != dtype:
+                raise ValueError('input {} should be {} {}, got {} {}'.format(
+                    i, dtype, shape, data.dtype, data.shape))
+        buffers = self.acquire()
+        for b, i in zip(buffers, inputs):
+            np.copyto(b, i)
+        return self.submit(buffers)
+
+    def close(self):
+        """
+        Waits for the buffers still in flight and releases the recycle
+        queue of the pool. A stopped runner never returns its buffers, so
+        they are not waited for.
+        """
+        if self.pool_id == 0:
+            return
+        # wakes up a thread waiting in acquire() before taking the lock
+        self.closed = True
+        with self.lock:
+            while self.busy and self.infer.running:
+                self.__recycle(0.1)
+        self.infer._release_input_pool(self.pool_id)
+        self.pool_id = 0
+
+    def __del__(self):
+        if hasattr(self, 'pool_id'):
+            self.close()
+
+class AsyncSGInfer:
+    """
+    asyncio front end multiplexing concurrent requests over one SGInfer.
+
+    Puts go through a single worker thread so the event loop never blocks.
+    A single reader thread collects results and resolves the waiting
+    futures by task id with call_soon_threadsafe, which wakes the loop
+    through its self-pipe instead of polling. Requests still waiting when
+    close() is called fail with RuntimeError.
+    """
+    def __init__(self, runner, max_inflight=64):
+        self.runner = runner
+        self.max_inflight = max_inflight
+        self.slots = None
+        self.futures = {}
+        self.early = {}
+        self.discarded = set()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.put_executor = ThreadPoolExecutor(1)
+        self.reader = threading.Thread(target=self.__read_results, daemon=True)
+        self.reader.start()
+
+    async def infer(self, *inputs):
+        """
+        Returns (outputs, valid) like SGInfer.infer_one.
+        """
+        if self.closed:
+            raise RuntimeError('AsyncSGInfer is closed')
+        loop = asyncio.get_running_loop()
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_inflight)
+        async with self.slots:
+            future = loop.create_future()
+            put = loop.run_in_executor(self.put_executor, self.runner.put, *inputs)
+            try:
+                task_id = await asyncio.shield(put)
+            except asyncio.CancelledError:
+                # The put still completes, its result is dropped
+                put.add_done_callback(self.__discard)
+                raise
+            with self.lock:
+                if self.closed:
+                    raise RuntimeError('AsyncSGInfer is closed')
+                if task_id in self.early:
+                    future.set_result(self.early.pop(task_id))
+                else:
+                    self.futures[task_id] = loop, future
+            return await future
+
+    def __discard(self, put):
+        if put.cancelled() or put.exception() is not None:
+            return
+        with self.lock:
+            if self.early.pop(put.result(), None) is None:
+                self.discarded.add(put.result())
+
+    def __read_results(self):
+        while not self.closed:
+            task_id, outputs, valid = self.runner.wait_get(0.1)
+            if task_id == 0:
+                continue
+            with self.lock:
+                if task_id in self.discarded:
+                    self.discarded.remove(task_id)
+                    continue
+                entry = self.futures.pop(task_id, None)
+                if entry is None:
+                    # put() has not returned the task id yet
+                    self.early[task_id] = outputs, valid
+                    continue
+            loop, future = entry
+            loop.call_soon_threadsafe(self.__resolve, future, (outputs, valid))
+
+    @staticmethod
+    def __resolve(future, result):
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    def __fail(future):
+        if not future.done():
+            future.set_exception(RuntimeError('AsyncSGInfer closed before the result arrived'))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            futures, self.futures = self.futures, {}
+            self.early.clear()
+        self.reader.join()
+        self.put_executor.shutdown()
+        for loop, future in futures.values():
+            try:
+                loop.call_soon_threadsafe(self.__fail, future)
+            except RuntimeError:
+                # the loop is closed, nobody is waiting any more
+                pass
+
+class BatchingSGInfer:
+    """
+    Coalesces requests of a few samples into full batches for a runner
+    started with a bmodel compiled for batch_size.
+
+    A batch is put once it is full or max_latency seconds after its first
+    request arrived; partial batches are zero padded. Outputs are split
+    back along the first axis per request. A batch that cannot be put
+    fails the futures of its requests; requests still pending when close()
+    is called, or when the batching thread dies, fail with RuntimeError.
+    """
+    def __init__(self, runner, batch_size=None, max_latency=0.005):
+        if batch_size is None:
+            batch_size = next(iter(runner.get_input_info().values()))['shape'][0]
+        self.runner = runner
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.batches = {}
+        self.batch_cond = threading.Condition()
+        self.lock = threading.Lock()
+        self.accepting = True
+        self.closed = False
+        self.num_batches = 0
+        self.num_samples = 0
+        self.num_requests = 0
+        self.total_delay = 0.
+        self.max_delay = 0.
+        self.batcher = threading.Thread(target=self.__make_batches, daemon=True)
+        self.reader = threading.Thread(target=self.__read_results, daemon=True)
+        self.batcher.start()
+        self.reader.start()
+
+    def submit(self, *inputs):
+        """
+        Queues one request whose inputs all have the same first dimension,
+        returning a concurrent.futures.Future of (outputs, valid).
+        """
+        num = inputs[0].shape[0]
+        if num > self.batch_size:
+            raise ValueError('request of {} samples exceeds batch size {}'.format(num, self.batch_size))
+        future = Future()
+        with self.lock:
+            if not self.accepting:
+                raise RuntimeError('BatchingSGInfer is closed')
+            self.requests.put((inputs, num, future, time.monotonic()))
+        return future
+
+    def infer(self, *inputs):
+        return self.submit(*inputs).result()
+
+    def __make_batches(self):
+        held = None
+        try:
+            while not self.closed:
+                if held is not None:
+                    request, held = held, None
+                else:
+                    try:
+                        request = self.requests.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                deadline = request[3] + self.max_latency
+                batch = [request]
+                filled = request[1]
+                while filled < self.batch_size:
+                    try:
+                        request = self.requests.get(timeout=max(deadline - time.monotonic(), 0))
+                    except queue.Empty:
+                        break
+                    if filled + request[1] > self.batch_size:
+                        held = request
+                        break
+                    batch.append(request)
+                    filled += request[1]
+                try:
+                    self.__put_batch(batch, filled)
+                except Exception as err:
+                    self.__fail(batch, err)
+        finally:
+            # Nothing takes requests any more, fail the ones left behind
+            with self.lock:
+                self.accepting = False
+            pending = [] if held is None else [held]
+            while True:
+                try:
+                    pending.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            self.__fail(pending, RuntimeError('BatchingSGInfer is closed'))
+
+    @staticmethod
+    def __fail(batch, err):
+        for _, _, future, _ in batch:
+            if not future.done():
+                future.set_exception(err)
+
+    def __put_batch(self, batch, filled):
+        inputs = []
+        for i in range(len(batch[0][0])):
+            parts = [r[0][i] for r in batch]
+            if filled < self.batch_size:
+                pad_shape = (self.batch_size - filled,) + parts[0].shape[1:]
+                parts.append(np.zeros(pad_shape, dtype=parts[0].dtype))
+            inputs.append(np.concatenate(parts))
+        now = time.monotonic()
+        task_id = self.runner.put(*inputs)
+        with self.batch_cond:
+            self.batches[task_id] = batch
+            self.num_batches += 1
+            self.num_samples += filled
+            self.num_requests += len(batch)
+            self.total_delay += sum(now - r[3] for r in batch)
+            self.max_delay = max(self.max_delay, now - batch[0][3])
+            self.batch_cond.notify()
+
+    def __read_results(self):
+        while not self.closed:
+            task_id, outputs, valid = self.runner.wait_get(0.1)
+            if task_id == 0:
+                continue
+            with self.batch_cond:
+                # the batcher records the batch right after putting it
+                while not self.batch_cond.wait_for(lambda: task_id in self.batches, 0.1):
+                    if self.closed:
+                        return
+                batch = self.batches.pop(task_id)
+            offset = 0
+            for _, num, future, _ in batch:
+                if not future.done():
+                    future.set_result(([o[offset:offset + num] for o in outputs], valid))
+                offset += num
+
+    def stats(self):
+        """
+        Batch fill ratio and queueing delay in seconds of the requests so far.
+        """
+        with self.batch_cond:
+            return dict(
+                batches=self.num_batches,
+                samples=self.num_samples,
+                fill_ratio=self.num_samples / max(self.num_batches * self.batch_size, 1),
+                queue_delay_mean=self.total_delay / max(self.num_requests, 1),
+                queue_delay_max=self.max_delay)
+
+    def close(self):
+        with self.lock:
+            self.accepting = False
+            self.closed = True
+        self.batcher.join()
+        self.reader.join()
+        with self.batch_cond:
+            batches, self.batches = self.batches, {}
+        err = RuntimeError('BatchingSGInfer closed before the result arrived')
+        for batch in batches.values():
+            self.__fail(batch, err)
+
 
 if __name__ == "__main__":
 
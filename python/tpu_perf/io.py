@@ -1,5 +1,13 @@
+import os
+import copy
+import queue
+import functools
+import threading
+import collections
+import multiprocessing
+import multiprocessing.util
 import numpy as np
-from collections import Iterable
+from collections.abc import Iterable
 import lmdb
 try:
     from scipy.ndimage import zoom
@@ -60,7 +68,10 @@ def array_to_blobproto(arr):
             np.float16,
             np.float64,
     ):
-        blob.data.extend(arr.astype(np.float32).flat)
+        # Packed fields are merged as one bulk buffer instead of being
+        # extended element by element.
+        data = arr.astype('<f4', copy=False).tobytes()
+        blob.MergeFromString(_length_delimited(_BLOB_DATA, data))
         return blob
     if arr.dtype in (
             np.uint32,
@@ -70,7 +81,8 @@ def array_to_blobproto(arr):
             np.int16,
             np.uint16,
     ):
-        blob.int32_data.extend(arr.astype(np.int32).flat)
+        data = _encode_zigzag(arr.astype(np.int32, copy=False).ravel())
+        blob.MergeFromString(_length_delimited(_BLOB_INT32_DATA, data))
         return blob
     raise Exception("unsupported numpy dtype:{}".format(arr.dtype))
 
@@ -79,9 +91,10 @@ def arraylist_to_blobprotovector_str(arraylist):
     """Converts a list of arrays to a serialized blobprotovec, which could be
     then passed to a network for processing.
     """
-    vec = ufw_blob.BlobProtoVector()
-    vec.blobs.extend([array_to_blobproto(arr) for arr in arraylist])
-    return vec.SerializeToString()
+    return b''.join(
+        _length_delimited(1,
+                          array_to_blobproto(arr).SerializeToString())
+        for arr in arraylist)
 
 
 def blobprotovector_str_to_arraylist(str):
@@ -92,51 +105,303 @@ def blobprotovector_str_to_arraylist(str):
     return [blobproto_to_array(blob) for blob in vec.blobs]
 
 
-def array_to_datum(arr, label=None):
+def iter_blobprotovector(Input):
+    """Iterates over a serialized blobprotovec, or a file containing one,
+    and yields the arrays one at a time in the same format as
+    blob_to_array. Files are memory mapped and the arrays are views over
+    the mapping wherever the wire format allows it.
+    """
+    if isinstance(Input, str):
+        import mmap
+        with open(Input, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return
+            buf = memoryview(mmap.mmap(fp.fileno(), 0,
+                                       access=mmap.ACCESS_READ))
+    else:
+        buf = memoryview(Input)
+    for number, wire_type, _, begin, end in _iter_fields(buf):
+        if number == 1 and wire_type == 2:
+            yield _blob_str_to_array(buf[begin:end])
+
+
+def array_to_datum(arr, label=None, raw=False):
     """
     Converts a arbitrary-dimensional and arbitrary-dtype array to datum.
+    float32 arrays are stored in float_data unless raw is True, in which
+    case every dtype is stored as raw bytes in data with the dtype tag.
     """
     datum = ufw_blob.Datum()
     datum.shape.dim.extend(arr.shape)
-    if arr.dtype == np.float32:
+    if arr.dtype == np.float32 and not raw:
         datum.float_data.extend(arr.flat)
     else:
-        datum.data = arr.view(np.uint8).tostring()
+        datum.data = arr.tobytes()
     datum.dtype = ufw_dtype[arr.dtype]
     if label is not None:
         datum.label = label
     return datum
 
 
-def datum_to_array(datum):
+def datum_to_array(datum, copy=True):
     """Converts a datum to an array. Note that the label is not returned,
     as one can easily get it by calling datum.label.
+    With copy=False raw data is returned as a read-only view over
+    datum.data instead of a writable copy.
     """
     if datum.HasField('shape'):
         shape = datum.shape.dim
     else:
         shape = [datum.channels, datum.height, datum.width]
     if len(datum.data):
-        return np.fromstring(datum.data, dtype=np.uint8).view(
-            np_dtype[datum.dtype]).reshape(shape)
+        arr = np.frombuffer(datum.data, dtype=np_dtype[datum.dtype]).reshape(
+            shape)
+        return arr.copy() if copy else arr
     else:
         return np.array(datum.float_data).astype(np.float32).reshape(shape)
 
 
+## protobuf wire format
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(buf, pos=0, end=None):
+    """
+    Walk the top level fields of a serialized message.
+
+    Yields (field_number, wire_type, value, value_begin, value_end), where
+    value is the decoded integer for varint fields and None otherwise.
+    """
+    if end is None:
+        end = len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        number, wire_type = key >> 3, key & 7
+        begin = pos
+        value = None
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, begin = _read_varint(buf, pos)
+            pos = begin + length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise Exception("unsupported wire type:{}".format(wire_type))
+        yield number, wire_type, value, begin, pos
+
+
+def _read_packed_varints(buf, begin, end):
+    values = []
+    while begin < end:
+        v, begin = _read_varint(buf, begin)
+        values.append(v)
+    return values
+
+
+def datum_str_to_array(value, copy=True):
+    """Converts a serialized datum to an array without parsing it into a
+    protobuf message. With copy=False raw data is returned as a read-only
+    view over value, so no copy at all is made.
+    """
+    shape = None
+    legacy_shape = [0, 0, 0]
+    dtype = ufw_blob.BlobProto.Dtype.UINT8
+    data = None
+    floats = None
+    pos = 0
+    while pos is not None:
+        fields, pos = _iter_fields(value, pos), None
+        for number, wire_type, v, begin, end in fields:
+            if number == 4:
+                data = begin, end
+            elif number == 8:
+                shape = []
+                for n, w, dim, b, e in _iter_fields(value, begin, end):
+                    if n != 1:
+                        continue
+                    if w == 2:
+                        shape.extend(_read_packed_varints(value, b, e))
+                    else:
+                        shape.append(dim)
+            elif number == 9:
+                dtype = v
+            elif number in (1, 2, 3):
+                legacy_shape[number - 1] = v
+            elif number == 6 and wire_type == 2:
+                floats = np.frombuffer(value,
+                                       dtype='<f4',
+                                       count=(end - begin) // 4,
+                                       offset=begin)
+            elif number == 6:
+                # Skip the whole run of unpacked values at once
+                floats, pos = _unpacked_floats(value, begin - 1)
+                break
+    if shape is None:
+        shape = legacy_shape
+    if data is not None and data[0] != data[1]:
+        dtype = np.dtype(np_dtype[dtype])
+        begin, end = data
+        arr = np.frombuffer(value,
+                            dtype=dtype,
+                            count=(end - begin) // dtype.itemsize,
+                            offset=begin)
+    elif floats is not None:
+        arr = floats
+    else:
+        datum = ufw_blob.Datum()
+        datum.ParseFromString(value)
+        return datum_to_array(datum, copy)
+    arr = arr.reshape(shape)
+    return arr.copy() if copy else arr
+
+
+def array_to_datum_str(arr, label=None, raw=False):
+    """Serializes an array like array_to_datum(arr, label,
+    raw).SerializeToString(), with the same bytes, but frames the fields
+    straight from the array buffer instead of filling a protobuf message
+    element by element.
+    """
+    dims = b''.join(_encode_varint(d) for d in arr.shape)
+    shape = _length_delimited(1, dims) if dims else b''
+    out = []
+    if arr.dtype == np.float32 and not raw:
+        records = np.empty(arr.size, dtype=_FLOAT_RECORD)
+        records['key'] = _DATUM_FLOAT_DATA_KEY
+        records['value'] = arr.ravel()
+        floats = records.tobytes()
+    else:
+        out.append(_length_delimited(_DATUM_DATA, arr.tobytes()))
+        floats = b''
+    if label is not None:
+        # Negative int32 are encoded as 64 bit two's complement
+        out.append(_encode_varint(_DATUM_LABEL << 3))
+        out.append(_encode_varint(int(label) & 0xffffffffffffffff))
+    out.append(floats)
+    out.append(_length_delimited(_DATUM_SHAPE, shape))
+    out.append(_encode_varint(_DATUM_DTYPE << 3))
+    out.append(_encode_varint(ufw_dtype[arr.dtype]))
+    return b''.join(out)
+
+
+def _unpacked_floats(buf, pos):
+    """Reads the run of unpacked float_data fields starting at pos,
+    returning the values as a strided view and the end of the run.
+    """
+    count = (len(buf) - pos) // _FLOAT_RECORD.itemsize
+    keys = np.frombuffer(buf, dtype=np.uint8, offset=pos)
+    keys = keys[:count * _FLOAT_RECORD.itemsize:_FLOAT_RECORD.itemsize]
+    other = np.flatnonzero(keys != _DATUM_FLOAT_DATA_KEY)
+    if len(other):
+        count = int(other[0])
+    records = np.frombuffer(buf, dtype=_FLOAT_RECORD, count=count, offset=pos)
+    return records['value'], pos + count * _FLOAT_RECORD.itemsize
+
+
 def blob_to_array(Input):
     """Converts a blob to an array. Note that the data type is float32 and
     int32 only.
     """
     if isinstance(Input, str):
-        blob = ufw_blob.BlobProto()
+        buf = bytearray(os.path.getsize(Input))
         with open(Input, 'rb') as fp:
-            blob.ParseFromString(fp.read())
+            fp.readinto(buf)
     else:
-        blob = Input
-    shape = blob.shape.dim
+        # Re-serializing copies the packed fields in bulk, which is much
+        # cheaper than iterating over the repeated fields in Python.
+        buf = bytearray(Input.SerializeToString())
+    return _blob_str_to_array(memoryview(buf))
+
+
+_BLOB_DATA = 5
+_BLOB_SHAPE = 7
+_BLOB_INT32_DATA = 14
+
+_DATUM_DATA = 4
+_DATUM_LABEL = 5
+_DATUM_SHAPE = 8
+_DATUM_DTYPE = 9
+_DATUM_FLOAT_DATA_KEY = 6 << 3 | 5
+# float_data is not packed, each value is a key byte and a fixed32
+_FLOAT_RECORD = np.dtype([('key', 'u1'), ('value', '<f4')])
+
+
+def _encode_varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _length_delimited(number, payload):
+    return _encode_varint(number << 3 | 2) + \
+        _encode_varint(len(payload)) + payload
+
+
+def _encode_zigzag(arr):
+    """Encodes an int32 array as packed sint32 varints."""
+    z = ((arr << 1) ^ (arr >> 31)).view(np.uint32)
+    nbytes = np.ones(len(z), dtype=np.int64)
+    for bits in (7, 14, 21, 28):
+        nbytes += z >= (1 << bits)
+    offsets = np.cumsum(nbytes) - nbytes
+    out = np.empty(int(nbytes.sum()), dtype=np.uint8)
+    for i in range(5):
+        mask = nbytes > i
+        if not mask.any():
+            break
+        byte = (z[mask] >> np.uint32(7 * i)) & np.uint32(0x7f)
+        byte |= np.where(nbytes[mask] > i + 1, 0x80, 0).astype(np.uint32)
+        out[offsets[mask] + i] = byte
+    return out.tobytes()
+
+
+def _decode_zigzag(buf):
+    """Decodes packed sint32 varints into an int32 array."""
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if len(b) == 0:
+        return np.empty(0, dtype=np.int32)
+    ends = np.flatnonzero(b < 0x80)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    pos = np.arange(len(b)) - np.repeat(starts, ends - starts + 1)
+    z = np.add.reduceat(
+        (b & 0x7f).astype(np.uint32) << (7 * pos).astype(np.uint32),
+        starts,
+        dtype=np.uint32)
+    return ((z >> np.uint32(1)) ^ -(z & np.uint32(1))).view(np.int32)
+
+
+def _blob_str_to_array(buf):
+    shape = ufw_blob.BlobShape()
+    data = []
+    int32_data = []
+    for number, _, _, begin, end in _iter_fields(buf):
+        if number == _BLOB_SHAPE:
+            shape.MergeFromString(bytes(buf[begin:end]))
+        elif number == _BLOB_DATA:
+            # Packed and unpacked encodings share the same byte layout
+            data.append(np.frombuffer(buf[begin:end], dtype='<f4'))
+        elif number == _BLOB_INT32_DATA:
+            int32_data.append(_decode_zigzag(buf[begin:end]))
+    shape = list(shape.dim)
 
     def toArray(data, dtype):
-        nonlocal shape
+        data = data[0] if len(data) == 1 else np.concatenate(data)
         lenData = len(data)
         if shape == [] and lenData == 1:
             return data
@@ -145,12 +410,12 @@ def blob_to_array(Input):
                 "Expected a scalar, but got an array with length {}".format(
                     lenData))
         if lenData > 0:
-            return np.array(data).astype(dtype).reshape(shape)
+            return data.astype(dtype, copy=False).reshape(shape)
 
-    if len(blob.data) > 0:
-        return toArray(blob.data, np.float32)
-    if len(blob.int32_data) > 0:
-        return toArray(blob.int32_data, np.int32)
+    if sum(len(d) for d in data) > 0:
+        return toArray(data, np.float32)
+    if sum(len(d) for d in int32_data) > 0:
+        return toArray(int32_data, np.int32)
 
 
 ## Pre-processing
@@ -174,6 +439,7 @@ class Transformer:
         self.raw_scale = {}
         self.mean = {}
         self.input_scale = {}
+        self.resize_backend = {}
 
     def __check_input(self, in_):
         if in_ not in self.inputs:
@@ -209,7 +475,10 @@ class Transformer:
         input_scale = self.input_scale.get(in_)
         in_dims = self.inputs[in_][2:]
         if ufw_in.shape[:2] != in_dims:
-            ufw_in = resize_image(ufw_in, in_dims)
+            ufw_in = resize_image(ufw_in,
+                                  in_dims,
+                                  backend=self.resize_backend.get(
+                                      in_, 'skimage'))
         if transpose is not None:
             ufw_in = ufw_in.transpose(transpose)
         if channel_swap is not None:
@@ -222,6 +491,65 @@ class Transformer:
             ufw_in *= input_scale
         return ufw_in
 
+    def preprocess_batch(self, in_, images, out=None):
+        """
+        Batched version of preprocess(), writing the whole batch into a
+        single float32 output with the same results. Images are resized
+        and reordered one by one into their slots of the output, the
+        scaling and mean subtraction then run once over the whole batch.
+
+        Parameters
+        ----------
+        in_ : name of input blob to preprocess for
+        images : (N x H' x W' x K) ndarray or sequence of (H' x W' x K)
+            ndarrays
+        out : optional preallocated (N x K x H x W) float32 ndarray
+
+        Returns
+        -------
+        ufw_in : (N x K x H x W) ndarray for input to a Net
+        """
+        self.__check_input(in_)
+        transpose = self.transpose.get(in_)
+        channel_swap = self.channel_swap.get(in_)
+        raw_scale = self.raw_scale.get(in_)
+        mean = self.mean.get(in_)
+        input_scale = self.input_scale.get(in_)
+        in_dims = tuple(self.inputs[in_][2:])
+        backend = self.resize_backend.get(in_, 'skimage')
+        im_shape = in_dims + (self.inputs[in_][1], )
+        if transpose is not None:
+            im_shape = tuple(im_shape[i] for i in transpose)
+        shape = (len(images), ) + im_shape
+        if out is None:
+            out = np.empty(shape, dtype=np.float32)
+        elif out.shape != shape or out.dtype != np.float32:
+            raise ValueError(
+                'Output buffer should be float32 {}'.format(shape))
+        for n, im in enumerate(images):
+            if im.shape[:2] != in_dims:
+                im = resize_image(im.astype(np.float32, copy=False),
+                                  in_dims,
+                                  backend=backend)
+            if transpose is not None:
+                im = im.transpose(transpose)
+            if im.shape != im_shape:
+                raise ValueError('Image {} should be {} after resizing'
+                                 ' and transposing, got {}'.format(
+                                     n, im_shape, im.shape))
+            if channel_swap is None:
+                np.copyto(out[n], im)
+            else:
+                for i, c in enumerate(channel_swap):
+                    np.copyto(out[n, i], im[c])
+        if raw_scale is not None:
+            out *= raw_scale
+        if mean is not None:
+            out -= mean
+        if input_scale is not None:
+            out *= input_scale
+        return out
+
     def deprocess(self, in_, data):
         """
         Invert Caffe formatting; see preprocess().
@@ -324,8 +652,27 @@ class Transformer:
                 mean = resize_image(normal_mean.transpose((1,2,0)),
                         in_shape[1:]).transpose((2,0,1)) * \
                         (m_max - m_min) + m_min
+        mean32 = mean.astype(np.float32)
+        if np.array_equal(mean32, mean):
+            # float32 arithmetic then rounds exactly like subtracting the
+            # float64 mean and rounding to float32, only much faster
+            mean = mean32
         self.mean[in_] = mean
 
+    def set_resize_backend(self, in_, backend):
+        """
+        Set how inputs are resized to the input dimensions.
+
+        Parameters
+        ----------
+        in_ : which input to assign this backend
+        backend : 'skimage' (default) or 'separable', see resize_image()
+        """
+        self.__check_input(in_)
+        if backend not in ('skimage', 'separable'):
+            raise ValueError('Unknown resize backend {}'.format(backend))
+        self.resize_backend[in_] = backend
+
     def set_input_scale(self, in_, scale):
         """
         Set the scale of preprocessed inputs s.t. the blob = blob * scale.
@@ -372,7 +719,11 @@ def load_image(filename, color=True):
     return img
 
 
-def resize_image(im, new_dims, interp_order=1):
+def resize_image(im,
+                 new_dims,
+                 interp_order=1,
+                 normalize=True,
+                 backend='skimage'):
     """
     Resize an image array with interpolation.
 
@@ -381,14 +732,26 @@ def resize_image(im, new_dims, interp_order=1):
     im : (H x W x K) ndarray
     new_dims : (height, width) tuple of new dimensions.
     interp_order : interpolation order, default is linear.
+    normalize : scale the image to [0, 1] around the skimage call.
+    backend : 'skimage', or 'separable' to use a cached ResizePlan, which
+        takes any number of channels and needs no normalization.
 
     Returns
     -------
     im : resized ndarray with shape (new_dims[0], new_dims[1], K)
     """
+    if backend == 'separable':
+        plan = resize_plan(tuple(im.shape[:2]), tuple(new_dims), interp_order)
+        return plan(im)
     if im.shape[-1] == 1 or im.shape[-1] == 3:
         im_min, im_max = im.min(), im.max()
-        if im_max > im_min:
+        if not normalize:
+            resized_im = resize(im,
+                                new_dims,
+                                order=interp_order,
+                                mode='constant',
+                                preserve_range=True)
+        elif im_max > im_min:
             # skimage is fast but only understands {1,3} channel images
             # in [0, 1].
             im_std = (im - im_min) / (im_max - im_min)
@@ -410,21 +773,128 @@ def resize_image(im, new_dims, interp_order=1):
     return resized_im.astype(np.float32)
 
 
-def oversample(images, crop_dims):
+class ResizePlan(object):
     """
-    Crop images into the four corners, center, and their mirrored versions.
+    Separable nearest (order 0) or linear (order 1) interpolation from
+    src_dims to dst_dims. Source and target indices and weights of both
+    axes are computed once, so applying the plan is only gathers and
+    in-place arithmetic. Pixel centers are aligned and borders are
+    clamped.
+
+    When an axis is downsampled, the Gaussian prefilter skimage applies
+    with anti_aliasing (sigma = (src / dst - 1) / 2) is folded into the
+    weights of that axis, unless anti_aliasing is False. Away from the
+    borders results then match skimage's resize to about 1e-6, the
+    difference coming from float32 accumulation. Near the borders they
+    differ, as skimage pads with zeros instead of clamping.
+
+    A plan resizes (H x W x K) images and (N x H x W x K) batches with any
+    number of channels K into float32.
+    """
+    def __init__(self, src_dims, dst_dims, order=1, anti_aliasing=True):
+        if order not in (0, 1):
+            raise ValueError(
+                'ResizePlan supports interpolation order 0 (nearest) and 1 '
+                '(linear), got {}'.format(order))
+        self.src_dims = tuple(src_dims)
+        self.dst_dims = tuple(dst_dims)
+        self.order = order
+        self.anti_aliasing = anti_aliasing
+        self.rows = self._axis(src_dims[0], dst_dims[0], order, anti_aliasing)
+        self.cols = self._axis(src_dims[1], dst_dims[1], order, anti_aliasing)
+
+    @staticmethod
+    def _axis(src, dst, order, anti_aliasing):
+        coords = (np.arange(dst) + 0.5) * (src / dst) - 0.5
+        sigma = (src / dst - 1) / 2
+        # Same kernel size as scipy.ndimage.gaussian_filter, truncate=4
+        radius = int(4 * sigma + 0.5) if anti_aliasing and sigma > 0 else 0
+        if order == 0:
+            index = np.clip(np.floor(coords + 0.5), 0, src - 1).astype(np.intp)
+            if radius == 0:
+                return index
+            index, weight = index[:, None], np.ones((dst, 1))
+        else:
+            lo = np.floor(coords)
+            weight = coords - lo
+            if radius == 0:
+                return (np.clip(lo, 0, src - 1).astype(np.intp),
+                        np.clip(lo + 1, 0, src - 1).astype(np.intp),
+                        weight.astype(np.float32))
+            index = np.clip(np.stack([lo, lo + 1], 1), 0, src - 1)
+            index = index.astype(np.intp)
+            weight = np.stack([1 - weight, weight], 1)
+        offsets = np.arange(-radius, radius + 1)
+        kernel = np.exp(-0.5 * (offsets / sigma)**2)
+        kernel /= kernel.sum()
+        index = np.clip(index[:, :, None] + offsets, 0, src - 1)
+        weight = weight[:, :, None] * kernel
+        return index.reshape(dst, -1), weight.reshape(dst, -1).astype(
+            np.float32)
+
+    @staticmethod
+    def _resample(im, taps, axis, out=None):
+        shape = (-1, ) + (1, ) * (-axis - 1)
+        if not isinstance(taps, tuple):
+            res = im.take(taps, axis=axis)
+            if out is None:
+                return res.astype(np.float32, copy=False)
+            np.copyto(out, res)
+            return out
+        if len(taps) == 2:
+            index, weight = taps
+            res = np.multiply(im.take(index[:, 0], axis=axis),
+                              weight[:, 0].reshape(shape),
+                              out=out,
+                              dtype=np.float32)
+            for i in range(1, index.shape[1]):
+                res += np.multiply(im.take(index[:, i], axis=axis),
+                                   weight[:, i].reshape(shape),
+                                   dtype=np.float32)
+            return res
+        lo, hi, weight = taps
+        res = im.take(lo, axis=axis).astype(np.float32, copy=False)
+        delta = im.take(hi, axis=axis).astype(np.float32, copy=False)
+        delta -= res
+        delta *= weight.reshape(shape)
+        if out is None:
+            res += delta
+            return res
+        np.add(res, delta, out=out)
+        return out
+
+    def __call__(self, im, out=None):
+        """
+        Parameters
+        ----------
+        im : (H x W x K) or (N x H x W x K) ndarray
+        out : optional float32 ndarray to write the result into
 
-    Parameters
-    ----------
-    image : iterable of (H x W x K) ndarrays
-    crop_dims : (height, width) tuple for the crops.
+        Returns
+        -------
+        im : resized float32 ndarray
+        """
+        if im.shape[-3:-1] != self.src_dims:
+            raise ValueError('expected image size {}, got {}'.format(
+                self.src_dims, im.shape[-3:-1]))
+        if self.order == 0 and not isinstance(self.rows, tuple):
+            # Keep the input dtype until the last gather
+            rows = im.take(self.rows, axis=-3)
+        else:
+            rows = self._resample(im, self.rows, -3)
+        return self._resample(rows, self.cols, -2, out)
 
-    Returns
-    -------
-    crops : (10*N x H x W x K) ndarray of crops for number of inputs N.
-    """
+
+@functools.lru_cache(maxsize=32)
+def resize_plan(src_dims, dst_dims, order=1, anti_aliasing=True):
+    """Returns a cached ResizePlan, the dims should be tuples."""
+    return ResizePlan(src_dims, dst_dims, order, anti_aliasing)
+
+
+def _crop_indices(im_shape, crop_dims):
+    """(y0, x0, y1, x1) of the four corner and the center crops."""
     # Dimensions and center.
-    im_shape = np.array(images[0].shape)
+    im_shape = np.array(im_shape)
     crop_dims = np.array(crop_dims)
     im_center = im_shape[:2] / 2.0
 
@@ -439,37 +909,125 @@ def oversample(images, crop_dims):
             curr += 1
     crops_ix[4] = np.tile(im_center, (1, 2)) + np.concatenate(
         [-crop_dims / 2.0, crop_dims / 2.0])
-    crops_ix = np.tile(crops_ix, (2, 1))
+    return crops_ix
 
-    # Extract crops
-    crops = np.empty(
-        (10 * len(images), crop_dims[0], crop_dims[1], im_shape[-1]),
-        dtype=np.float32)
+
+def oversample_views(image, crop_dims):
+    """
+    Crops of a single image as in oversample(), but as strided views into
+    the image instead of copies. Mirrors are negative stride views.
+
+    Parameters
+    ----------
+    image : (H x W x K) ndarray
+    crop_dims : (height, width) tuple for the crops.
+
+    Returns
+    -------
+    crops : list of 10 (H x W x K) ndarray views
+    """
+    crops = [
+        image[crop[0]:crop[2], crop[1]:crop[3], :]
+        for crop in _crop_indices(image.shape, crop_dims)
+    ]
+    return crops + [crop[:, ::-1, :] for crop in crops]
+
+
+def oversample(images, crop_dims, out=None):
+    """
+    Crop images into the four corners, center, and their mirrored versions.
+
+    Parameters
+    ----------
+    image : iterable of (H x W x K) ndarrays
+    crop_dims : (height, width) tuple for the crops.
+    out : optional (10*N x H x W x K) ndarray to write the crops into.
+
+    Returns
+    -------
+    crops : (10*N x H x W x K) ndarray of crops for number of inputs N.
+    """
+    shape = (10 * len(images), crop_dims[0], crop_dims[1],
+             images[0].shape[-1])
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    elif out.shape != shape or out.dtype != np.float32:
+        raise ValueError('Output buffer should be float32 {}'.format(shape))
+    crops_ix = _crop_indices(images[0].shape, crop_dims)
     ix = 0
     for im in images:
         for crop in crops_ix:
-            crops[ix] = im[crop[0]:crop[2], crop[1]:crop[3], :]
+            out[ix] = im[crop[0]:crop[2], crop[1]:crop[3], :]
+            out[ix + 5] = im[crop[0]:crop[2], crop[1]:crop[3], :][:, ::-1, :]
             ix += 1
-        crops[ix - 5:ix] = crops[ix - 5:ix, :, ::-1, :]  # flip for mirrors
-    return crops
+        ix += 5
+    return out
+
+
+def iter_oversample(images, crop_dims, batch_size=1):
+    """
+    Generator version of oversample(). Crops batch_size images at a time
+    into a buffer that is reused for every batch, so memory stays constant
+    whatever the number of images. A yielded batch is only valid until the
+    next one is requested.
+
+    Parameters
+    ----------
+    image : iterable of (H x W x K) ndarrays of the same shape
+    crop_dims : (height, width) tuple for the crops.
+    batch_size : number of images per batch.
+
+    Returns
+    -------
+    generator of (10*batch_size x H x W x K) ndarrays, the last one may be
+    smaller.
+    """
+    buf = None
+    batch = []
+    for im in images:
+        batch.append(im)
+        if len(batch) < batch_size:
+            continue
+        if buf is None:
+            buf = np.empty(
+                (10 * batch_size, crop_dims[0], crop_dims[1], im.shape[-1]),
+                dtype=np.float32)
+        yield oversample(batch, crop_dims, buf)
+        batch = []
+    if batch:
+        yield oversample(batch, crop_dims)
 
 
 class LMDB_Dataset(object):
-    def __init__(self, path, queue_size=100, map_size=20e6):
+    """
+    Writes arrays into an lmdb dataset.
+
+    Records are serialized by put() itself, framed straight from the array
+    buffers, so the arrays may be reused as soon as it returns. A single
+    writer thread owns the write transaction, appending records in put
+    order and committing every `queue_size` records, so that disk writes
+    overlap with the caller.
+    """
+    def __init__(self, path, queue_size=100, map_size=20e6, raw=False):
         self.db = lmdb.open(path,
-                            map_size,
+                            int(map_size),
                             create=True,
                             lock=False,
                             map_async=True,
                             max_dbs=0)
-        self.txn = self.db.begin(write=True)
         self.DB_KEY_FORMAT = "{:0>10d}__{:1}"
         self.queue_size = queue_size
+        self.raw = raw
         self.index = 0
-        self.value_list = []
-        self.key_list = []
+        # Bounded, so that put() blocks when the disk falls behind
+        self.pending = queue.Queue(16)
+        self.error = None
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+        self.closed = False
 
     def put(self, images, labels=None, keys=None):
+        self._check_error()
         if isinstance(images, np.ndarray):
             images = [images]
 
@@ -481,54 +1039,79 @@ class LMDB_Dataset(object):
             keys = [''] * num
         assert (num == len(keys))
         keys = [
-            self.DB_KEY_FORMAT.format(self.index + i, k)
+            self.DB_KEY_FORMAT.format(self.index + i, k).encode()
             for i, k in enumerate(keys)
         ]
 
-        def put_datum(arr, labels):
-            num = len(arr)
-            if isinstance(labels, Iterable):
-                labels = [labels[i] for i in range(num)]
-            if labels is None:
-                labels = [None] * num
-            elif isinstance(labels, int):
-                labels = [labels]
-            return [
-                array_to_datum(g, l).SerializeToString()
-                for g, l in zip(arr, labels)
-            ]
-
-        self.key_list.extend(keys)
-        self.value_list.extend(put_datum(images, labels))
+        if isinstance(labels, Iterable):
+            labels = [labels[i] for i in range(num)]
+        if labels is None:
+            labels = [None] * num
+        elif isinstance(labels, int):
+            labels = [labels]
+
+        values = [
+            array_to_datum_str(g, l, self.raw)
+            for g, l in zip(images, labels)
+        ]
+        self.pending.put(list(zip(keys, values)))
         self.index += num
-        if len(self.key_list) >= self.queue_size:
-            self._put_batch()
 
-    def _put_batch(self):
-        if len(self.key_list) == 0:
-            return
-        for key, value in zip(self.key_list, self.value_list):
-            if not self._put(key, value):
-                self._put_batch()
-        self.txn.commit()
-        self.txn = self.db.begin(write=True)
-        self.value_list = []
-        self.key_list = []
-
-    def _put(self, key, value):
-        success = False
+    def _write_loop(self):
+        batch = []
+        while True:
+            records = self.pending.get()
+            if records is None:
+                break
+            if self.error is not None:
+                # Keep draining so that put() never blocks
+                continue
+            try:
+                batch.extend(records)
+                if len(batch) >= self.queue_size:
+                    self._put_batch(batch)
+                    batch = []
+            except Exception as err:
+                self.error = err
         try:
-            if isinstance(key, str):
-                key = key.encode()
-            self.txn.put(key, value, append=True)
-            success = True
-        except lmdb.MapFullError:
-            self.txn.abort()
-            curr_limit = self.db.info()['map_size']
-            new_limit = curr_limit * 2
-            self.db.set_mapsize(new_limit)
-            self.txn = self.db.begin(write=True)
-        return success
+            if self.error is None:
+                self._put_batch(batch)
+        except Exception as err:
+            self.error = err
+
+    def _put_batch(self, batch):
+        if len(batch) == 0:
+            return
+        self._reserve(batch)
+        while True:
+            try:
+                with self.db.begin(write=True) as txn:
+                    txn.cursor().putmulti(batch, append=True)
+                return
+            except lmdb.MapFullError:
+                # The estimation in _reserve is only a guess
+                self.db.set_mapsize(self.db.info()['map_size'] * 2)
+
+    def _reserve(self, batch):
+        """Grows the map ahead of time from the size of the records."""
+        psize = self.db.stat()['psize']
+        pages = 0
+        for key, value in batch:
+            size = len(key) + len(value) + 16
+            if size > psize // 2:
+                # Large values go to dedicated overflow pages
+                pages += -(-size // psize)
+            else:
+                pages += size / psize
+        info = self.db.info()
+        # Leave room for branch pages and copy-on-write of touched pages
+        needed = int((info['last_pgno'] + 2 * pages + 64) * psize)
+        if needed > info['map_size']:
+            self.db.set_mapsize(max(needed * 2, info['map_size'] * 2))
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
 
     def __enter__(self):
         return self
@@ -537,20 +1120,228 @@ class LMDB_Dataset(object):
         self.close()
 
     def close(self):
-        self._put_batch()
+        if getattr(self, 'closed', True):
+            return
+        self.closed = True
+        self.pending.put(None)
+        self.writer.join()
         self.db.close()
+        self._check_error()
 
     def __del__(self):
         self.close()
 
 
-def lmdb_data(dataset_org):
+def lmdb_data(dataset_org, copy=True):
     db_raw = lmdb.open(dataset_org, readonly=True)
 
     with db_raw.begin() as txn:
         cursor = txn.cursor()
         for key, value in cursor:
-            datum = ufw_blob.Datum()
-            datum.ParseFromString(value)
-            yield key, datum_to_array(datum)
+            yield key, datum_str_to_array(value, copy)
     db_raw.close()
+
+
+class LMDB_IndexedDataset(object):
+    """
+    Random access view over an lmdb dataset written by LMDB_Dataset.
+
+    Supports len(), integer indexing, slicing and shard(), each item being
+    a (key, ndarray) tuple like lmdb_data yields. Slices and shards are
+    views sharing the same environment, which stays open until the
+    dataset they come from is closed. The keys are cached in
+    key_index.npy next to the dataset, so that later opens need not scan
+    it again. With copy=False arrays are read-only views over the records.
+    """
+    INDEX_FN = 'key_index.npy'
+
+    def __init__(self, path, copy=True):
+        self.path = path
+        self.copy = copy
+        self.db = lmdb.open(path, readonly=True)
+        self.parent = None
+        self.keys = self._load_keys()
+        self.indices = range(len(self.keys))
+
+    def _load_keys(self):
+        index_fn = os.path.join(self.path, self.INDEX_FN)
+        data_fn = os.path.join(self.path, 'data.mdb')
+        with self.db.begin() as txn:
+            entries = txn.stat()['entries']
+            if os.path.exists(index_fn) and \
+                    os.path.getmtime(index_fn) >= os.path.getmtime(data_fn):
+                keys = np.load(index_fn, mmap_mode='r')
+                if len(keys) == entries:
+                    return keys
+            keys = np.array(list(txn.cursor().iternext(values=False)),
+                            dtype=bytes)
+        # A fixed width bytes array, so that it can be memory mapped
+        tmp_fn = index_fn + '.tmp'
+        try:
+            with open(tmp_fn, 'wb') as f:
+                np.save(f, keys)
+            os.replace(tmp_fn, index_fn)
+        except OSError:
+            # Read-only dataset, keep the index in memory
+            pass
+        return keys
+
+    def _view(self, indices):
+        view = copy.copy(self)
+        view.indices = indices
+        # Keeps the owner of the environment alive
+        view.parent = self.parent or self
+        return view
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._view(self.indices[index])
+        key = bytes(self.keys[self.indices[index]])
+        with self.db.begin() as txn:
+            return key, datum_str_to_array(txn.get(key), self.copy)
+
+    def __iter__(self):
+        if len(self.indices) == 0:
+            return
+        if self.indices.step != 1:
+            for i in range(len(self.indices)):
+                yield self[i]
+            return
+        with self.db.begin() as txn:
+            cursor = txn.cursor()
+            cursor.set_key(bytes(self.keys[self.indices[0]]))
+            for _, (key, value) in zip(self.indices, cursor):
+                yield key, datum_str_to_array(value, self.copy)
+
+    def shard(self, index, num):
+        """Returns the index-th of num contiguous, near equal parts."""
+        if not 0 <= index < num:
+            raise IndexError('shard {} out of {}'.format(index, num))
+        total = len(self.indices)
+        return self._view(self.indices[index * total // num:(index + 1) *
+                                       total // num])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Closes the environment. Does nothing on views."""
+        if getattr(self, 'parent', True) is None:
+            self.db.close()
+
+    def __del__(self):
+        self.close()
+
+
+# The dataset of an lmdb_prefetch worker, opened once for its lifetime
+_prefetch_env = None
+
+
+def _lmdb_open_worker(path):
+    global _prefetch_env
+    _prefetch_env = lmdb.open(path, readonly=True)
+    # Runs when the worker exits after the pool is closed
+    multiprocessing.util.Finalize(None, _prefetch_env.close, exitpriority=10)
+
+
+def _lmdb_read_range(start_key, count, batch_size):
+    keys = []
+    arrays = []
+    with _prefetch_env.begin() as txn:
+        cursor = txn.cursor()
+        if cursor.set_key(start_key):
+            for key, value in cursor:
+                keys.append(key)
+                # Pickling the result back copies the arrays anyway
+                arrays.append(datum_str_to_array(value, copy=False))
+                if len(keys) == count:
+                    break
+    if not batch_size:
+        return list(zip(keys, arrays))
+    return [(keys[i:i + batch_size], np.stack(arrays[i:i + batch_size]))
+            for i in range(0, len(keys), batch_size)]
+
+
+def lmdb_prefetch(dataset_org,
+                  workers=4,
+                  prefetch=None,
+                  ordered=True,
+                  batch_size=None,
+                  chunk_size=256):
+    """
+    Reads an lmdb dataset like lmdb_data, but decodes it in worker
+    processes ahead of the consumer.
+
+    Parameters
+    ----------
+    dataset_org : path of the lmdb dataset
+    workers : number of decode processes
+    prefetch : number of key ranges decoded ahead, 2 * workers by default
+    ordered : yield records in key order, otherwise in completion order
+    batch_size : if set, yield (keys, (N x ...) ndarray) batches
+    chunk_size : number of records in each key range handed to a worker
+
+    Returns
+    -------
+    generator of (key, ndarray) or (keys, ndarray) tuples
+    """
+    if batch_size:
+        # Only the last batch may be partial
+        chunk_size = -(-chunk_size // batch_size) * batch_size
+    if prefetch is None:
+        prefetch = workers * 2
+
+    db_raw = lmdb.open(dataset_org, readonly=True)
+    with db_raw.begin() as txn:
+        starts = [
+            key for i, key in enumerate(txn.cursor().iternext(values=False))
+            if i % chunk_size == 0
+        ]
+    db_raw.close()
+
+    pool = multiprocessing.Pool(workers,
+                                initializer=_lmdb_open_worker,
+                                initargs=(dataset_org, ))
+    try:
+        done = queue.Queue()
+        inflight = collections.deque()
+        starts = iter(starts)
+
+        def submit():
+            start = next(starts, None)
+            if start is None:
+                return
+            args = (start, chunk_size, batch_size)
+            if ordered:
+                inflight.append(pool.apply_async(_lmdb_read_range, args))
+            else:
+                pool.apply_async(_lmdb_read_range,
+                                 args,
+                                 callback=done.put,
+                                 error_callback=done.put)
+                inflight.append(None)
+
+        for _ in range(prefetch):
+            submit()
+        while inflight:
+            if ordered:
+                items = inflight.popleft().get()
+            else:
+                inflight.pop()
+                items = done.get()
+                if isinstance(items, BaseException):
+                    raise items
+            submit()
+            for item in items:
+                yield item
+    finally:
+        # Lets the workers finish their ranges and close the dataset,
+        # terminate() would kill them without it
+        pool.close()
+        pool.join()
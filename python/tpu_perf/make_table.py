@@ -131,7 +131,14 @@ def adjust_sheet(filename):
     wb.save(filename)
 
 def throughput(time, batchsize):
-    fps = 1000/(float(time)/batchsize)
+    # Failed or aborted runs have N/A times
+    try:
+        time = float(time)
+    except ValueError:
+        return 'N/A'
+    if not time > 0:
+        return 'N/A'
+    fps = 1000/(time/batchsize)
     #print(time, batchsize, fps)
     return float('%.2f'%fps)
 
@@ -1,16 +1,41 @@
 import os
 import re
 import csv
+import json
 import math
+import shutil
+import hashlib
 import psutil
 import sys
 import time
+import queue
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from .buildtree import check_buildtree, BuildTree
 from .subp import CommandExecutor
 from .util import *
 
 option_cmodel_stats = False
+run_cache = None
+
+# Two-sided 95% t distribution quantiles by degrees of freedom
+t_table_95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+def t_value(df):
+    if df < 1:
+        return math.nan
+    if df <= len(t_table_95):
+        return t_table_95[df - 1]
+    # Quantiles of the tabulated df just below, so that intervals in between
+    # are a little wide rather than too narrow
+    for limit, t in [(40, 2.042), (60, 2.021), (120, 2.000)]:
+        if df < limit:
+            return t
+    return 1.980
 
 class Average:
     def __init__(self):
@@ -19,31 +44,95 @@ class Average:
     def put(self, v):
         self.acc += v
         self.count += 1
+        self.values.append(v)
 
     def get(self):
         return self.acc / self.count
 
+    def stddev(self):
+        if self.count < 2:
+            return math.nan
+        mean = self.get()
+        return math.sqrt(
+            sum((v - mean) ** 2 for v in self.values) / (self.count - 1))
+
+    def confidence(self):
+        """Half width of the 95% confidence interval of the mean"""
+        return t_value(self.count - 1) * self.stddev() / math.sqrt(self.count)
+
+    def percentile(self, p):
+        values = sorted(self.values)
+        rank = max(math.ceil(p / 100 * len(values)), 1)
+        return values[rank - 1]
+
     def clear(self):
         self.acc = 0
         self.count = 0
+        self.values = []
+
+class StatsParser:
+    """
+    Incremental parser of bmrt_test output, fed line by line while the
+    process runs. Keeps an Average per time key and flags anomalies: errors
+    logged by bmrt_test, and if abort_ratio is set, iterations slower than
+    abort_ratio times the mean so far.
+    """
+    time_prog = re.compile(r'INFO:(.+) time\(s\): ([\.\d]+)')
+    shape_prog = re.compile(r'Input \d+\).+shape=\[([\d ]+)\]')
+    error_prog = re.compile(r'\b(ERROR|FATAL):')
+    warmup = 10
+
+    def __init__(self, abort_ratio=None):
+        self.abort_ratio = abort_ratio
+        self.times = dict()
+        self.shapes = []
+        self.anomaly = None
+
+    def feed(self, line):
+        m = self.time_prog.search(line)
+        if m:
+            k = m.group(1).strip().replace(' ', '_')
+            v = float(m.group(2))
+            if k not in self.times:
+                self.times[k] = Average()
+            avg = self.times[k]
+            if k == 'calculate' and self.abort_ratio and \
+                avg.count >= self.warmup and v > self.abort_ratio * avg.get():
+                self.anomaly = self.anomaly or \
+                    f'iteration {avg.count} took {v}s, mean {avg.get():.6f}s'
+            avg.put(v)
+            return
+        m = self.shape_prog.search(line)
+        if m:
+            # Only the inputs before the first iteration, later runs repeat them
+            if not self.times:
+                self.shapes.append('x'.join(m.group(1).split()))
+            return
+        if self.error_prog.search(line):
+            self.anomaly = self.anomaly or line.strip()
+
+    @property
+    def iterations(self):
+        return self.times['calculate'].count if 'calculate' in self.times else 0
+
+    @property
+    def mean(self):
+        return self.times['calculate'].get() if self.iterations else math.nan
+
+    def result(self):
+        ret = dict()
+        for k, v in self.times.items():
+            for p in [50, 90, 99]:
+                ret[f'{k}_p{p}'] = v.percentile(p)
+            ret[k] = v.get()
+        ret['shape'] = ':'.join(self.shapes)
+        return ret
 
 def parse_stats(string):
-    time_prog = 'INFO:(.+) time\(s\): ([\.\d]+)'
-    ret = dict()
-    for k, v in re.findall(time_prog, string):
-        k = k.strip().replace(' ', '_')
-        if k not in ret:
-            ret[k] = Average()
-        ret[k].put(float(v))
-    for k in ret.keys():
-        ret[k] = ret[k].get()
-
-    shape_prog = 'Input \d+\).+shape=\[([\d ]+)\]'
-    shape_info = ':'.join(
-        'x'.join(s.split()) for s in re.findall(shape_prog, string))
-    ret['shape'] = shape_info
-
-    return ret
+    parser = StatsParser()
+    for line in string.splitlines():
+        parser.feed(line)
+    return parser.result()
 
 def parse_profile(fn):
     with open(fn) as f:
@@ -63,13 +152,199 @@ def format_float(v):
     else:
         return f'{v:.03e}'
 
-def run_model(tree, config, name, b, profile_path, bmodel, stat_f, extra):
-    title = f'run.{name}'
+class DeviceScheduler:
+    """
+    Runs jobs concurrently on a set of devices, one job per device at a time.
+    The device id is passed to the job as its last argument.
+    """
+    def __init__(self, devices):
+        # A device listed twice would run two jobs at once
+        devices = list(dict.fromkeys(devices))
+        if not devices:
+            raise ValueError('No devices to run on')
+        self.devices = queue.Queue()
+        for dev in devices:
+            self.devices.put(dev)
+        self.executor = ThreadPoolExecutor(max_workers=len(devices))
+        self.jobs = []
+
+    def _run(self, func, args):
+        dev = self.devices.get()
+        try:
+            return func(*args, dev)
+        finally:
+            self.devices.put(dev)
+
+    def submit(self, func, *args):
+        job = self.executor.submit(self._run, func, args)
+        self.jobs.append(job)
+        return job
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            for job in self.jobs:
+                job.cancel()
+        self.executor.shutdown()
+
+class ProcessSampler:
+    """
+    Samples CPU usage, RSS and context switches of a process and all its
+    children from a background thread, every interval seconds until stop().
+    Each sample is (time, cpu, rss, ctx_switches), context switches counted
+    since the previous sample. stop() takes a last sample, so a process
+    still running then has at least one even if it ran shorter than interval.
+    Samples are only taken while the root process runs, an exiting process
+    has already released its memory.
+    """
+    def __init__(self, pid, interval=0.5, start=None):
+        self.root = psutil.Process(pid)
+        self.interval = interval
+        self.start = time.monotonic() if start is None else start
+        self.procs = dict()
+        self.ctx_switches = dict()
+        self.samples = []
+        self.stopped = threading.Event()
+        # Prime cpu_percent, its first call has nothing to compare with
+        self._sample()
+        self.samples.clear()
+        self.thread = threading.Thread(target=self._sample_loop, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        try:
+            procs = [self.root, *self.root.children(recursive=True)]
+        except psutil.Error:
+            return
+        cpu, rss, ctx = 0, 0, 0
+        alive = False
+        for proc in procs:
+            # Reuse Process objects so cpu_percent compares with the last call
+            proc = self.procs.setdefault(proc.pid, proc)
+            try:
+                with proc.oneshot():
+                    if proc.status() == psutil.STATUS_ZOMBIE:
+                        continue
+                    proc_rss = proc.memory_info().rss
+                    # Exiting but not reaped yet, its readings are meaningless
+                    if proc_rss == 0:
+                        continue
+                    cpu += proc.cpu_percent() / 100
+                    rss += proc_rss
+                    switches = proc.num_ctx_switches()
+            except psutil.Error:
+                continue
+            alive = alive or proc.pid == self.root.pid
+            switches = switches.voluntary + switches.involuntary
+            ctx += switches - self.ctx_switches.get(proc.pid, 0)
+            self.ctx_switches[proc.pid] = switches
+        if alive:
+            self.samples.append((time.monotonic() - self.start, cpu, rss, ctx))
+
+    def _sample_loop(self):
+        while not self.stopped.wait(self.interval):
+            self._sample()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self._sample()
+        return self.samples
+
+def write_samples(fn, samples):
+    with open(fn, 'w') as f:
+        csv_f = csv.writer(f)
+        csv_f.writerow(['time(s)', 'cpu_usage', 'rss(MB)', 'ctx_switches'])
+        for t, cpu, rss, ctx in samples:
+            csv_f.writerow([f'{t:.3f}', f'{cpu:.2%}', f'{rss / 1024**2:.1f}', ctx])
+
+def file_sha256(fn):
+    m = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            m.update(block)
+    return m.hexdigest()
+
+class RunCache:
+    """
+    Rows of earlier runs kept in a json file, keyed by a hash of everything
+    they depend on and of schema, the layout of the rows. With force, every
+    model is timed again and its row replaced. New rows are written out at
+    most every save_interval seconds and on flush().
+
+    Each row is stored under the name of its job. A row put for a name
+    drops the rows of that name with other keys, which are stale.
+    """
+    version = 2
+
+    def __init__(self, fn, force=False, schema=None, save_interval=10):
+        self.fn = fn
+        self.force = force
+        self.schema = [self.version, schema]
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.entries = dict()
+        self.dirty = False
+        self.last_save = time.monotonic()
+        if os.path.exists(fn):
+            try:
+                with open(fn) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                logging.warning(f'Ignore invalid run cache {fn}')
+
+    def make_key(self, **fields):
+        fields['schema'] = self.schema
+        data = json.dumps(fields, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key):
+        if self.force:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry and entry['row']
+
+    def put(self, key, name, row):
+        with self.lock:
+            stale = [
+                k for k, entry in self.entries.items()
+                if entry.get('name') == name and k != key]
+            for k in stale:
+                del self.entries[k]
+            self.entries[key] = dict(name=name, row=row)
+            self.dirty = True
+            if time.monotonic() - self.last_save >= self.save_interval:
+                self._save()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+    def _save(self):
+        # Write and rename, an interrupted run never leaves half a file
+        tmp_fn = f'{self.fn}.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_fn, self.fn)
+        self.dirty = False
+        self.last_save = time.monotonic()
+
+def run_model(tree, config, name, b, profile_path, bmodel, extra, title, dev):
+    """
+    Times bmodel with bmrt_test on dev. title names the log, sample and
+    profile files of the run in the workdir, and must be unique per job
+    since jobs run concurrently.
+    """
     workdir = config['workdir']
     env = [
         tree.expand_variables(config, v)
         for v in config.get('run_env', [])]
-    env.append('BMRUNTIME_PROFILE_OUT_DIR={b}b.profiledata')
+    env.append(
+        f'BMRUNTIME_PROFILE_OUT_DIR={os.path.join(workdir, title)}.profiledata')
     pool = CommandExecutor(workdir, env)
     rt_cmp = config.get('runtime_cmp')
     iter_opt = tree.global_config.get('iter_opt', '--loopnum')
@@ -94,47 +369,160 @@ def run_model(tree, config, name, b, profile_path, bmodel, stat_f, extra):
     elif rounds is None:
         rounds = 2000 / b
 
+    # Adaptive mode times in chunks until the mean is known well enough,
+    # rounds is then an upper bound
+    rel_error = config.get(
+        'time_rel_error', tree.global_config.get('time_rel_error'))
+    if rel_error:
+        rounds = math.ceil(rounds)
+        chunk = math.ceil(rounds / 10)
+    else:
+        chunk = rounds
+
     full_name = f'{config["name"]} {name}'
-    logging.info(f'Run {rounds} times for {full_name}')
+    if rel_error:
+        logging.info(
+            f'Run up to {rounds} times for {full_name} on device {dev}, '
+            f'until relative error {rel_error:.2%}')
+    else:
+        logging.info(f'Run {rounds} times for {full_name} on device {dev}')
 
     ref_fn = os.path.join(bmodel_dir, 'output_ref_data.dat')
-    dev = tree.global_config['devices'][0]
-    cmd_opts = ['bmrt_test', iter_opt, str(rounds), '--dev', str(dev)]
     if rt_cmp and os.path.exists(ref_fn) and os.path.getsize(ref_fn):
         logging.info(f'Runtime test {full_name}')
-        pool.put(
-            title,
-            [*cmd_opts, '--context', bmodel_dir],
-            shell=False)
+        model_opts = ['--context', bmodel_dir]
     else:
         logging.info(f'Runtime test {full_name} without reference')
+        model_opts = ['--bmodel', bmodel]
+
+    from math import nan
+    abort_ratio = config.get(
+        'time_abort_ratio', tree.global_config.get('time_abort_ratio'))
+    sample_interval = config.get(
+        'sample_interval', tree.global_config.get('sample_interval', 0.5))
+
+    cache_key = None
+    if run_cache is not None:
+        # Everything the row depends on, except the device
+        bmrt_test = shutil.which('bmrt_test', path=pool.env.get('PATH'))
+        bmrt_stat = os.stat(bmrt_test) if bmrt_test else None
+        # With --context, bmrt_test also reads and checks the data files
+        data_files = [
+            os.path.join(bmodel_dir, fn)
+            for fn in ['input_ref_data.dat', 'output_ref_data.dat']] \
+            if '--context' in model_opts else []
+        cache_key = run_cache.make_key(
+            bmodel=file_sha256(bmodel),
+            data={
+                os.path.basename(fn): file_sha256(fn)
+                for fn in data_files if os.path.exists(fn)},
+            options=[iter_opt, rounds, chunk, rel_error, abort_ratio, model_opts],
+            target=tree.global_config['target'],
+            env=[env, pool.env.get('LD_LIBRARY_PATH')],
+            bmrt_test=bmrt_stat and
+                [bmrt_test, bmrt_stat.st_size, bmrt_stat.st_mtime_ns],
+            profile=info,
+            row=[config['name'], [config.get(k, '') for k in extra],
+                config.get('gops'), config.get('prec'), b,
+                option_cmodel_stats, sample_interval])
+        row = run_cache.get(cache_key)
+        if row is not None:
+            logging.info(f'Reuse cached result of {full_name}')
+            return row
+    parser = StatsParser(abort_ratio)
+    # Per iteration calculate time in seconds
+    samples = Average()
+    iterations = 0
+    chunks = 0
+    failed = False
+    aborted = False
+    run_start = time.monotonic()
+    usage = []
+    while iterations < rounds:
+        loops = min(chunk, rounds - iterations)
         pool.put(
             title,
-            [*cmd_opts, '--bmodel', bmodel],
+            ['bmrt_test', iter_opt, str(loops), '--dev', str(dev), *model_opts],
             shell=False)
-    try:
-        pool.fire()
-        pid = pool.pipes[0].pid
-        p = psutil.Process(pid)
-        cpu_percent = p.cpu_percent(interval=1) / 100
-        pool.drain()
-        pool.procs.clear()
-    except RuntimeError:
-        logging.error(f'Runtime test {full_name} failed')
-
-    log_fn = os.path.join(workdir, f'{title}.log')
-    with open(log_fn) as f:
-        stats = parse_stats(f.read())
-    from math import nan
-    real_time = stats['calculate'] * 1000 if 'calculate' in stats else nan
-    if 'calculate_times' in iter_opt:
-        real_time /= rounds
+        seen = parser.iterations
+        failed = False
+        sampler = None
+        try:
+            pool.fire(pipe=True, append=chunks > 0)
+            sampler = ProcessSampler(
+                pool.pipes[0].pid, sample_interval, run_start)
+            last_report = time.monotonic()
+            for line in pool.tee():
+                parser.feed(line)
+                now = time.monotonic()
+                if now - last_report >= 10:
+                    last_report = now
+                    logging.info(
+                        f'{full_name}: {parser.iterations} iterations, '
+                        f'mean {parser.mean * 1000:.3f}ms')
+                if parser.anomaly and abort_ratio:
+                    logging.error(f'Abort {full_name}, {parser.anomaly}')
+                    aborted = True
+                    pool.pipes[0].kill()
+                    break
+            usage.extend(sampler.stop())
+            sampler = None
+            pool.drain()
+        except RuntimeError:
+            logging.error(f'Runtime test {full_name} failed')
+            failed = True
+        finally:
+            if sampler:
+                usage.extend(sampler.stop())
+            pool.procs.clear()
+        chunks += 1
+        if failed and 'calculate_times' not in iter_opt:
+            # Only the iterations before the failure
+            loops = parser.iterations - seen
+        iterations += loops
+        new_values = parser.times['calculate'].values[seen:] \
+            if 'calculate' in parser.times else []
+        if 'calculate_times' in iter_opt:
+            # One total over the loops
+            for v in new_values:
+                samples.put(v / loops)
+        else:
+            # Every chunk starts a new bmrt_test, whose first iteration runs
+            # on cold caches, keep it out of the samples
+            for v in new_values[1:] if len(new_values) > 1 else new_values:
+                samples.put(v)
+        if failed or aborted:
+            break
+        if not rel_error or chunks < 2 or samples.count < 2:
+            continue
+        if samples.confidence() <= rel_error * samples.get():
+            break
+    if rel_error and samples.count > 1:
+        logging.info(
+            f'{full_name} stopped after {iterations} iterations, '
+            f'relative error {samples.confidence() / samples.get():.2%}')
+
+    stats = parser.result()
+    write_samples(os.path.join(workdir, f'{title}.samples.csv'), usage)
+    cpu = Average()
+    rss = Average()
+    for _, c, r, _ in usage:
+        cpu.put(c)
+        rss.put(r / 1024**2)
+    # Runs too short to be sampled have no usage rather than nan%
+    cpu_usage = f'{cpu.get():.2%}' if cpu.count else 'N/A'
+    # Partial samples of a failed or aborted run are no measurement, keep
+    # them out of the table
+    timed = samples.count > 0 and not failed and not aborted
+    if not timed:
+        logging.warning(f'{full_name} has no complete timing, times are N/A')
+    real_time = samples.get() * 1000 if timed else nan
     row = [
         config['name'],
         *[config.get(k, '') for k in extra],
         stats['shape'],
         format_float(config['gops'] * b) if 'gops' in config else 'N/A',
-        format_float(real_time)]
+        format_float(real_time) if timed else 'N/A']
 
     # If profile exists, calculate mac & ddr utilization
     if tree.global_config['target'] == 'BM1684':
@@ -179,22 +567,43 @@ def run_model(tree, config, name, b, profile_path, bmodel, stat_f, extra):
             if option_cmodel_stats:
                 row.append('N/A')
         else:
-            row.append(f'{calc_mac_util(real_time):.2%}')
+            row.append(f'{calc_mac_util(real_time):.2%}' if timed else 'N/A')
             if option_cmodel_stats:
                 row.append(f'{calc_mac_util(est_time):.2%}')
-        row.insert(cpu_index, f'{cpu_percent:.2%}')
-        row.append(f'{calc_ddr_bandwidth(real_time):.2%}')
+        row.insert(cpu_index, cpu_usage)
+        row.append(f'{calc_ddr_bandwidth(real_time):.2%}' if timed else 'N/A')
         if option_cmodel_stats:
             row.append(f'{calc_ddr_bandwidth(est_time):.2%}')
     else:
         ext = ['N/A'] * (5 if option_cmodel_stats else 2)
         cpu_index = 2 if option_cmodel_stats else 1
-        ext.insert(cpu_index, f'{cpu_percent:.2%}')
+        ext.insert(cpu_index, cpu_usage)
         row.extend(ext)
 
-    stat_f.writerow(row)
+    # Host side stages, to tell input/output copies from TPU time
+    for k in ['load_input', 'get_output']:
+        row.append(format_float(stats[k] * 1000) if k in stats else 'N/A')
+    if timed:
+        for p in [50, 90, 99]:
+            row.append(format_float(samples.percentile(p) * 1000))
+        row.append(format_float(samples.stddev() * 1000))
+        row.append(format_float(samples.confidence() * 1000))
+    else:
+        row.extend(['N/A'] * 5)
+    row.append(str(int(iterations)))
+    row.append(f'{max(cpu.values):.2%}' if cpu.count else 'N/A')
+    row.append(f'{rss.get():.1f}' if rss.count else 'N/A')
+    row.append(f'{max(rss.values):.1f}' if rss.count else 'N/A')
+    row.append(str(sum(ctx for _, _, _, ctx in usage)))
+
+    if cache_key and timed:
+        # The bmodel path, full_name is not unique among the jobs
+        run_cache.put(cache_key, bmodel, row)
 
-def run_mlir(tree, path, raw_config, stat_f, extra):
+    return row
+
+def run_mlir(tree, path, raw_config, scheduler, extra):
+    jobs = []
     workdir = raw_config['workdir']
     for dirpath, dirnames, filenames in os.walk(workdir):
         for fn in filenames:
@@ -204,22 +613,29 @@ def run_mlir(tree, path, raw_config, stat_f, extra):
                 continue
             name = os.path.splitext(fn)[0]
             bmodel = os.path.join(dirpath, fn)
+            # Bmodels of the same name in different directories log apart
+            title = os.path.normpath(os.path.join(
+                os.path.relpath(dirpath, workdir), f'run.{name}'))
             profile_path = bmodel + '.compiler_profile_0.txt'
             config = raw_config.copy()
             config['name'] = name
             if 'prec' not in config:
                 config['prec'] = 'INT8' if 'int8' in name else 'FP32'
-            run_model(
+            jobs.append(scheduler.submit(
+                run_model,
                 tree, config,
                 name,
                 1,
                 profile_path,
                 bmodel,
-                stat_f, extra)
+                extra,
+                title))
+    return jobs
 
-def run_nntc(tree, path, raw_config, stat_f, extra):
+def run_nntc(tree, path, raw_config, scheduler, extra):
+    jobs = []
     if not raw_config.get('time', True):
-        return
+        return jobs
     workdir = raw_config['workdir']
 
     profile_fn = 'compiler_profile_0.dat' \
@@ -243,9 +659,9 @@ def run_nntc(tree, path, raw_config, stat_f, extra):
             profile_path = os.path.join(bmodel_dir, profile_fn)
             if 'prec' not in config:
                 config['prec'] = 'FP32'
-            run_model(
-                tree, config, name, b, profile_path,
-                bmodel, stat_f, extra)
+            jobs.append(scheduler.submit(
+                run_model, tree, config, name, b, profile_path,
+                bmodel, extra, f'run.{name}'))
 
     int8_loops = raw_config.get('int8_loops') or \
         tree.global_config.get('int8_loops') or [dict()]
@@ -264,9 +680,10 @@ def run_nntc(tree, path, raw_config, stat_f, extra):
             profile_path = os.path.join(bmodel_dir, profile_fn)
             if 'prec' not in config:
                 config['prec'] = 'INT8'
-            run_model(
-                tree, config, name, b, profile_path,
-                bmodel, stat_f, extra)
+            jobs.append(scheduler.submit(
+                run_model, tree, config, name, b, profile_path,
+                bmodel, extra, f'run.{name}'))
+    return jobs
 
 def collect_nntc_headers(tree, config):
     extra = set(['prec'])
@@ -292,6 +709,16 @@ def main():
     parser = argparse.ArgumentParser(description='tpu-perf benchmark tool')
     BuildTree.add_arguments(parser)
     parser.add_argument('--cmodel', action='store_true')
+    parser.add_argument(
+        '--rel-error', type=float,
+        help='Time each model until the 95%% confidence interval of '
+            'the mean is within this relative error')
+    parser.add_argument(
+        '--sample-interval', type=float,
+        help='Seconds between CPU and memory samples of bmrt_test')
+    parser.add_argument(
+        '--force', action='store_true',
+        help='Time every model again instead of reusing cached results')
     args = parser.parse_args()
     global option_cmodel_stats
     option_cmodel_stats = args.cmodel
@@ -300,6 +727,10 @@ def main():
         sys.exit(1)
 
     tree = BuildTree(os.path.abspath('.'), args)
+    if args.rel_error:
+        tree.global_config['time_rel_error'] = args.rel_error
+    if args.sample_interval:
+        tree.global_config['sample_interval'] = args.sample_interval
     stat_fn = os.path.join(tree.global_config['outdir'], 'stats.csv')
     extra = set()
     if args.mlir:
@@ -311,34 +742,73 @@ def main():
                 extra.add(k)
     extra = list(extra)
     extra.sort()
+    if option_cmodel_stats:
+        header = [
+            'name',
+            *extra,
+            'shape',
+            'gops',
+            'time(ms)',
+            'cmodel_estimated_time(ms)',
+            'mac_utilization',
+            'cpu_usage',
+            'cmodel_estimated_mac_utilization',
+            'ddr_utilization',
+            'cmodel_estimated_ddr_bandwidth',
+            'load_input_time(ms)',
+            'get_output_time(ms)',
+            'time_p50(ms)',
+            'time_p90(ms)',
+            'time_p99(ms)',
+            'time_stddev(ms)',
+            'time_ci(ms)',
+            'iterations',
+            'cpu_usage_peak',
+            'rss(MB)',
+            'rss_peak(MB)',
+            'ctx_switches']
+    else:
+        header = [
+            'name',
+            *extra,
+            'shape',
+            'gops',
+            'time(ms)',
+            'mac_utilization',
+            'cpu_usage',
+            'ddr_utilization',
+            'load_input_time(ms)',
+            'get_output_time(ms)',
+            'time_p50(ms)',
+            'time_p90(ms)',
+            'time_p99(ms)',
+            'time_stddev(ms)',
+            'time_ci(ms)',
+            'iterations',
+            'cpu_usage_peak',
+            'rss(MB)',
+            'rss_peak(MB)',
+            'ctx_switches']
+    global run_cache
+    # Rows cached with another header do not fit this one
+    run_cache = RunCache(
+        os.path.join(tree.global_config['outdir'], 'run_cache.json'),
+        args.force, header)
     with open(stat_fn, 'w') as f:
         csv_f = csv.writer(f)
-        if option_cmodel_stats:
-            csv_f.writerow([
-                'name',
-                *extra,
-                'shape',
-                'gops',
-                'time(ms)',
-                'cmodel_estimated_time(ms)',
-                'mac_utilization',
-                'cpu_usage',
-                'cmodel_estimated_mac_utilization',
-                'ddr_utilization',
-                'cmodel_estimated_ddr_bandwidth'])
-        else:
-            csv_f.writerow([
-                'name',
-                *extra,
-                'shape',
-                'gops',
-                'time(ms)',
-                'mac_utilization',
-                'cpu_usage',
-                'ddr_utilization'])
+        csv_f.writerow(header)
 
-        for path, config in tree.walk():
-            run_func(tree, path, config, csv_f, extra)
+        # Models run concurrently, one per device, but rows keep the tree order
+        try:
+            with DeviceScheduler(tree.global_config['devices']) as scheduler:
+                jobs = []
+                for path, config in tree.walk():
+                    jobs.extend(run_func(tree, path, config, scheduler, extra))
+                for job in jobs:
+                    csv_f.writerow(job.result())
+                    f.flush()
+        finally:
+            run_cache.flush()
 
 if __name__ == '__main__':
     main()
@@ -55,7 +55,7 @@ class CommandExecutor:
             else self.env
         self.procs.append((title, args, kw_args))
 
-    def fire(self, bulk = None):
+    def fire(self, bulk = None, pipe = False, append = False):
         if bulk is None:
             bulk = self.procs
         self.logs = []
@@ -67,16 +67,33 @@ class CommandExecutor:
                 pprint(kw_args, f)
                 f.write(f'\n\n---------------\n{args}\n')
             log_fn = os.path.join(kw_args['cwd'], f'{title}.log')
-            log = open(log_fn, 'w')
-            p = subprocess.Popen(*args, **kw_args, stdout=log, stderr=log)
+            log = open(log_fn, 'a' if append else 'w', errors='replace')
+            if pipe:
+                # Output goes through tee() into the log, undecodable bytes
+                # are replaced rather than failing the run
+                p = subprocess.Popen(
+                    *args, **kw_args, stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT, universal_newlines=True,
+                    errors='replace')
+            else:
+                p = subprocess.Popen(*args, **kw_args, stdout=log, stderr=log)
             self.logs.append((log_fn, log))
             self.pipes.append(p)
 
+    def tee(self, index = 0):
+        """Yields output lines of a piped process, also writing them to its log"""
+        log_fn, log = self.logs[index]
+        for line in self.pipes[index].stdout:
+            log.write(line)
+            yield line
+
     def drain(self):
         for i, p in enumerate(self.pipes):
             log_fn, log = self.logs[i]
             ret = p.wait()
             log.close()
+            if p.stdout:
+                p.stdout.close()
             if ret != 0:
                 logging.error(f'Command failed, please check {log_fn}')
                 raise RuntimeError('Command failed')
@@ -0,0 +1,71 @@
+import os
+import sys
+import glob
+import shutil
+import hashlib
+import subprocess
+import ctypes as ct
+import pytest
+
+# Run against the source tree. blob_pb2.py and libpipeline.so are build
+# outputs, see CMakeLists.txt.
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'python'))
+
+FAKE_SDK = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fake_sdk')
+
+
+def build_libpipeline(out_dir):
+    """
+    Builds libpipeline from pipeline/ against the host memory bmlib and
+    bmruntime of fake_sdk/, reusing the library while sources are unchanged.
+    """
+    sources = sorted(glob.glob(os.path.join(ROOT, 'pipeline', '*.cpp')))
+    sources.append(os.path.join(FAKE_SDK, 'fake_sdk.cpp'))
+    digest = hashlib.sha256()
+    for fn in sources + sorted(
+            glob.glob(os.path.join(ROOT, 'pipeline', '*.h')) +
+            glob.glob(os.path.join(FAKE_SDK, '*.h'))):
+        with open(fn, 'rb') as f:
+            digest.update(f.read())
+    lib = os.path.join(out_dir, 'libpipeline-{}.so'.format(
+        digest.hexdigest()[:16]))
+    if os.path.exists(lib):
+        return lib
+    tmp = lib + '.tmp'
+    cmd = ['g++', '-std=c++11', '-shared', '-fPIC', '-O1', '-g',
+           '-I', os.path.join(ROOT, 'pipeline'), '-I', FAKE_SDK,
+           '-o', tmp] + sources + ['-lpthread']
+    subprocess.run(cmd, check=True)
+    os.replace(tmp, lib)
+    return lib
+
+
+@pytest.fixture(scope='session')
+def libpipeline(request):
+    """libpipeline on fake devices, loaded into SGInfer."""
+    if shutil.which('g++') is None:
+        pytest.skip('g++ is needed to build libpipeline')
+    from tpu_perf.infer import SGInfer
+    path = build_libpipeline(str(request.config.cache.mkdir('libpipeline')))
+    lib = ct.cdll.LoadLibrary(path)
+    SGInfer._SGInfer__lib = lib
+    return lib
+
+
+@pytest.fixture
+def make_bmodel(tmp_path):
+    """
+    Writes a fake bmodel, a network copying its inputs to its outputs.
+    Inputs are (name, dtype, shape) with the SGTypeTuple dtype codes.
+    """
+    def make(net='idnet', inputs=(('data', 0, (1, 3, 4, 4)), )):
+        fn = tmp_path / '{}.{}.bmodel'.format(net, len(os.listdir(tmp_path)))
+        lines = ['net {}'.format(net)]
+        for name, dtype, shape in inputs:
+            lines.append('input {} {} {}'.format(
+                name, dtype, ' '.join(str(d) for d in shape)))
+        fn.write_text('\n'.join(lines) + '\n')
+        return str(fn)
+    return make
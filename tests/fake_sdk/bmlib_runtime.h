@@ -0,0 +1,34 @@
+// The parts of bmlib used by the pipeline, implemented on host memory by
+// fake_sdk.cpp so that libpipeline can be built and tested without devices
+#ifndef FAKE_BMLIB_RUNTIME_H
+#define FAKE_BMLIB_RUNTIME_H
+#include <stddef.h>
+#include <stdint.h>
+#include <stdlib.h>
+
+typedef enum {
+    BM_SUCCESS = 0,
+    BM_ERR_FAILURE = 1,
+} bm_status_t;
+
+struct bm_context;
+typedef struct bm_context* bm_handle_t;
+
+typedef struct {
+    unsigned long long addr;
+    unsigned size;
+} bm_device_mem_t;
+
+bm_status_t bm_dev_getcount(int* count);
+bm_status_t bm_dev_request(bm_handle_t* handle, int devid);
+void bm_dev_free(bm_handle_t handle);
+bm_status_t bm_malloc_device_byte(bm_handle_t handle, bm_device_mem_t* mem, unsigned size);
+void bm_free_device(bm_handle_t handle, bm_device_mem_t mem);
+unsigned long long bm_mem_get_device_addr(bm_device_mem_t mem);
+bm_device_mem_t bm_mem_null();
+bm_status_t bm_memcpy_d2s_partial(bm_handle_t handle, void* dst, bm_device_mem_t src, unsigned size);
+bm_status_t bm_memcpy_s2d_partial_offset(bm_handle_t handle, bm_device_mem_t dst, void* src,
+                                         unsigned size, unsigned offset);
+bm_status_t bm_thread_sync(bm_handle_t handle);
+
+#endif
@@ -0,0 +1,70 @@
+// The parts of bmruntime used by the pipeline, see fake_sdk.cpp
+#ifndef FAKE_BMRUNTIME_INTERFACE_H
+#define FAKE_BMRUNTIME_INTERFACE_H
+#include "bmlib_runtime.h"
+
+#define BM_MAX_DIMS_NUM 8
+
+typedef enum bm_data_type_e {
+    BM_FLOAT32 = 0,
+    BM_FLOAT16 = 1,
+    BM_INT8 = 2,
+    BM_UINT8 = 3,
+    BM_INT16 = 4,
+    BM_UINT16 = 5,
+    BM_INT32 = 6,
+    BM_UINT32 = 7
+} bm_data_type_t;
+
+typedef enum {
+    BM_STORE_1N = 0,
+    BM_STORE_2N = 1,
+    BM_STORE_4N = 2
+} bm_store_mode_t;
+
+typedef struct {
+    int num_dims;
+    int dims[BM_MAX_DIMS_NUM];
+} bm_shape_t;
+
+typedef struct {
+    bm_data_type_t dtype;
+    bm_shape_t shape;
+    bm_device_mem_t device_mem;
+    bm_store_mode_t st_mode;
+} bm_tensor_t;
+
+typedef struct {
+    bm_shape_t* input_shapes;
+    bm_shape_t* output_shapes;
+} bm_stage_info_t;
+
+typedef struct {
+    const char* name;
+    bool is_dynamic;
+    int input_num;
+    char const** input_names;
+    bm_data_type_t* input_dtypes;
+    float* input_scales;
+    int output_num;
+    char const** output_names;
+    bm_data_type_t* output_dtypes;
+    float* output_scales;
+    int stage_num;
+    bm_stage_info_t* stages;
+} bm_net_info_t;
+
+void* bmrt_create(bm_handle_t handle);
+void bmrt_destroy(void* bmrt);
+void* bmrt_get_bm_handle(void* bmrt);
+bool bmrt_load_bmodel(void* bmrt, const char* bmodel);
+int bmrt_get_network_number(void* bmrt);
+void bmrt_get_network_names(void* bmrt, const char*** names);
+const bm_net_info_t* bmrt_get_network_info(void* bmrt, const char* name);
+bool bmrt_launch_tensor_ex(void* bmrt, const char* name, const bm_tensor_t* inputs, int input_num,
+                           bm_tensor_t* outputs, int output_num, bool user_mem, bool user_stmode);
+size_t bmrt_tensor_bytesize(const bm_tensor_t* tensor);
+size_t bmrt_tensor_device_size(const bm_tensor_t* tensor);
+unsigned long long bmrt_shape_count(const bm_shape_t* shape);
+
+#endif
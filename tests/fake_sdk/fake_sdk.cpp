@@ -0,0 +1,247 @@
+// Host memory implementation of the bmlib and bmruntime calls made by the
+// pipeline. Device memory is malloc'ed, and a "bmodel" is a text file
+// describing one network that copies its inputs to its outputs:
+//
+//     net <name>
+//     input <name> <dtype> <dim>...
+//
+// FAKE_BM_DEVICES sets the number of devices (2 by default) and
+// FAKE_BM_FORWARD_US makes every launch take that long. Launches on device
+// FAKE_BM_SLOW_DEVICE take FAKE_BM_SLOW_US instead.
+#include <atomic>
+#include <chrono>
+#include <fstream>
+#include <memory>
+#include <mutex>
+#include <sstream>
+#include <string>
+#include <thread>
+#include <vector>
+#include <string.h>
+#include "bmruntime_interface.h"
+
+struct bm_context {
+    int devid;
+};
+
+static std::atomic<int> liveRuntimes(0);
+
+static size_t dtypeLen(bm_data_type_t dtype) {
+    switch(dtype) {
+    case BM_INT8: case BM_UINT8: return 1;
+    case BM_FLOAT16: case BM_INT16: case BM_UINT16: return 2;
+    default: return 4;
+    }
+}
+
+static int envInt(const char* name, int value) {
+    const char* str = getenv(name);
+    return str ? atoi(str) : value;
+}
+
+bm_status_t bm_dev_getcount(int* count) {
+    *count = envInt("FAKE_BM_DEVICES", 2);
+    return BM_SUCCESS;
+}
+
+bm_status_t bm_dev_request(bm_handle_t* handle, int devid) {
+    int count;
+    bm_dev_getcount(&count);
+    if(devid < 0 || devid >= count) return BM_ERR_FAILURE;
+    *handle = new bm_context{devid};
+    return BM_SUCCESS;
+}
+
+void bm_dev_free(bm_handle_t handle) {
+    delete handle;
+}
+
+bm_status_t bm_malloc_device_byte(bm_handle_t, bm_device_mem_t* mem, unsigned size) {
+    mem->addr = (unsigned long long)malloc(size ? size : 1);
+    mem->size = size;
+    return mem->addr ? BM_SUCCESS : BM_ERR_FAILURE;
+}
+
+void bm_free_device(bm_handle_t, bm_device_mem_t mem) {
+    free((void*)mem.addr);
+}
+
+unsigned long long bm_mem_get_device_addr(bm_device_mem_t mem) {
+    return mem.addr;
+}
+
+bm_device_mem_t bm_mem_null() {
+    return bm_device_mem_t{0, 0};
+}
+
+bm_status_t bm_memcpy_d2s_partial(bm_handle_t, void* dst, bm_device_mem_t src, unsigned size) {
+    if(size > src.size) return BM_ERR_FAILURE;
+    memcpy(dst, (void*)src.addr, size);
+    return BM_SUCCESS;
+}
+
+bm_status_t bm_memcpy_s2d_partial_offset(bm_handle_t, bm_device_mem_t dst, void* src,
+                                         unsigned size, unsigned offset) {
+    if(offset + size > dst.size) return BM_ERR_FAILURE;
+    memcpy((char*)dst.addr + offset, src, size);
+    return BM_SUCCESS;
+}
+
+bm_status_t bm_thread_sync(bm_handle_t) {
+    return BM_SUCCESS;
+}
+
+struct FakeNet {
+    std::string name;
+    std::vector<std::string> inNames, outNames;
+    std::vector<const char*> inNamePtrs, outNamePtrs;
+    std::vector<bm_data_type_t> dtypes;
+    std::vector<float> scales;
+    std::vector<bm_shape_t> inShapes, outShapes;
+    bm_stage_info_t stage;
+    bm_net_info_t info;
+};
+
+struct FakeRuntime {
+    bm_handle_t handle;
+    std::mutex mut;
+    std::vector<std::unique_ptr<FakeNet>> nets;
+};
+
+static std::unique_ptr<FakeNet> parseBModel(const char* path) {
+    std::ifstream file(path);
+    if(!file) return nullptr;
+    std::unique_ptr<FakeNet> net(new FakeNet);
+    std::string line;
+    while(std::getline(file, line)) {
+        std::istringstream words(line);
+        std::string kind;
+        words >> kind;
+        if(kind == "net") {
+            words >> net->name;
+        } else if(kind == "input") {
+            std::string name;
+            int dtype;
+            bm_shape_t shape = {0, {0}};
+            words >> name >> dtype;
+            while(shape.num_dims < BM_MAX_DIMS_NUM && words >> shape.dims[shape.num_dims]) shape.num_dims++;
+            net->inNames.push_back(name);
+            net->outNames.push_back("output" + std::to_string(net->outNames.size()));
+            net->dtypes.push_back((bm_data_type_t)dtype);
+            net->scales.push_back(1);
+            net->inShapes.push_back(shape);
+            net->outShapes.push_back(shape);
+        }
+    }
+    if(net->name.empty() || net->inNames.empty()) return nullptr;
+    for(size_t i=0; i<net->inNames.size(); i++) {
+        net->inNamePtrs.push_back(net->inNames[i].c_str());
+        net->outNamePtrs.push_back(net->outNames[i].c_str());
+    }
+    net->stage.input_shapes = net->inShapes.data();
+    net->stage.output_shapes = net->outShapes.data();
+    bm_net_info_t& info = net->info;
+    info.name = net->name.c_str();
+    info.is_dynamic = false;
+    info.input_num = info.output_num = net->inNames.size();
+    info.input_names = net->inNamePtrs.data();
+    info.output_names = net->outNamePtrs.data();
+    info.input_dtypes = info.output_dtypes = net->dtypes.data();
+    info.input_scales = info.output_scales = net->scales.data();
+    info.stage_num = 1;
+    info.stages = &net->stage;
+    return net;
+}
+
+void* bmrt_create(bm_handle_t handle) {
+    auto runtime = new FakeRuntime;
+    runtime->handle = handle;
+    liveRuntimes++;
+    return runtime;
+}
+
+void bmrt_destroy(void* bmrt) {
+    delete (FakeRuntime*)bmrt;
+    liveRuntimes--;
+}
+
+void* bmrt_get_bm_handle(void* bmrt) {
+    return ((FakeRuntime*)bmrt)->handle;
+}
+
+bool bmrt_load_bmodel(void* bmrt, const char* bmodel) {
+    auto runtime = (FakeRuntime*)bmrt;
+    auto net = parseBModel(bmodel);
+    if(!net) return false;
+    std::lock_guard<std::mutex> guard(runtime->mut);
+    // like bmruntime, refuse networks whose name is already loaded
+    for(auto& loaded: runtime->nets) {
+        if(loaded->name == net->name) return false;
+    }
+    runtime->nets.push_back(std::move(net));
+    return true;
+}
+
+int bmrt_get_network_number(void* bmrt) {
+    auto runtime = (FakeRuntime*)bmrt;
+    std::lock_guard<std::mutex> guard(runtime->mut);
+    return runtime->nets.size();
+}
+
+void bmrt_get_network_names(void* bmrt, const char*** names) {
+    auto runtime = (FakeRuntime*)bmrt;
+    std::lock_guard<std::mutex> guard(runtime->mut);
+    *names = (const char**)malloc(sizeof(char*) * (runtime->nets.size() + 1));
+    for(size_t i=0; i<runtime->nets.size(); i++) {
+        (*names)[i] = runtime->nets[i]->name.c_str();
+    }
+}
+
+const bm_net_info_t* bmrt_get_network_info(void* bmrt, const char* name) {
+    auto runtime = (FakeRuntime*)bmrt;
+    std::lock_guard<std::mutex> guard(runtime->mut);
+    for(auto& net: runtime->nets) {
+        if(net->name == name) return &net->info;
+    }
+    return nullptr;
+}
+
+bool bmrt_launch_tensor_ex(void* bmrt, const char* name, const bm_tensor_t* inputs, int input_num,
+                           bm_tensor_t* outputs, int output_num, bool user_mem, bool) {
+    auto info = bmrt_get_network_info(bmrt, name);
+    if(!info || input_num != info->input_num || output_num != info->output_num) return false;
+    int forwardUs = envInt("FAKE_BM_FORWARD_US", 0);
+    auto handle = ((FakeRuntime*)bmrt)->handle;
+    if(handle && handle->devid == envInt("FAKE_BM_SLOW_DEVICE", -1)) {
+        forwardUs = envInt("FAKE_BM_SLOW_US", forwardUs);
+    }
+    if(forwardUs > 0) std::this_thread::sleep_for(std::chrono::microseconds(forwardUs));
+    for(int i=0; i<input_num; i++) {
+        size_t bytes = bmrt_tensor_bytesize(&inputs[i]);
+        outputs[i].shape = inputs[i].shape;
+        if(!user_mem) {
+            bm_malloc_device_byte(nullptr, &outputs[i].device_mem, bytes);
+        }
+        if(outputs[i].device_mem.size < bytes) return false;
+        memcpy((void*)outputs[i].device_mem.addr, (void*)inputs[i].device_mem.addr, bytes);
+    }
+    return true;
+}
+
+unsigned long long bmrt_shape_count(const bm_shape_t* shape) {
+    unsigned long long count = 1;
+    for(int i=0; i<shape->num_dims; i++) count *= shape->dims[i];
+    return count;
+}
+
+size_t bmrt_tensor_bytesize(const bm_tensor_t* tensor) {
+    return bmrt_shape_count(&tensor->shape) * dtypeLen(tensor->dtype);
+}
+
+size_t bmrt_tensor_device_size(const bm_tensor_t* tensor) {
+    return bmrt_tensor_bytesize(tensor);
+}
+
+extern "C" int fake_bm_live_runtimes() {
+    return liveRuntimes;
+}
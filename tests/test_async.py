@@ -0,0 +1,77 @@
+import time
+import asyncio
+import numpy as np
+import pytest
+
+from tpu_perf.infer import SGInfer, AsyncSGInfer
+
+
+@pytest.fixture
+def runner(libpipeline, make_bmodel):
+    return SGInfer(make_bmodel(), devices=[0])
+
+
+def sample(i):
+    return np.full((1, 3, 4, 4), i, dtype=np.float32)
+
+
+class SlowPut:
+    """Runner whose puts take a while, to cancel requests during them."""
+    def __init__(self, runner, delay):
+        self.runner = runner
+        self.delay = delay
+
+    def put(self, *inputs):
+        time.sleep(self.delay)
+        return self.runner.put(*inputs)
+
+    def wait_get(self, timeout):
+        return self.runner.wait_get(timeout)
+
+
+def test_concurrent_requests(runner):
+    front = AsyncSGInfer(runner, max_inflight=4)
+
+    async def main():
+        return await asyncio.gather(*(front.infer(sample(i))
+                                      for i in range(32)))
+
+    for i, (outputs, valid) in enumerate(asyncio.run(main())):
+        assert valid
+        np.testing.assert_array_equal(outputs[0], sample(i))
+    front.close()
+
+
+def test_close_fails_waiting_requests(runner, monkeypatch):
+    monkeypatch.setenv('FAKE_BM_FORWARD_US', '300000')
+    front = AsyncSGInfer(runner)
+
+    async def main():
+        task = asyncio.ensure_future(front.infer(sample(0)))
+        while not front.futures:
+            await asyncio.sleep(0.005)
+        front.close()
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(task, 1)
+        with pytest.raises(RuntimeError):
+            await front.infer(sample(1))
+
+    asyncio.run(main())
+
+
+def test_cancel_during_put_drops_result(runner):
+    front = AsyncSGInfer(SlowPut(runner, 0.05))
+
+    async def main():
+        task = asyncio.ensure_future(front.infer(sample(0)))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # the next request is not confused by the dropped result
+        outputs, _ = await front.infer(sample(1))
+        np.testing.assert_array_equal(outputs[0], sample(1))
+
+    asyncio.run(main())
+    assert not front.early and not front.discarded and not front.futures
+    front.close()
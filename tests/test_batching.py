@@ -0,0 +1,65 @@
+import time
+import numpy as np
+import pytest
+
+from tpu_perf.infer import SGInfer, BatchingSGInfer
+
+
+@pytest.fixture
+def runner(libpipeline, make_bmodel):
+    return SGInfer(make_bmodel(inputs=(('data', 0, (4, 3, 4, 4)), )),
+                   devices=[0])
+
+
+def sample(i, num=1):
+    return np.full((num, 3, 4, 4), i, dtype=np.float32)
+
+
+def test_requests_split_back(runner):
+    batcher = BatchingSGInfer(runner, max_latency=0.01)
+    assert batcher.batch_size == 4
+    futures = [batcher.submit(sample(i, 1 + i % 3)) for i in range(12)]
+    for i, future in enumerate(futures):
+        outputs, valid = future.result(5)
+        assert valid
+        np.testing.assert_array_equal(outputs[0], sample(i, 1 + i % 3))
+    stats = batcher.stats()
+    assert stats['samples'] == sum(1 + i % 3 for i in range(12))
+    assert 0 < stats['fill_ratio'] <= 1
+    batcher.close()
+
+
+def test_failed_put_fails_its_batch(runner, monkeypatch):
+    batcher = BatchingSGInfer(runner, max_latency=0.01)
+    put = runner.put
+    monkeypatch.setattr(runner, 'put', lambda *inputs: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        batcher.infer(sample(0))
+    # the batching thread survives the failure
+    monkeypatch.setattr(runner, 'put', put)
+    np.testing.assert_array_equal(batcher.infer(sample(1))[0][0], sample(1))
+    batcher.close()
+
+
+def test_close_fails_pending(runner, monkeypatch):
+    monkeypatch.setenv('FAKE_BM_FORWARD_US', '200000')
+    batcher = BatchingSGInfer(runner, max_latency=0.01)
+    futures = [batcher.submit(sample(i, 4)) for i in range(4)]
+    batcher.close()
+    for future in futures:
+        assert future.done()
+        if future.exception(0) is not None:
+            assert isinstance(future.exception(0), RuntimeError)
+    with pytest.raises(RuntimeError):
+        batcher.submit(sample(0))
+
+
+def test_close_with_unknown_result(runner):
+    batcher = BatchingSGInfer(runner, max_latency=0.01)
+    # a task put around the batcher has no batch to wait for
+    runner.put(sample(0, 4))
+    time.sleep(0.2)
+    start = time.monotonic()
+    batcher.close()
+    assert time.monotonic() - start < 2
+    assert not batcher.reader.is_alive()
@@ -0,0 +1,343 @@
+import gc
+import threading
+import time
+import weakref
+import numpy as np
+import pytest
+
+from tpu_perf.infer import SGInfer, SGInferRegistry, InputBufferPool
+
+
+@pytest.fixture
+def bmodel(libpipeline, make_bmodel):
+    return make_bmodel()
+
+
+def sample(i):
+    return np.full((1, 3, 4, 4), i, dtype=np.float32)
+
+
+@pytest.mark.parametrize('zero_copy', [False, True])
+def test_infer_one(bmodel, zero_copy):
+    runner = SGInfer(bmodel, devices=[0], zero_copy=zero_copy)
+    outputs, valid = runner.infer_one(sample(3))
+    assert valid
+    np.testing.assert_array_equal(outputs[0], sample(3))
+
+
+def test_zero_copy_outputs_outlive_task(bmodel):
+    runner = SGInfer(bmodel, devices=[0], zero_copy=True)
+    kept = [runner.infer_one(sample(i))[0][0] for i in range(8)]
+    # later tasks must not reuse memory still viewed by earlier outputs
+    for i in range(8, 16):
+        runner.infer_one(sample(i))
+    gc.collect()
+    for i, out in enumerate(kept):
+        assert out.base is not None
+        np.testing.assert_array_equal(out, sample(i))
+
+
+def test_zero_copy_release_with_last_view(bmodel):
+    runner = SGInfer(bmodel, devices=[0], zero_copy=True)
+    out = runner.infer_one(sample(1))[0][0]
+    view = out[0, 1:]
+    owner = weakref.ref(out.base.owner)
+    del out
+    gc.collect()
+    assert owner() is not None
+    np.testing.assert_array_equal(view, sample(1)[0, 1:])
+    del view
+    gc.collect()
+    assert owner() is None
+
+
+def test_copy_outputs_own_memory(bmodel):
+    runner = SGInfer(bmodel, devices=[0])
+    out = runner.infer_one(sample(2))[0][0]
+    assert not hasattr(out.base, 'owner')
+    out += 1
+    np.testing.assert_array_equal(out, sample(3))
+
+
+def test_input_pool(bmodel):
+    runner = SGInfer(bmodel, devices=[0])
+    pool = InputBufferPool(runner, size=2)
+    outputs = runner.infer_all([(sample(i), ) for i in range(10)],
+                               input_pool=pool)
+    for i, (out, ) in enumerate(outputs):
+        np.testing.assert_array_equal(out, sample(i))
+    pool.close()
+    assert not pool.busy
+
+
+def test_input_pools_share_runner(bmodel):
+    runner = SGInfer(bmodel, devices=[0])
+    pools = [InputBufferPool(runner, size=2) for _ in range(2)]
+    for i in range(20):
+        pools[i % 2].put(sample(i))
+        runner.get()
+    for pool in pools:
+        pool.close()
+
+
+def test_input_pool_checks_inputs(bmodel):
+    runner = SGInfer(bmodel, devices=[0])
+    pool = InputBufferPool(runner, size=1)
+    with pytest.raises(ValueError):
+        pool.put(np.zeros((3, 4, 4), dtype=np.float32))
+    with pytest.raises(ValueError):
+        pool.put(np.zeros((1, 3, 4, 4), dtype=np.float64))
+    with pytest.raises(ValueError):
+        pool.put(sample(0), sample(0))
+    # nothing was acquired by the rejected puts
+    assert pool.free == [0]
+
+
+def test_input_pool_close_wakes_acquire(bmodel):
+    runner = SGInfer(bmodel, devices=[0])
+    pool = InputBufferPool(runner, size=1)
+    pool.acquire()
+    errors = []
+
+    def acquire():
+        try:
+            pool.acquire()
+        except RuntimeError as err:
+            errors.append(err)
+
+    # the only buffer is held, so acquire waits until the pool closes
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    time.sleep(0.2)
+    assert thread.is_alive()
+    pool.close()
+    thread.join(5)
+    assert not thread.is_alive() and len(errors) == 1
+    assert pool.pool_id == 0
+
+
+def test_input_pool_runner_stopped(bmodel):
+    runner = SGInfer(bmodel, devices=[0])
+    pool = InputBufferPool(runner, size=1)
+    pool.acquire()
+    runner.stop()
+    # a stopped runner never gives buffers back
+    with pytest.raises(RuntimeError):
+        pool.acquire()
+    pool.close()
+
+
+def test_wait_get_timeout(bmodel):
+    runner = SGInfer(bmodel, devices=[0])
+    start = time.monotonic()
+    assert runner.wait_get(0.05) == (0, [], 0)
+    assert time.monotonic() - start >= 0.04
+
+
+def test_infer_all_order(bmodel, monkeypatch):
+    monkeypatch.setenv('FAKE_BM_FORWARD_US', '500')
+    runner = SGInfer(bmodel, devices=[0, 1])
+    samples = [(sample(i), ) for i in range(20)]
+    outputs = runner.infer_all(samples,
+                               key_func=lambda i, s: 'k{}'.format(i),
+                               out_func=lambda key, out: (key, out[0]))
+    for i, (key, out) in enumerate(outputs):
+        assert key == 'k{}'.format(i)
+        np.testing.assert_array_equal(out, sample(i))
+
+
+@pytest.mark.parametrize('ordered', [False, True])
+def test_infer_stream(bmodel, monkeypatch, ordered):
+    monkeypatch.setenv('FAKE_BM_FORWARD_US', '200')
+    runner = SGInfer(bmodel, devices=[0, 1])
+    seen = []
+
+    def samples():
+        for i in range(30):
+            # never more than max_inflight samples taken ahead of results
+            assert i - len(seen) <= 4
+            yield (sample(i), )
+
+    for key, (out, ) in runner.infer_stream(samples(), max_inflight=4,
+                                            ordered=ordered):
+        np.testing.assert_array_equal(out, sample(key))
+        seen.append(key)
+    assert sorted(seen) == list(range(30))
+    if ordered:
+        assert seen == list(range(30))
+
+
+def test_infer_stream_early_stop(bmodel):
+    runner = SGInfer(bmodel, devices=[0])
+    stream = runner.infer_stream(((sample(i), ) for i in range(100)),
+                                 max_inflight=8)
+    assert next(stream)[0] == 0
+    stream.close()
+    # results of the abandoned samples were drained
+    assert runner.wait_get(0.05)[0] == 0
+    np.testing.assert_array_equal(runner.infer_one(sample(5))[0][0],
+                                  sample(5))
+
+
+def test_registry_name_clash(libpipeline, make_bmodel):
+    registry = SGInferRegistry(devices=[0])
+    registry.load('a', make_bmodel('neta'))
+    registry.load('b', make_bmodel('netb'))
+    assert libpipeline.fake_bm_live_runtimes() == 1
+    # same network name, falls back to a runtime of its own
+    registry.load('c', make_bmodel('neta'))
+    assert libpipeline.fake_bm_live_runtimes() == 2
+    for i, name in enumerate(registry.names()):
+        outputs, valid = registry.infer_one(name, sample(i))
+        assert valid
+        np.testing.assert_array_equal(outputs[0], sample(i))
+    for name in registry.names():
+        registry.unload(name)
+    assert libpipeline.fake_bm_live_runtimes() == 0
+
+
+def test_stage_stats(bmodel, monkeypatch):
+    monkeypatch.setenv('FAKE_BM_FORWARD_US', '2000')
+    runner = SGInfer(bmodel, devices=[0, 1])
+    runner.infer_all([(sample(i), ) for i in range(20)])
+    stats = runner.stats()
+    assert {s['device'] for s in stats} == {0, 1}
+    for stage in ('pre-process', 'forward', 'post-process'):
+        assert sum(s['count'] for s in stats if s['stage'] == stage) == 20
+    for s in stats:
+        assert s['p50'] <= s['p90'] <= s['p99'] <= s['max']
+        assert sum(count for _, _, count in s['histogram']) == s['count']
+        bounds = [(lower, upper) for lower, upper, _ in s['histogram']]
+        assert bounds == sorted(bounds)
+        for lower, upper in bounds:
+            # log-linear buckets, a few percent wide
+            assert lower <= upper <= max(lower * 17 // 16, lower)
+        if s['stage'] == 'forward':
+            assert 2000 <= s['p50'] and 2000 <= s['mean'] <= s['max']
+    durations = runner.get_durations()
+    assert len(durations) == 3
+    assert durations[1] >= 20 * 2000
+
+
+def test_options_are_per_runner(bmodel):
+    with pytest.raises(KeyError):
+        SGInfer(bmodel, devices=[1], queue_type='bogus')
+    # nothing of the failed runner leaks into the next one
+    runner = SGInfer(bmodel)
+    runner.infer_all([(sample(i), ) for i in range(8)])
+    assert {s['device'] for s in runner.stats()} == {0, 1}
+
+
+def test_concurrent_runner_start(bmodel):
+    runners = [None] * 8
+
+    def start(i):
+        runners[i] = SGInfer(bmodel, devices=[i % 2],
+                             queue_type=('locked', 'ring')[i % 2])
+
+    threads = [threading.Thread(target=start, args=(i, )) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for i, runner in enumerate(runners):
+        runner.infer_one(sample(i))
+        assert {s['device'] for s in runner.stats()} == {i % 2}
+
+
+def test_start_stop_while_inferring(bmodel):
+    runner = SGInfer(bmodel, devices=[0])
+    done = threading.Event()
+
+    def churn():
+        while not done.is_set():
+            SGInfer(bmodel, devices=[1]).stop()
+
+    thread = threading.Thread(target=churn)
+    thread.start()
+    try:
+        for i in range(200):
+            np.testing.assert_array_equal(runner.infer_one(sample(i))[0][0],
+                                          sample(i))
+    finally:
+        done.set()
+        thread.join()
+
+
+def forward_counts(runner):
+    return {s['device']: s['count']
+            for s in runner.stats() if s['stage'] == 'forward'}
+
+
+def stream_slow_device(bmodel, monkeypatch, schedule):
+    # device 1 is 30 times slower than device 0
+    monkeypatch.setenv('FAKE_BM_FORWARD_US', '100')
+    monkeypatch.setenv('FAKE_BM_SLOW_DEVICE', '1')
+    monkeypatch.setenv('FAKE_BM_SLOW_US', '3000')
+    runner = SGInfer(bmodel, devices=[0, 1], schedule=schedule)
+    samples = ((sample(i), ) for i in range(60))
+    seen = []
+    for key, (out, ) in runner.infer_stream(samples, max_inflight=4):
+        np.testing.assert_array_equal(out, sample(key))
+        seen.append(key)
+    assert sorted(seen) == list(range(60))
+    counts = forward_counts(runner)
+    assert sum(counts.values()) == 60
+    return counts
+
+
+def test_schedule_round_robin(bmodel, monkeypatch):
+    counts = stream_slow_device(bmodel, monkeypatch, 'round_robin')
+    # the slow device still gets every other task
+    assert counts == {0: 30, 1: 30}
+
+
+def test_schedule_least_outstanding(bmodel, monkeypatch):
+    counts = stream_slow_device(bmodel, monkeypatch, 'least_outstanding')
+    # tasks pile up on the slow device, so it is picked less often
+    assert counts[1] < counts[0]
+
+
+def test_schedule_latency_weighted(bmodel, monkeypatch):
+    counts = stream_slow_device(bmodel, monkeypatch, 'latency_weighted')
+    # once measured, a slow task costs 30 fast ones
+    assert counts[1] * 4 < counts[0]
+
+
+@pytest.mark.parametrize('kwargs', [
+    dict(buffer_depth=0), dict(queue_capacity=-1),
+    dict(pre_workers=0), dict(post_workers=0)])
+def test_bad_pipeline_options(bmodel, kwargs):
+    with pytest.raises(ValueError):
+        SGInfer(bmodel, **kwargs)
+
+
+@pytest.mark.parametrize('devices', [[0], [0, 1]])
+def test_parallel_stage_workers(bmodel, monkeypatch, devices):
+    monkeypatch.setenv('FAKE_BM_FORWARD_US', '200')
+    runner = SGInfer(bmodel, devices=devices, pre_workers=3, post_workers=3)
+    task_ids = [runner.put(sample(i)) for i in range(40)]
+    results = [runner.get() for _ in task_ids]
+    got = [task_id for task_id, _, _ in results]
+    assert sorted(got) == task_ids
+    if len(devices) == 1:
+        # the workers of a stage retire their tasks in order
+        assert got == task_ids
+    for task_id, (out, ), valid in results:
+        assert valid
+        np.testing.assert_array_equal(out, sample(task_ids.index(task_id)))
+    counts = [s['count'] for s in runner.stats() if s['stage'] == 'post-process']
+    assert sum(counts) == len(task_ids)
+
+
+def test_pipeline_depth(bmodel):
+    runner = SGInfer(bmodel, buffer_depth=1, queue_capacity=2)
+    outputs = runner.infer_all([(sample(i), ) for i in range(10)])
+    for i, (out, ) in enumerate(outputs):
+        np.testing.assert_array_equal(out, sample(i))
+
+
+def test_show_stage_depths(bmodel, capfd):
+    runner = SGInfer(bmodel, devices=[0], buffer_depth=2, pre_workers=3)
+    runner.show()
+    assert 'buffer_depth=2 (pre-process 4, forward 2)' in capfd.readouterr().out
@@ -0,0 +1,261 @@
+import multiprocessing
+import numpy as np
+import pytest
+
+from tpu_perf import blob_pb2
+from tpu_perf.io import array_to_datum, array_to_datum_str, \
+    array_to_blobproto, arraylist_to_blobprotovector_str, blob_to_array, \
+    iter_blobprotovector, ufw_dtype, datum_str_to_array, lmdb_data, lmdb_prefetch, LMDB_Dataset, \
+    LMDB_IndexedDataset, Transformer, ResizePlan, resize_image, resize_plan, \
+    oversample, oversample_views, iter_oversample
+
+ARRAYS = [
+    (np.random.rand(3, 5, 7).astype(np.float32), 7, False),
+    (np.random.rand(3, 5, 7).astype(np.float32), -2, True),
+    (np.random.rand(4, 4).astype(np.float32)[:, ::-1], None, False),
+    (np.float32(3).reshape(()), 0, False),
+    (np.random.randint(0, 255, (3, 300, 2)).astype(np.uint8), None, False),
+    (np.arange(10, dtype=np.int32).reshape(2, 5) - 5, 2**31 - 1, False),
+]
+
+
+@pytest.mark.parametrize('arr,label,raw', ARRAYS)
+def test_datum_str_matches_protobuf(arr, label, raw):
+    value = array_to_datum_str(arr, label, raw)
+    assert value == array_to_datum(arr, label, raw).SerializeToString()
+    for copy in (True, False):
+        out = datum_str_to_array(value, copy)
+        assert out.dtype == arr.dtype
+        np.testing.assert_array_equal(out, arr)
+
+
+def reference_blobproto(arr):
+    # field by field encoding the bulk encoder must reproduce
+    blob = blob_pb2.BlobProto()
+    blob.shape.dim.extend(arr.shape)
+    blob.dtype = ufw_dtype[arr.dtype]
+    if arr.dtype in (np.float32, np.float16):
+        blob.data.extend(arr.flat)
+    else:
+        blob.int32_data.extend(int(v) for v in arr.flat)
+    return blob
+
+
+BLOB_ARRAYS = [
+    np.float32(-1.5).reshape(()),
+    np.random.rand(7).astype(np.float32),
+    np.random.rand(2, 3, 4, 5).astype(np.float32),
+    np.random.rand(3, 4).astype(np.float16),
+    np.int8(-3).reshape(()),
+    np.random.randint(-128, 128, (4, 6)).astype(np.int8),
+    np.random.randint(0, 256, (2, 3, 5)).astype(np.uint8),
+    np.random.randint(-2**15, 2**15, (9, )).astype(np.int16),
+    np.array([0, 1, -1, 63, -64, 64, 2**31 - 1, -2**31], dtype=np.int32),
+]
+
+
+@pytest.mark.parametrize('arr', BLOB_ARRAYS, ids=lambda a: str(a.shape))
+def test_blobproto_matches_protobuf(arr):
+    ref = reference_blobproto(arr).SerializeToString()
+    assert array_to_blobproto(arr).SerializeToString() == ref
+    out = blob_to_array(reference_blobproto(arr))
+    expected = np.float32 if arr.dtype.kind == 'f' else np.int32
+    assert out.dtype == expected
+    # scalars come back with shape (1, )
+    np.testing.assert_array_equal(out, arr.reshape(out.shape))
+
+
+def test_blobprotovector_matches_protobuf(tmp_path):
+    vec = blob_pb2.BlobProtoVector()
+    for arr in BLOB_ARRAYS:
+        vec.blobs.add().CopyFrom(reference_blobproto(arr))
+    ref = vec.SerializeToString()
+    assert arraylist_to_blobprotovector_str(BLOB_ARRAYS) == ref
+    path = tmp_path / 'vec.bin'
+    path.write_bytes(ref)
+    for source in (ref, str(path)):
+        arrays = list(iter_blobprotovector(source))
+        assert len(arrays) == len(BLOB_ARRAYS)
+        for out, arr in zip(arrays, BLOB_ARRAYS):
+            np.testing.assert_array_equal(out, blob_to_array(
+                reference_blobproto(arr)))
+
+
+def test_blob_to_array_scalar():
+    out = blob_to_array(reference_blobproto(np.float32(2.5).reshape(())))
+    assert isinstance(out, np.ndarray)
+    assert out.shape == (1, ) and out[0] == 2.5
+
+
+def test_datum_str_to_array_is_writable():
+    arr = np.arange(24, dtype=np.uint8).reshape(2, 3, 4)
+    out = datum_str_to_array(array_to_datum_str(arr, raw=True))
+    out -= 1
+    np.testing.assert_array_equal(out, arr - 1)
+    view = datum_str_to_array(array_to_datum_str(arr, raw=True), copy=False)
+    assert not view.flags.writeable
+
+
+@pytest.mark.parametrize('raw', [False, True])
+def test_lmdb_dataset_reused_buffer(tmp_path, raw):
+    buf = np.empty((3, 8, 8), dtype=np.float32)
+    with LMDB_Dataset(str(tmp_path), queue_size=16, raw=raw) as db:
+        for i in range(200):
+            buf[...] = i
+            db.put(buf, i)
+    records = list(lmdb_data(str(tmp_path)))
+    assert len(records) == 200
+    for i, (_, arr) in enumerate(records):
+        assert (arr == i).all()
+
+
+def test_indexed_dataset_reopen(tmp_path):
+    with LMDB_Dataset(str(tmp_path)) as db:
+        for i in range(10):
+            db.put(np.full((2, 2), i, dtype=np.uint8), i)
+    with LMDB_IndexedDataset(str(tmp_path)) as ds:
+        assert len(ds) == 10
+    ds = LMDB_IndexedDataset(str(tmp_path))
+    shard = ds.shard(1, 2)
+    del ds
+    # the shard keeps the environment open
+    assert [int(a[0, 0]) for _, a in shard] == [5, 6, 7, 8, 9]
+    del shard
+    ds = LMDB_IndexedDataset(str(tmp_path))
+    assert int(ds[3][1][0, 0]) == 3
+
+
+@pytest.fixture
+def prefetch_db(tmp_path):
+    with LMDB_Dataset(str(tmp_path)) as db:
+        for i in range(50):
+            db.put(np.full((2, 3), i, dtype=np.int32), i)
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize('ordered', [True, False])
+def test_lmdb_prefetch(prefetch_db, ordered):
+    records = list(lmdb_prefetch(prefetch_db, workers=3, ordered=ordered,
+                                 chunk_size=7))
+    ref = list(lmdb_data(prefetch_db))
+    if not ordered:
+        records.sort(key=lambda r: r[0])
+    assert [k for k, _ in records] == [k for k, _ in ref]
+    for (_, arr), (_, ref_arr) in zip(records, ref):
+        np.testing.assert_array_equal(arr, ref_arr)
+    assert not multiprocessing.active_children()
+
+
+def test_lmdb_prefetch_batches(prefetch_db):
+    # chunks are rounded up to whole batches, only the last one is partial
+    batches = list(lmdb_prefetch(prefetch_db, workers=2, batch_size=4,
+                                 chunk_size=6))
+    assert [len(keys) for keys, _ in batches] == [4] * 12 + [2]
+    arrays = np.concatenate([arr for _, arr in batches])
+    assert arrays.shape == (50, 2, 3)
+    np.testing.assert_array_equal(arrays[:, 0, 0], np.arange(50))
+
+
+def test_lmdb_prefetch_early_close(prefetch_db):
+    records = lmdb_prefetch(prefetch_db, workers=2, chunk_size=5)
+    next(records)
+    records.close()
+    # the workers exit instead of lingering with the dataset open
+    assert not multiprocessing.active_children()
+
+
+@pytest.mark.parametrize('backend', ['skimage', 'separable'])
+@pytest.mark.parametrize('size', [8, 12])
+def test_preprocess_batch_matches_preprocess(backend, size):
+    t = Transformer({'data': (4, 3, 8, 8)})
+    t.set_transpose('data', (2, 0, 1))
+    t.set_channel_swap('data', (2, 1, 0))
+    t.set_raw_scale('data', 255)
+    t.set_mean('data', np.array([104., 117.5, 123.]))
+    t.set_input_scale('data', 0.017)
+    t.set_resize_backend('data', backend)
+    images = np.random.rand(4, size, size, 3).astype(np.float32)
+    ref = np.stack([t.preprocess('data', im) for im in images])
+    np.testing.assert_array_equal(t.preprocess_batch('data', images), ref)
+    out = np.empty_like(ref)
+    assert t.preprocess_batch('data', list(images), out) is out
+    np.testing.assert_array_equal(out, ref)
+    with pytest.raises(ValueError):
+        t.preprocess_batch('data', images, out[:, :2])
+    with pytest.raises(ValueError):
+        t.preprocess_batch('data', images[..., :2])
+    # the output shape does not depend on the images
+    empty = t.preprocess_batch('data', images[:0])
+    assert empty.shape == (0, 3, 8, 8) and empty.dtype == np.float32
+
+
+def reference_oversample(images, crop_dims):
+    """The copy then flip implementation oversample() replaced."""
+    im_shape = np.array(images[0].shape)
+    crop_dims = np.array(crop_dims)
+    im_center = im_shape[:2] / 2.0
+    h_indices = (0, im_shape[0] - crop_dims[0])
+    w_indices = (0, im_shape[1] - crop_dims[1])
+    crops_ix = np.empty((5, 4), dtype=int)
+    curr = 0
+    for i in h_indices:
+        for j in w_indices:
+            crops_ix[curr] = (i, j, i + crop_dims[0], j + crop_dims[1])
+            curr += 1
+    crops_ix[4] = np.tile(im_center, (1, 2)) + np.concatenate(
+        [-crop_dims / 2.0, crop_dims / 2.0])
+    crops_ix = np.tile(crops_ix, (2, 1))
+    crops = np.empty(
+        (10 * len(images), crop_dims[0], crop_dims[1], im_shape[-1]),
+        dtype=np.float32)
+    ix = 0
+    for im in images:
+        for crop in crops_ix:
+            crops[ix] = im[crop[0]:crop[2], crop[1]:crop[3], :]
+            ix += 1
+        crops[ix - 5:ix] = crops[ix - 5:ix, :, ::-1, :]
+    return crops
+
+
+@pytest.mark.parametrize('im_shape,crop_dims', [
+    ((8, 10, 3), (4, 6)), ((9, 7, 1), (4, 3)), ((11, 13, 2), (11, 5))])
+def test_oversample_matches_reference(im_shape, crop_dims):
+    images = [np.random.rand(*im_shape).astype(np.float32) for _ in range(5)]
+    ref = reference_oversample(images, crop_dims)
+    np.testing.assert_array_equal(oversample(images, crop_dims), ref)
+    out = np.empty_like(ref)
+    assert oversample(images, crop_dims, out) is out
+    np.testing.assert_array_equal(out, ref)
+    for n, im in enumerate(images):
+        views = oversample_views(im, crop_dims)
+        assert all(np.shares_memory(v, im) for v in views)
+        np.testing.assert_array_equal(np.stack(views),
+                                      ref[10 * n:10 * (n + 1)])
+    for batch_size in (1, 2, 5):
+        batches = [b.copy() for b in
+                   iter_oversample(iter(images), crop_dims, batch_size)]
+        np.testing.assert_array_equal(np.concatenate(batches), ref)
+
+
+def test_oversample_checks_out():
+    images = [np.random.rand(8, 8, 3).astype(np.float32)] * 2
+    with pytest.raises(ValueError):
+        oversample(images, (4, 4), np.empty((10, 4, 4, 3), np.float32))
+    with pytest.raises(ValueError):
+        oversample(images, (4, 4), np.empty((20, 4, 4, 3), np.float64))
+
+
+@pytest.mark.parametrize('order', [0, 1])
+@pytest.mark.parametrize('src', [(40, 50), (100, 150), (64, 30)])
+def test_resize_plan_matches_skimage(order, src):
+    pytest.importorskip('skimage')
+    im = np.random.rand(src[0], src[1], 3).astype(np.float32)
+    ref = resize_image(im, (32, 32), interp_order=order)
+    res = resize_plan(src, (32, 32), order)(im)
+    # skimage pads with zeros where the plan clamps
+    np.testing.assert_allclose(res[6:-6, 6:-6], ref[6:-6, 6:-6], atol=1e-6)
+
+
+def test_resize_plan_order():
+    with pytest.raises(ValueError, match='order'):
+        ResizePlan((4, 4), (2, 2), order=3)
@@ -0,0 +1,248 @@
+import os
+import sys
+import csv
+import json
+import time
+import threading
+import subprocess
+import pytest
+
+from tpu_perf.run import DeviceScheduler, ProcessSampler, RunCache, t_value
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Prints the bmrt_test lines run.py parses and records how it was called,
+# FAKE_BMRT_FAIL_AFTER makes it fail after that many iterations
+FAKE_BMRT_TEST = '''#!{python}
+import os, sys, json, time
+args = sys.argv[1:]
+loops = int(args[args.index('--loopnum') + 1])
+fail_after = int(os.environ.get('FAKE_BMRT_FAIL_AFTER', -1))
+start = time.time()
+print("[BMRT] Input 0) 'data' shape=[ 1 3 4 4 ]", flush=True)
+for i in range(loops):
+    if i == fail_after:
+        sys.exit(1)
+    time.sleep(0.002)
+    # the first iteration is slow, like on cold caches
+    print('[BMRT] INFO:calculate  time(s): {{}}'.format(
+        0.05 if i == 0 else 0.002), flush=True)
+with open(os.environ['FAKE_BMRT_CALLS'], 'a') as f:
+    f.write(json.dumps(dict(
+        args=args, start=start, end=time.time(),
+        profile=os.environ.get('BMRUNTIME_PROFILE_OUT_DIR'))) + '\\n')
+'''
+
+
+@pytest.fixture
+def bmrt_test(tmp_path, monkeypatch):
+    """Fake bmrt_test on PATH, returns the function reading its calls."""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    fn = bin_dir / 'bmrt_test'
+    fn.write_text(FAKE_BMRT_TEST.format(python=sys.executable))
+    fn.chmod(0o755)
+    calls = tmp_path / 'calls.jsonl'
+    monkeypatch.setenv('PATH', f'{bin_dir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('FAKE_BMRT_CALLS', str(calls))
+
+    def read():
+        with open(calls) as f:
+            return [json.loads(line) for line in f]
+    return read
+
+
+def run_tree(tree, *args):
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, 'python'))
+    subprocess.run(
+        [sys.executable, '-m', 'tpu_perf.run', '--full', *args],
+        cwd=tree, env=env, check=True, capture_output=True)
+    with open(tree / 'output' / 'stats.csv') as f:
+        return list(csv.DictReader(f))
+
+
+@pytest.fixture
+def mlir_tree(tmp_path):
+    """An mlir model with two bmodels of the same file name"""
+    tree = tmp_path / 'tree'
+    (tree / 'm1').mkdir(parents=True)
+    (tree / 'config.yaml').write_text('{}\n')
+    (tree / 'm1' / 'config.yaml').write_text(
+        'name: m1\ndeploy: x\ngops: 1.0\ntime_rounds: 5\n')
+    for sub in ['a', 'b']:
+        (tree / 'output' / 'm1' / sub).mkdir(parents=True)
+        (tree / 'output' / 'm1' / sub / 'net.bmodel').write_text(sub)
+    return tree
+
+
+def test_same_bmodel_names(mlir_tree, bmrt_test):
+    rows = run_tree(mlir_tree, '--mlir', '-d', '0', '0', '1')
+    assert [r['name'] for r in rows] == ['net', 'net']
+    # runs shorter than the sample interval
+    assert not any('nan' in v for r in rows for v in r.values())
+    assert all(r['rss(MB)'] != '0.0' for r in rows)
+    assert all(r['iterations'] == '5' for r in rows)
+    calls = bmrt_test()
+    assert len(calls) == 2
+    # both rows are cached although the jobs share their name
+    with open(mlir_tree / 'output' / 'run_cache.json') as f:
+        assert len(json.load(f)) == 2
+    workdir = mlir_tree / 'output' / 'm1'
+    profiles = {c['profile'] for c in calls}
+    assert profiles == {
+        str(workdir / sub / 'run.net.profiledata') for sub in ['a', 'b']}
+    for sub in ['a', 'b']:
+        with open(workdir / sub / 'run.net.log') as f:
+            assert f.read().count('calculate') == 5
+        assert (workdir / sub / 'run.net.samples.csv').exists()
+    # device 0 listed twice still runs one job at a time
+    devices = {}
+    for c in calls:
+        devices.setdefault(c['args'][c['args'].index('--dev') + 1], []).append(c)
+    for dev_calls in devices.values():
+        dev_calls.sort(key=lambda c: c['start'])
+        for prev, cur in zip(dev_calls, dev_calls[1:]):
+            assert prev['end'] <= cur['start']
+
+
+def test_scheduler_dedupes_devices():
+    running = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def job(i, dev):
+        with lock:
+            overlaps.append(dev in running)
+            running.append(dev)
+        time.sleep(0.02)
+        with lock:
+            running.remove(dev)
+        return dev
+
+    with DeviceScheduler([0, 0, 1, 1]) as scheduler:
+        jobs = [scheduler.submit(job, i) for i in range(8)]
+    assert {j.result() for j in jobs} == {0, 1}
+    assert not any(overlaps)
+    with pytest.raises(ValueError):
+        DeviceScheduler([])
+
+
+def test_adaptive_skips_first_iterations(mlir_tree, bmrt_test):
+    (mlir_tree / 'm1' / 'config.yaml').write_text(
+        'name: m1\ndeploy: x\ngops: 1.0\n'
+        'time_rounds: 40\ntime_rel_error: 0.01\n')
+    rows = run_tree(mlir_tree, '--mlir')
+    for row in rows:
+        # two chunks of 4, their first iterations are not timed
+        assert row['iterations'] == '8'
+        assert row['time(ms)'] == '2.000'
+        assert row['time_p99(ms)'] == '2.000'
+    assert len(bmrt_test()) == 4
+
+
+def test_t_value_between_table_rows():
+    assert t_value(30) == t_value(35) == 2.042
+    assert t_value(40) == 2.021
+    assert t_value(100) == 2.000
+    assert t_value(10000) == 1.980
+
+
+def test_sampler_short_run():
+    proc = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(0.3)'])
+    sampler = ProcessSampler(proc.pid, interval=10)
+    time.sleep(0.1)
+    samples = sampler.stop()
+    proc.wait()
+    assert len(samples) == 1
+    t, cpu, rss, ctx = samples[0]
+    assert 0 < t < 10 and rss > 0
+
+
+def test_run_cache_batches_writes(tmp_path):
+    fn = str(tmp_path / 'cache.json')
+    cache = RunCache(fn, schema=['a', 'b'], save_interval=3600)
+    key = cache.make_key(bmodel='x')
+    cache.put(key, 'm1', ['m1', '1.0'])
+    assert not os.path.exists(fn)
+    cache.flush()
+    assert os.listdir(tmp_path) == ['cache.json']
+    assert RunCache(fn, schema=['a', 'b']).get(key) == ['m1', '1.0']
+    # rows of another layout are not reused
+    assert RunCache(fn, schema=['a']).make_key(bmodel='x') != key
+    assert RunCache(fn, force=True, schema=['a', 'b']).get(key) is None
+
+
+def test_run_cache_prunes_stale_rows(tmp_path):
+    fn = str(tmp_path / 'cache.json')
+    cache = RunCache(fn)
+    old = cache.make_key(bmodel='v1')
+    cache.put(old, 'a.bmodel', ['a', '1.0'])
+    cache.put(cache.make_key(bmodel='b'), 'b.bmodel', ['b', '2.0'])
+    new = cache.make_key(bmodel='v2')
+    cache.put(new, 'a.bmodel', ['a', '3.0'])
+    cache.flush()
+    cache = RunCache(fn)
+    assert cache.get(old) is None
+    assert cache.get(new) == ['a', '3.0']
+    assert len(cache.entries) == 2
+
+
+def test_run_cache_context_data(tmp_path, bmrt_test):
+    tree = tmp_path / 'tree'
+    (tree / 'm1').mkdir(parents=True)
+    (tree / 'config.yaml').write_text('{}\n')
+    (tree / 'm1' / 'config.yaml').write_text(
+        'name: m1\nbmnetu_options: x\nruntime_cmp: true\ntime_rounds: 5\n')
+    bmodel_dir = tree / 'output' / 'm1' / '1b.compilation'
+    bmodel_dir.mkdir(parents=True)
+    (bmodel_dir / 'compilation.bmodel').write_text('model')
+    (bmodel_dir / 'input_ref_data.dat').write_text('input')
+    (bmodel_dir / 'output_ref_data.dat').write_text('output')
+    rows = run_tree(tree)
+    assert run_tree(tree) == rows
+    assert len(bmrt_test()) == 1
+    assert '--context' in bmrt_test()[0]['args']
+    # new reference data is checked again
+    (bmodel_dir / 'input_ref_data.dat').write_text('other input')
+    run_tree(tree)
+    assert len(bmrt_test()) == 2
+    # the row of the old reference data is replaced
+    with open(tree / 'output' / 'run_cache.json') as f:
+        assert len(json.load(f)) == 1
+    run_tree(tree, '--cmodel')
+    assert len(bmrt_test()) == 3
+
+
+def test_samples_of_exiting_process(mlir_tree, bmrt_test):
+    (mlir_tree / 'm1' / 'config.yaml').write_text(
+        'name: m1\ndeploy: x\ngops: 1.0\ntime_rounds: 150\n')
+    rows = run_tree(mlir_tree, '--mlir', '--sample-interval', '0.05')
+    for row in rows:
+        assert float(row['rss(MB)']) > 0
+        assert float(row['rss_peak(MB)']) >= float(row['rss(MB)'])
+    for sub in ['a', 'b']:
+        fn = mlir_tree / 'output' / 'm1' / sub / 'run.net.samples.csv'
+        with open(fn) as f:
+            samples = list(csv.DictReader(f))
+        assert samples
+        assert all(float(s['rss(MB)']) > 0 for s in samples)
+
+
+def test_failed_run_has_no_times(mlir_tree, bmrt_test, monkeypatch):
+    monkeypatch.setenv('FAKE_BMRT_FAIL_AFTER', '3')
+    rows = run_tree(mlir_tree, '--mlir')
+    assert len(rows) == 2
+    for row in rows:
+        # the iterations before the failure are counted but not reported
+        assert row['iterations'] == '3'
+        for k in ['time(ms)', 'mac_utilization', 'ddr_utilization',
+                  'time_p50(ms)', 'time_p99(ms)', 'time_stddev(ms)',
+                  'time_ci(ms)']:
+            assert row[k] == 'N/A'
+
+
+def test_make_table_skips_na_times():
+    throughput = pytest.importorskip('tpu_perf.make_table').throughput
+    assert throughput('N/A', 1) == 'N/A'
+    assert throughput('nan', 1) == 'N/A'
+    assert throughput('2.000', 4) == 2000.0
@@ -0,0 +1,18 @@
+import sys
+
+from tpu_perf.subp import CommandExecutor
+
+
+def test_tee_pipe(tmp_path):
+    pool = CommandExecutor(str(tmp_path), [])
+    script = 'import sys; sys.stdout.buffer.write(b"ok\\n\\xff\\xfe\\n")'
+    for chunk in range(2):
+        pool.put('run', [sys.executable, '-c', script], shell=False)
+        pool.fire(pipe=True, append=chunk > 0)
+        # undecodable output is replaced instead of raising
+        assert list(pool.tee()) == ['ok\n', '��\n']
+        pool.drain()
+        assert pool.pipes[0].stdout.closed
+        pool.procs.clear()
+    with open(tmp_path / 'run.log', encoding='utf-8') as f:
+        assert f.read().count('ok\n') == 2
@@ -0,0 +1,42 @@
+"""
+Datum codec throughput: protobuf message vs framing the bytes directly,
+float_data vs raw bytes, and LMDB_Dataset writes.
+
+    PYTHONPATH=python python tools/datum_bench.py
+"""
+import tempfile
+import time
+import numpy as np
+from tpu_perf.io import array_to_datum, array_to_datum_str, \
+    datum_str_to_array, LMDB_Dataset
+
+
+def main():
+    arr = np.random.rand(16, 3, 224, 224).astype(np.float32)
+    mb = arr.nbytes / 1024**2
+    for raw in (False, True):
+        start = time.time()
+        values = [array_to_datum(a, 0, raw).SerializeToString() for a in arr]
+        encode = time.time() - start
+        start = time.time()
+        framed = [array_to_datum_str(a, 0, raw) for a in arr]
+        frame = time.time() - start
+        assert framed == values
+        start = time.time()
+        out = [datum_str_to_array(v) for v in values]
+        decode = time.time() - start
+        assert all((a == b).all() for a, b in zip(arr, out))
+        print('raw={}: protobuf encode {:.1f} MB/s, framed encode {:.1f} '
+              'MB/s ({:.0f}x), decode {:.1f} MB/s'.format(
+                  raw, mb / encode, mb / frame, encode / frame, mb / decode))
+        with tempfile.TemporaryDirectory() as path:
+            start = time.time()
+            with LMDB_Dataset(path, raw=raw) as db:
+                for _ in range(4):
+                    db.put(arr, list(range(len(arr))))
+            print('raw={}: LMDB_Dataset put {:.1f} MB/s'.format(
+                raw, 4 * mb / (time.time() - start)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Transformer.preprocess_batch against a loop of Transformer.preprocess.
+
+    PYTHONPATH=python python tools/preprocess_bench.py
+"""
+import time
+import numpy as np
+from tpu_perf.io import Transformer
+
+
+def make_transformer(backend):
+    t = Transformer({'data': (16, 3, 224, 224)})
+    t.set_transpose('data', (2, 0, 1))
+    t.set_channel_swap('data', (2, 1, 0))
+    t.set_raw_scale('data', 255)
+    t.set_mean('data', np.array([104., 117., 123.]))
+    t.set_input_scale('data', 0.017)
+    t.set_resize_backend('data', backend)
+    return t
+
+
+def best_of(func, repeat=10):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    rng = np.random.default_rng(0)
+    cases = (
+        ('float32 224', rng.random((16, 224, 224, 3), dtype=np.float32)),
+        ('uint8 224', rng.integers(0, 256, (16, 224, 224, 3), np.uint8)),
+        ('float32 256', rng.random((16, 256, 256, 3), dtype=np.float32)),
+    )
+    for case, batch in cases:
+        for backend in ('skimage', 'separable'):
+            t = make_transformer(backend)
+            out = np.empty((16, 3, 224, 224), dtype=np.float32)
+            for name, images in (('array', batch), ('list', list(batch))):
+                ref = np.stack([t.preprocess('data', im) for im in images])
+                res = t.preprocess_batch('data', images, out)
+                err = np.abs(ref - res).max()
+                loop = best_of(
+                    lambda: [t.preprocess('data', im) for im in images])
+                stack = best_of(lambda: np.stack(
+                    [t.preprocess('data', im) for im in images]))
+                batched = best_of(
+                    lambda: t.preprocess_batch('data', images, out))
+                print('{:11} {:9} {:5}: loop {:6.1f} ms, loop+stack {:6.1f} '
+                      'ms, batch {:6.1f} ms ({:.2f}x, {:.2f}x), max diff '
+                      '{:.2g}'.format(case, backend, name, loop * 1e3,
+                                      stack * 1e3, batched * 1e3,
+                                      loop / batched, stack / batched, err))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+/*
+ * Microbenchmark of the pipeline queues: raw producer/consumer throughput of
+ * a single link, then a three stage pipeline with trivial node functions,
+ * then a stub device pipeline with slow host stages run by 1..4 workers.
+ *
+ * build: make queue_bench (not part of the default target)
+ * usage: queue_bench [num_items]
+ */
+#include <cstdio>
+#include <cstdlib>
+#include <thread>
+#include <functional>
+#include "SGQueue.h"
+#include "SGPipelinePool.h"
+
+using namespace bm;
+
+static double secondsSince(const TimerClock::time_point& start) {
+    return std::chrono::duration<double>(TimerClock::now() - start).count();
+}
+
+static void benchLink(const char* name, std::shared_ptr<SGQueue<size_t>> queue, size_t num) {
+    auto start = TimerClock::now();
+    std::thread producer([&]{
+        for(size_t i=0; i<num; i++){
+            queue->push(i);
+        }
+        queue->join();
+    });
+    size_t value, count = 0, sum = 0;
+    while(queue->waitAndPop(value)){
+        sum += value;
+        count++;
+    }
+    producer.join();
+    auto seconds = secondsSince(start);
+    BM_ASSERT_EQ(count, num);
+    BM_ASSERT_EQ(sum, num*(num-1)/2);
+    printf("%-24s %8.2f Mitems/s %8.1f ns/item\n", name, num/seconds/1e6, seconds*1e9/num);
+}
+
+static void benchPipeline(const char* name, SGQueueType type, size_t num) {
+    SGPipelinePool<size_t, size_t> pool(1, nullptr, nullptr, nullptr, type);
+    std::function<bool(const size_t&, size_t&)> inc = [](const size_t& in, size_t& out){
+        out = in + 1;
+        return true;
+    };
+    std::function<std::vector<size_t>(std::shared_ptr<SGPipelineEmptyContext>)> buffers =
+            [](std::shared_ptr<SGPipelineEmptyContext>){ return std::vector<size_t>(2); };
+    pool.addNode(inc, buffers);
+    pool.addNode(inc, buffers);
+    pool.addNode(inc);
+    pool.start();
+    auto start = TimerClock::now();
+    std::thread producer([&]{
+        for(size_t i=0; i<num; i++){
+            pool.push(i);
+        }
+    });
+    size_t value, sum = 0;
+    for(size_t i=0; i<num; i++){
+        pool.waitAndPop(value);
+        sum += value;
+    }
+    auto seconds = secondsSince(start);
+    producer.join();
+    pool.join();
+    BM_ASSERT_EQ(sum, num*(num-1)/2 + 3*num);
+    printf("%-24s %8.2f Mitems/s %8.1f ns/item\n", name, num/seconds/1e6, seconds*1e9/num);
+}
+
+// pre and post sleep like host copies, forward like a fast device; outputs
+// must come back in input order whatever the number of workers
+static void benchWorkers(size_t workers, size_t num) {
+    SGPipelinePool<size_t, size_t> pool(1, nullptr, nullptr, nullptr);
+    auto stage = [](size_t us) {
+        return std::function<bool(const size_t&, size_t&)>([us](const size_t& in, size_t& out){
+            std::this_thread::sleep_for(std::chrono::microseconds(us));
+            out = in;
+            return true;
+        });
+    };
+    size_t depth = std::max<size_t>(workers + 1, 2);
+    std::function<std::vector<size_t>(std::shared_ptr<SGPipelineEmptyContext>)> buffers =
+            [depth](std::shared_ptr<SGPipelineEmptyContext>){ return std::vector<size_t>(depth); };
+    pool.addNode(stage(400), buffers, workers);
+    pool.addNode(stage(100), buffers);
+    pool.addNode(stage(400), std::function<std::vector<size_t>(std::shared_ptr<SGPipelineEmptyContext>)>(), workers);
+    pool.start();
+    auto start = TimerClock::now();
+    std::thread producer([&]{
+        for(size_t i=0; i<num; i++){
+            pool.push(i);
+        }
+    });
+    size_t value;
+    for(size_t i=0; i<num; i++){
+        pool.waitAndPop(value);
+        BM_ASSERT_EQ(value, i);
+    }
+    auto seconds = secondsSince(start);
+    producer.join();
+    pool.join();
+    printf("stub pipeline workers=%zu %8.0f samples/s\n", workers, num/seconds);
+}
+
+int main(int argc, char** argv) {
+    set_env_log_level(LogLevel::WARNING);
+    size_t num = argc > 1? strtoul(argv[1], nullptr, 10): 1000000;
+    benchLink("link locked", std::make_shared<SGQueue<size_t>>(), num);
+    auto bounded = std::make_shared<SGQueue<size_t>>();
+    bounded->setMaxNode(1024);
+    benchLink("link locked max=1024", bounded, num);
+    benchLink("link ring cap=1024", std::make_shared<SGRingQueue<size_t>>(1024), num);
+    benchLink("link ring cap=16", std::make_shared<SGRingQueue<size_t>>(16), num);
+    benchPipeline("pipeline locked", SG_QUEUE_LOCKED, num / 10);
+    benchPipeline("pipeline ring", SG_QUEUE_RING, num / 10);
+    for(size_t workers: {1, 2, 4}){
+        benchWorkers(workers, 2000);
+    }
+    return 0;
+}
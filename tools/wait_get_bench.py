@@ -0,0 +1,40 @@
+"""
+CPU time per inference of SGInfer results fetched by polling try_get()
+against blocking in wait_get().
+
+    PYTHONPATH=python python tools/wait_get_bench.py model.bmodel
+"""
+import argparse
+import time
+import numpy as np
+from tpu_perf.infer import SGInfer, nptype
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('bmodel', help='bmodel to run')
+    parser.add_argument('--num', type=int, default=1000, help='inferences per mode')
+    parser.add_argument('--devices', type=int, nargs='*', help='devices to use')
+    args = parser.parse_args()
+
+    runner = SGInfer(args.bmodel, devices=args.devices)
+    inputs = [np.zeros(i['shape'], dtype=nptype(i['dtype']))
+              for i in runner.get_input_info().values()]
+    for name, get in (('poll', runner.try_get), ('wait', runner.wait_get)):
+        start = time.process_time()
+        for _ in range(args.num):
+            runner.put(*inputs)
+        done = 0
+        while done < args.num:
+            task_id, _, _ = get()
+            if task_id == 0:
+                time.sleep(0.0001)
+                continue
+            done += 1
+        cpu = time.process_time() - start
+        print('{}: {:.1f}us cpu per inference'.format(name, cpu / args.num * 1e6))
+    runner.stop()
+
+
+if __name__ == '__main__':
+    main()